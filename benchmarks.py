@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+
+import bot
+
+BENCH_TOKEN = "1000:bench"
+BENCH_USER = 1
+BENCH_ADMIN = 2
+BASELINE_PATH = os.getenv(
+    "BENCH_BASELINE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+)
+
+
+def measure(fn, number):
+    started = time.perf_counter_ns()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter_ns() - started) / number
+
+
+def linear_dispatch(bot_token, user_id, text):
+    is_admin = bot.is_chat_admin(bot_token, user_id)
+    for label, (handler, admin_only) in bot.SECRET_CHAT_BUTTONS.items():
+        if text == label and (is_admin or not admin_only):
+            return handler, None
+    state = bot.get_user_state(bot_token, user_id)
+    for mode, handler in bot.SECRET_CHAT_MODES.items():
+        if state and state.get("mode") == mode:
+            return handler, state
+    return None, None
+
+
+def setup_dispatch():
+    bot.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    bot.init_db()
+    bot.user_pseudonyms[BENCH_TOKEN] = {BENCH_USER: "user", BENCH_ADMIN: "admin"}
+    bot.bot_admins[BENCH_TOKEN] = BENCH_ADMIN
+    bot.set_user_state(BENCH_TOKEN, BENCH_ADMIN, {"mode": "waiting_amount"})
+
+
+def bench_dispatch(number):
+    setup_dispatch()
+    cases = [
+        ("plain text", BENCH_USER, "привет всем"),
+        ("button", BENCH_USER, "📋 Реквизиты"),
+        ("admin button", BENCH_ADMIN, "📋 Лист участников"),
+        ("state mode", BENCH_ADMIN, "1500"),
+    ]
+    results = []
+    for name, user_id, text in cases:
+        assert bot.resolve_secret_chat_route(BENCH_TOKEN, user_id, text) == linear_dispatch(BENCH_TOKEN, user_id, text)
+        routed = measure(lambda: bot.resolve_secret_chat_route(BENCH_TOKEN, user_id, text), number)
+        linear = measure(lambda: linear_dispatch(BENCH_TOKEN, user_id, text), number)
+        results.append((name, routed, linear))
+    return results
+
+
+def calibrate(number=5000):
+    def reference():
+        total = 0
+        for i in range(100):
+            total += i * i
+        return str(total)
+    return measure(reference, number)
+
+
+def setup_micro():
+    bot.bot_shifts[BENCH_TOKEN] = {"start": 20, "end": 6}
+    bot.message_map[BENCH_TOKEN] = {
+        (BENCH_USER, 10): {"pseudonym": "user", "text": "hi", "sender_id": BENCH_USER, "sender_msg_id": 10,
+                           "sent_to": {uid: 100 + uid for uid in range(2, 202)}},
+        (BENCH_ADMIN, 102): {"pseudonym": "user", "text": "hi", "sender_id": BENCH_USER, "sender_msg_id": 10},
+        (BENCH_ADMIN, 500): {"pseudonym": "user", "text": "Чек: 100 ARS", "sender_id": BENCH_USER, "receipt_id": "bench"},
+    }
+    bot.receipts["bench"] = {"message_ids": {uid: 600 + uid for uid in range(1, 201)}}
+    receipt = {"pseudonym": "user", "text": "1.234.567,89 ARS"}
+    comments = [{"pseudonym": f"admin{i}", "text": f"комментарий {i}"} for i in range(5)]
+    return receipt, comments
+
+
+def micro_cases():
+    receipt, comments = setup_micro()
+    comments_text = bot.render_receipt_comments(comments)
+    return {
+        "format_amount_int": lambda: bot.format_amount(1234567),
+        "format_amount_float": lambda: bot.format_amount(1234567.89),
+        "resolve_reply_own": lambda: bot.resolve_reply_target(BENCH_TOKEN, BENCH_USER, 10, 150),
+        "resolve_reply_copy": lambda: bot.resolve_reply_target(BENCH_TOKEN, BENCH_ADMIN, 102, 150),
+        "resolve_reply_receipt": lambda: bot.resolve_reply_target(BENCH_TOKEN, BENCH_ADMIN, 500, 150),
+        "is_working_hours": lambda: bot.is_working_hours(BENCH_TOKEN),
+        "get_working_day_date": lambda: bot.get_working_day_date(BENCH_TOKEN),
+        "main_keyboard_user": lambda: bot.get_main_keyboard(False),
+        "main_keyboard_admin": lambda: bot.get_main_keyboard(True),
+        "receipt_comments": lambda: bot.render_receipt_comments(comments),
+        "receipt_caption": lambda: bot.render_receipt_caption(
+            receipt, "Статус: Принят ✅ (admin)", "\nИтого за смену: 12.345,67 ARS", comments_text
+        ),
+    }
+
+
+def bench_micro(run_ms, repeat=5):
+    references = []
+    results = {}
+    for name, fn in micro_cases().items():
+        number = max(int(run_ms * 1e6 / measure(fn, 100)), 100)
+        runs = []
+        for _ in range(repeat):
+            reference = calibrate()
+            runs.append((measure(fn, number), reference))
+            references.append(reference)
+        ns = min(case for case, _ in runs)
+        results[name] = {"ns": ns, "score": min(case / reference for case, reference in runs)}
+    return min(references), results
+
+
+def merge_passes(passes):
+    return {
+        name: {
+            "ns": statistics.median(results[name]["ns"] for _, results in passes),
+            "score": statistics.median(results[name]["score"] for _, results in passes),
+        }
+        for name in passes[0][1]
+    }
+
+
+def host_fingerprint():
+    cpu = platform.processor()
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    return {
+        "machine": platform.machine(),
+        "cpu": cpu,
+        "cpus": os.cpu_count(),
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+    }
+
+
+def check_regressions(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result["score"] > base["score"] * (1 + threshold):
+            regressions.append((name, result["score"] / base["score"] - 1))
+    return regressions
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def summarize(name, members, latencies, seconds, api):
+    calls = sum(count for method, count in api.stats.items() if not method.startswith("error_"))
+    errors = sum(count for method, count in api.stats.items() if method.startswith("error_"))
+    return {
+        "scenario": name,
+        "members": members,
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / seconds if seconds else 0.0,
+        "calls_per_sec": calls / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+    }
+
+
+async def timed_updates(app, updates):
+    latencies = []
+    started = time.perf_counter()
+    for update in updates:
+        update_started = time.perf_counter()
+        await app.process_update(update)
+        latencies.append(time.perf_counter() - update_started)
+    return latencies, time.perf_counter() - started
+
+
+async def run_fanout(member_counts, operations, latency, rate_limit, flood_rate):
+    import fake_telegram
+    from telegram import Update
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    bot.init_db()
+    bot.GOOGLE_SHEETS_BACKEND = "fake"
+    bot.init_google_sheets()
+
+    api = fake_telegram.FakeBotApi(latency=latency, rate_limit=rate_limit, flood_rate=flood_rate, seed=1)
+    bot.TELEGRAM_API_URL = await api.start()
+    bot.start_state_writer()
+    results = []
+    try:
+        for index, members in enumerate(member_counts):
+            token = f"{9000 + index}:{'b' * 35}"
+            username = f"bench{members}"
+            api.add_bot(token, username)
+            bot.create_bot_sheet(username)
+            app = bot.build_secret_app(token)
+            await app.initialize()
+            bot.created_bots[token] = {"token": token, "application": app, "username": username}
+            bot.bot_admins[token] = BENCH_USER
+            bot.user_pseudonyms[token] = {uid: f"user{uid}" for uid in range(1, members + 1)}
+
+            def build(update):
+                return Update.de_json(update, app.bot)
+
+            senders = [1 + i % members for i in range(operations)]
+            api.stats.clear()
+            latencies, seconds = await timed_updates(app, [
+                build(fake_telegram.make_text_update(uid, f"message {i}")) for i, uid in enumerate(senders)
+            ])
+            results.append(summarize("message", members, latencies, seconds, api))
+
+            known = set(bot.receipts)
+            for i, uid in enumerate(senders):
+                await app.process_update(build(fake_telegram.make_photo_update(uid, f"photo{index}-{i}")))
+            api.stats.clear()
+            latencies, seconds = await timed_updates(app, [
+                build(fake_telegram.make_text_update(uid, str(100 + i))) for i, uid in enumerate(senders)
+            ])
+            results.append(summarize("receipt", members, latencies, seconds, api))
+
+            created = [rid for rid in bot.receipts if rid not in known]
+            api.stats.clear()
+            latencies, seconds = await timed_updates(app, [
+                build(fake_telegram.make_callback_update(BENCH_USER, f"receipt_approve_{rid}")) for rid in created
+            ])
+            results.append(summarize("approve", members, latencies, seconds, api))
+
+            await app.shutdown()
+            bot.evict_bot_state(token)
+    finally:
+        bot.stop_state_writer()
+        await api.stop()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for bot hot paths")
+    parser.add_argument("benchmark", choices=["dispatch", "fanout", "micro"])
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5, help="micro: best of N runs")
+    parser.add_argument("--run-ms", type=float, default=50, help="micro: target duration of one run")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="micro: baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="micro: store results as the new baseline")
+    parser.add_argument("--passes", type=int, default=5, help="micro: passes whose median becomes the baseline")
+    parser.add_argument("--threshold", type=float, default=0.3, help="micro: allowed slowdown before failing")
+    parser.add_argument("--members", default="10,100,1000", help="chat sizes for fanout, comma separated")
+    parser.add_argument("--operations", type=int, default=5, help="updates per fanout scenario")
+    parser.add_argument("--latency", default="0", help="fake Bot API latency per call, e.g. 0.02-0.05")
+    parser.add_argument("--rate-limit", type=float, default=0, help="fake Bot API sends per second per bot")
+    parser.add_argument("--flood-rate", type=float, default=0, help="probability of an injected 429")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "dispatch":
+        print(f"{'case':<14} {'router ns':>10} {'linear ns':>10} {'speedup':>8}")
+        for name, routed, linear in bench_dispatch(args.number):
+            print(f"{name:<14} {routed:>10.0f} {linear:>10.0f} {linear / routed:>7.1f}x")
+    elif args.benchmark == "micro":
+        passes = [bench_micro(args.run_ms, args.repeat) for _ in range(args.passes if args.save_baseline else 1)]
+        reference = statistics.median(reference for reference, _ in passes)
+        results = merge_passes(passes)
+        baseline = {}
+        baseline_host = None
+        if os.path.exists(args.baseline) and not args.save_baseline:
+            with open(args.baseline) as f:
+                saved = json.load(f)
+            baseline, baseline_host = saved["results"], saved.get("host")
+        print(f"calibration: {reference:.0f} ns")
+        print(f"{'case':<24} {'ns':>9} {'score':>8} {'baseline':>9} {'change':>8}")
+        for name, result in results.items():
+            base = baseline.get(name)
+            change = f"{(result['score'] / base['score'] - 1) * 100:>+7.1f}%" if base else f"{'-':>8}"
+            base_score = f"{base['score']:>9.3f}" if base else f"{'-':>9}"
+            print(f"{name:<24} {result['ns']:>9.0f} {result['score']:>8.3f} {base_score} {change}")
+        if args.save_baseline:
+            with open(args.baseline, "w") as f:
+                json.dump({"calibration_ns": reference, "host": host_fingerprint(), "results": results}, f, indent=2)
+            print(f"baseline saved to {args.baseline}")
+        elif not baseline:
+            print(f"no baseline at {args.baseline}; run with --save-baseline on the CI host to create one")
+            return 1
+        elif baseline_host != host_fingerprint():
+            print(f"baseline recorded on {baseline_host}, this host is {host_fingerprint()}")
+            print("re-record it here with --save-baseline; scores are only comparable on the same host")
+            return 1
+        else:
+            regressions = check_regressions(results, baseline, args.threshold)
+            for name, change in regressions:
+                print(f"REGRESSION {name}: {change * 100:+.1f}% (threshold {args.threshold * 100:.0f}%)")
+            if regressions:
+                return 1
+    elif args.benchmark == "fanout":
+        members = [int(x) for x in args.members.split(",") if x]
+        results = asyncio.run(run_fanout(members, args.operations, args.latency, args.rate_limit, args.flood_rate))
+        print(f"{'scenario':<9} {'members':>7} {'ops':>4} {'ops/s':>8} {'calls/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}")
+        for r in results:
+            print(
+                f"{r['scenario']:<9} {r['members']:>7} {r['ops']:>4} {r['ops_per_sec']:>8.2f} {r['calls_per_sec']:>8.0f} "
+                f"{r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errors']:>6}"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
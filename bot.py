@@ -4,24 +4,98 @@ import time
 import random
 import string
 import sqlite3
+import csv
+import io
+import json
+import hashlib
+import re
+import bisect
+import signal
+import subprocess
+import sys
+import threading
+import queue
+import asyncio
+import contextvars
+import importlib
+from collections import Counter, deque
 from datetime import datetime, timezone, timedelta
+from logging.handlers import QueueHandler, QueueListener
+
+IMPORT_STARTED = time.perf_counter()
 from dotenv import load_dotenv
 
 load_dotenv()
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import requests
-
-import gspread
-from google.oauth2.service_account import Credentials
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from telegram.error import InvalidToken, RetryAfter
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
+from telegram.request import HTTPXRequest
+import httpx
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 ADMIN_BOT_TOKEN = os.getenv("ADMIN_BOT_TOKEN")
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "https://api.telegram.org").rstrip("/")
 WHITELIST = [int(x) for x in os.getenv("WHITELIST", "").split(",") if x]
 GOOGLE_SHEETS_CREDS = os.getenv("GOOGLE_SHEETS_CREDS")
+SHEETS_INIT_WAIT = float(os.getenv("SHEETS_INIT_WAIT", "60"))
 GOOGLE_SHEET_ID = os.getenv("GOOGLE_SHEET_ID")
+GOOGLE_SHEETS_BACKEND = os.getenv("GOOGLE_SHEETS_BACKEND", "google").lower()
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "21600"))
+RECONCILE_CHUNK_ROWS = int(os.getenv("RECONCILE_CHUNK_ROWS", "500"))
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+HTTP_UPDATES_POOL_SIZE = int(os.getenv("HTTP_UPDATES_POOL_SIZE", "256"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+HTTP_WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))
+WORKER_SYNC_INTERVAL = float(os.getenv("WORKER_SYNC_INTERVAL", "5"))
+WORKER_TIMEOUT = float(os.getenv("WORKER_TIMEOUT", "30"))
+WORKER_STATE_TIMEOUT = float(os.getenv("WORKER_STATE_TIMEOUT", "5"))
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", "5"))
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "10"))
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "10"))
+RESTORE_TIMEOUT = float(os.getenv("RESTORE_TIMEOUT", "60"))
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "1") != "0"
+POLL_TIMEOUT_ACTIVE = int(os.getenv("POLL_TIMEOUT_ACTIVE", "10"))
+POLL_TIMEOUT_IDLE = int(os.getenv("POLL_TIMEOUT_IDLE", "50"))
+POLL_ACTIVE_WINDOW = float(os.getenv("POLL_ACTIVE_WINDOW", "120"))
+POLL_IDLE_AFTER = float(os.getenv("POLL_IDLE_AFTER", "900"))
+POLL_TIMEOUT_SLEEPING = int(os.getenv("POLL_TIMEOUT_SLEEPING", "300"))
+POLL_ALLOWED_UPDATES = ["message", "edited_message", "callback_query"]
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
+HANDLER_STATS_WINDOW = int(os.getenv("HANDLER_STATS_WINDOW", "1000"))
+MEMORY_SAMPLE_INTERVAL = int(os.getenv("MEMORY_SAMPLE_INTERVAL", "300"))
+RECEIPT_TRACE_LIMIT = int(os.getenv("RECEIPT_TRACE_LIMIT", "500"))
+STATE_RESTORE_DAYS = float(os.getenv("STATE_RESTORE_DAYS", "7"))
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "20"))
+PENDING_PAGE_SIZE = int(os.getenv("PENDING_PAGE_SIZE", "8"))
+PENDING_ESCALATE_AFTER = int(os.getenv("PENDING_ESCALATE_AFTER", "3600"))
+PENDING_ESCALATE_INTERVAL = int(os.getenv("PENDING_ESCALATE_INTERVAL", "60"))
+BULK_EDIT_CONCURRENCY = int(os.getenv("BULK_EDIT_CONCURRENCY", "8"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = float(os.getenv("LOG_RATE_WINDOW", "10"))
+LOG_SAMPLE_RATES = {
+    event.strip(): float(rate)
+    for event, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLE_RATES", "").split(","))
+    if event.strip() and rate
+}
+EXPORT_BACKEND = os.getenv("EXPORT_BACKEND", "sheets").lower()
+EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "exports")
+EXPORT_BUFFER_ROWS = int(os.getenv("EXPORT_BUFFER_ROWS", "50"))
+EXPORT_FLUSH_INTERVAL = int(os.getenv("EXPORT_FLUSH_INTERVAL", "10"))
 
 GEO_CURRENCIES = {
     "argentina": "ARS",
@@ -39,6 +113,7 @@ GEO_CURRENCIES = {
 created_bots = {}
 user_pseudonyms = {}
 receipts = {}
+receipt_index = {}
 bot_admins = {}
 bot_chat_admins = {}
 invite_links = {}
@@ -49,14 +124,531 @@ bot_requisites = {}
 message_map = {}
 banned_users = {}
 receipt_watchers = {}
+bot_sheet_partitions = {}
+startup_report = {}
+webhook_routes = {}
+shared_requests = {}
+worker_processes = {}
+bot_pollers = {}
+WORKER_ID = None
+background_tasks = set()
+log_listener = None
+metric_counters = Counter()
+metric_histograms = {}
+handler_timings = {}
+handler_timing = contextvars.ContextVar("handler_timing", default=None)
+memory_report = {}
+memory_sampler = None
+state_writer = None
+state_writes = queue.Queue()
+receipt_traces = {}
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.db")
 
 google_sheets_client = None
 spreadsheet = None
+sheets_ready = threading.Event()
+startup_phases = {}
+import_timings = {}
 
 
 MOSCOW_TZ = timezone(timedelta(hours=3))
+SHEET_HEADER = ['Timestamp', 'Amount', 'Currency', 'Pseudonym', 'Photo URL']
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "suppressed", "event"}
+
+
+class LogRateLimiter(logging.Filter):
+    def __init__(self, limit, window, sample_rates):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.sample_rates = sample_rates
+        self.windows = {}
+        self.random = random.Random()
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "event", None) or str(record.msg)
+        rate = self.sample_rates.get(key)
+        if rate is not None and self.random.random() >= rate:
+            return False
+        if not self.limit or record.levelno >= logging.CRITICAL:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.windows.get(key)
+            if entry is None or now - entry[0] >= self.window:
+                if len(self.windows) > 10000:
+                    self.windows.clear()
+                self.windows[key] = [now, 1, 0]
+                if entry and entry[2]:
+                    record.suppressed = entry[2]
+                return True
+            if entry[1] >= self.limit:
+                entry[2] += 1
+                return False
+            entry[1] += 1
+            return True
+
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} [+{suppressed} similar suppressed]" if suppressed else text
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None) or str(record.msg),
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS})
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+def setup_logging():
+    global log_listener
+    if log_listener:
+        return
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(TextLogFormatter("%(asctime)s %(levelname)s:%(name)s:%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(LogRateLimiter(LOG_RATE_LIMIT, LOG_RATE_WINDOW, LOG_SAMPLE_RATES))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_logging():
+    global log_listener
+    if log_listener:
+        log_listener.stop()
+        log_listener = None
+
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRIC_HELP = {
+    "bot_updates_total": ("counter", "Updates received per bot"),
+    "telegram_api_calls_total": ("counter", "Bot API calls by method and result"),
+    "telegram_api_seconds": ("histogram", "Bot API call latency by method"),
+    "fanout_seconds": ("histogram", "Time to deliver one message to every chat member"),
+    "export_seconds": ("histogram", "Sheets/export backend call latency"),
+    "sqlite_write_seconds": ("histogram", "SQLite write transaction latency"),
+    "handler_seconds": ("histogram", "Wall time spent in each update handler"),
+    "slow_updates_total": ("counter", "Updates whose handler exceeded SLOW_UPDATE_SECONDS"),
+    "state_entries": ("gauge", "Entries held in in-memory state"),
+    "state_bytes": ("gauge", "Approximate deep size of in-memory state (last sample)"),
+    "state_bot_bytes": ("gauge", "Approximate deep size of in-memory state per bot (last sample)"),
+    "process_resident_memory_bytes": ("gauge", "Resident set size at the last memory sample"),
+    "bots_running": ("gauge", "Secret bots running in this process"),
+    "receipts_pending": ("gauge", "Receipts waiting for an admin decision"),
+    "receipts_escalated_total": ("counter", "Pending receipts escalated to receipt watchers"),
+}
+
+
+def metric_inc(name, labels=(), value=1):
+    metric_counters[(name, labels)] += value
+
+
+def metric_observe(name, seconds, labels=()):
+    histogram = metric_histograms.get((name, labels))
+    if histogram is None:
+        histogram = metric_histograms[(name, labels)] = {"buckets": [0] * len(METRIC_BUCKETS), "sum": 0.0, "count": 0}
+    index = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    if index < len(METRIC_BUCKETS):
+        histogram["buckets"][index] += 1
+    histogram["sum"] += seconds
+    histogram["count"] += 1
+
+
+def add_handler_segment(segment, seconds):
+    timing = handler_timing.get()
+    if timing is not None:
+        timing[segment] += seconds
+
+
+def record_api_call(method, seconds, result):
+    metric_inc("telegram_api_calls_total", (("method", method), ("result", result)))
+    metric_observe("telegram_api_seconds", seconds, (("method", method),))
+    add_handler_segment("api", seconds)
+
+
+def record_db_write(op, seconds):
+    metric_observe("sqlite_write_seconds", seconds, (("op", op),))
+
+
+def record_export_call(op, seconds):
+    metric_observe("export_seconds", seconds, (("backend", export_backend.name), ("op", op)))
+    add_handler_segment("sheets", seconds)
+
+
+def record_fanout(kind, started):
+    metric_observe("fanout_seconds", time.perf_counter() - started, (("kind", kind),))
+
+
+async def gather_api(*aws):
+    timing = handler_timing.get()
+    if timing is None:
+        return await asyncio.gather(*aws)
+    token = handler_timing.set(None)
+    started = time.perf_counter()
+    try:
+        return await asyncio.gather(*aws)
+    finally:
+        handler_timing.reset(token)
+        timing["api"] += time.perf_counter() - started
+
+
+def start_receipt_trace(receipt_id, bot_token, upload=None):
+    trace = {
+        "receipt_id": receipt_id,
+        "bot": created_bots.get(bot_token, {}).get("username"),
+        "spans": [],
+    }
+    if upload:
+        trace["spans"].append({"name": "upload", **upload})
+        waited = time.time() - upload["start"] - upload["ms"] / 1000
+        trace["spans"].append({"name": "amount_wait", "start": round(upload["start"] + upload["ms"] / 1000, 6),
+                               "ms": round(waited * 1000, 3)})
+    receipt_traces[receipt_id] = trace
+    while len(receipt_traces) > RECEIPT_TRACE_LIMIT:
+        receipt_traces.pop(next(iter(receipt_traces)))
+    return trace
+
+
+def make_span(started, **attrs):
+    elapsed = time.perf_counter() - started
+    return {"start": round(time.time() - elapsed, 6), "ms": round(elapsed * 1000, 3), **attrs}
+
+
+def add_receipt_span(receipt_id, name, started, **attrs):
+    trace = receipt_traces.get(receipt_id)
+    if trace is not None:
+        trace["spans"].append({"name": name, **make_span(started, **attrs)})
+
+
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def collect_state_sizes():
+    return {
+        "message_map": sum(len(entries) for entries in list(message_map.values())),
+        "receipts": len(receipts),
+        "user_states": len(user_states),
+        "invite_links": len(invite_links),
+        "user_pseudonyms": sum(len(users) for users in list(user_pseudonyms.values())),
+    }
+
+
+def render_metrics():
+    series = {}
+    for (name, labels), value in list(metric_counters.items()):
+        series.setdefault(name, []).append(f"{name}{format_metric_labels(labels)} {value}")
+    for (name, labels), histogram in list(metric_histograms.items()):
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, histogram["buckets"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{name}_bucket{format_metric_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+        lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram['sum']:.6f}")
+        lines.append(f"{name}_count{format_metric_labels(labels)} {histogram['count']}")
+    series["state_entries"] = [
+        f"state_entries{format_metric_labels((('structure', structure),))} {size}"
+        for structure, size in collect_state_sizes().items()
+    ]
+    series["bots_running"] = [f"bots_running {len(created_bots)}"]
+    series["receipts_pending"] = [
+        f"receipts_pending {sum(len(buckets.get('pending', ())) for buckets in list(receipt_index.values()))}"
+    ]
+    report = memory_report
+    if report:
+        series["state_bytes"] = [
+            f"state_bytes{format_metric_labels((('structure', structure),))} {size}"
+            for structure, (count, size) in report["totals"].items()
+        ]
+        series["state_bot_bytes"] = [
+            f"state_bot_bytes{format_metric_labels((('bot', usage['username']),))} {usage['bytes']}"
+            for usage in report["bots"]
+        ]
+        series["process_resident_memory_bytes"] = [f"process_resident_memory_bytes {report['rss']}"]
+
+    output = []
+    for name in sorted(series):
+        kind, description = METRIC_HELP.get(name, ("untyped", name))
+        output.append(f"# HELP {name} {description}")
+        output.append(f"# TYPE {name} {kind}")
+        output.extend(series[name])
+    return "\n".join(output) + "\n"
+
+
+async def handle_metrics_request(method, path, headers, body):
+    if method != "GET" or path.split("?", 1)[0] != "/metrics":
+        return 404, "text/plain", b"Not Found"
+    return 200, "text/plain; version=0.0.4", render_metrics().encode()
+
+
+async def handle_worker_request(method, path, headers, body):
+    if method == "GET" and path.split("?", 1)[0] == "/state":
+        state = {
+            "handlers": {name: list(samples) for name, samples in handler_timings.items()},
+            "slow_updates": count_slow_updates(),
+            "traces": list(receipt_traces.values()),
+            "memory": memory_report,
+        }
+        return 200, "application/json", json.dumps(state, ensure_ascii=False).encode()
+    return await handle_metrics_request(method, path, headers, body)
+
+
+class TimedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.opened = time.perf_counter()
+        self.op = "db"
+
+    def commit(self):
+        super().commit()
+        record_db_write(self.op, time.perf_counter() - self.opened)
+
+    def close(self):
+        super().close()
+        add_handler_segment("db", time.perf_counter() - self.opened)
+
+
+def db_connect(op="db"):
+    conn = sqlite3.connect(DB_PATH, factory=TimedConnection)
+    conn.op = op
+    return conn
+
+
+def record_handler_time(name, bot_username, seconds, timing):
+    metric_observe("handler_seconds", seconds, (("handler", name),))
+    samples = handler_timings.get(name)
+    if samples is None:
+        samples = handler_timings[name] = deque(maxlen=HANDLER_STATS_WINDOW)
+    samples.append((seconds, timing["api"], timing["db"], timing["sheets"]))
+    if seconds >= SLOW_UPDATE_SECONDS:
+        metric_inc("slow_updates_total", (("handler", name),))
+        other = max(seconds - timing["api"] - timing["db"] - timing["sheets"], 0.0)
+        logger.warning(
+            "Slow update in %s (@%s): %.3fs = api %.3fs + db %.3fs + sheets %.3fs + other %.3fs",
+            name, bot_username, seconds, timing["api"], timing["db"], timing["sheets"], other,
+            extra={"event": "slow_update"},
+        )
+
+
+def timed_handler(callback):
+    async def wrapper(update, context):
+        timing = {"api": 0.0, "db": 0.0, "sheets": 0.0}
+        token = handler_timing.set(timing)
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            handler_timing.reset(token)
+            record_handler_time(callback.__name__, context.bot.username, time.perf_counter() - started, timing)
+
+    wrapper.__name__ = callback.__name__
+    return wrapper
+
+
+def instrument_handlers(app):
+    for group, handlers in app.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            handler.callback = timed_handler(handler.callback)
+
+
+MEMORY_STRUCTURES = ("message_map", "receipts", "user_states", "invite_links", "user_pseudonyms")
+
+
+def deep_sizeof(*objects):
+    seen = set()
+    stack = list(objects)
+    size = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            stack.extend(item)
+    return size
+
+
+def read_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def group_state_by_bot():
+    groups = {}
+
+    def add(token, structure, key, value):
+        groups.setdefault(token, {name: [] for name in MEMORY_STRUCTURES})[structure].append((key, value))
+
+    for token, entries in list(message_map.items()):
+        for key, value in list(entries.items()):
+            add(token, "message_map", key, value)
+    for receipt_id, receipt in list(receipts.items()):
+        add(receipt.get("bot_token"), "receipts", receipt_id, receipt)
+    for key, state in list(user_states.items()):
+        add(key.rsplit("_", 1)[0], "user_states", key, state)
+    for code, invite in list(invite_links.items()):
+        add(invite.get("bot_token"), "invite_links", code, invite)
+    for token, users in list(user_pseudonyms.items()):
+        for key, value in list(users.items()):
+            add(token, "user_pseudonyms", key, value)
+    return groups
+
+
+def sample_memory():
+    started = time.perf_counter()
+    for _ in range(3):
+        try:
+            groups = group_state_by_bot()
+            break
+        except RuntimeError:
+            time.sleep(0.05)
+    else:
+        return memory_report
+    totals = {name: (0, 0) for name in MEMORY_STRUCTURES}
+    bots = []
+    for token, structures in groups.items():
+        usage = {"token": token, "username": created_bots.get(token, {}).get("username") or str(token), "bytes": 0}
+        for name, items in structures.items():
+            size = deep_sizeof(*(part for item in items for part in item))
+            usage[name] = (len(items), size)
+            usage["bytes"] += size
+            count, total = totals[name]
+            totals[name] = (count + len(items), total + size)
+        bots.append(usage)
+    bots.sort(key=lambda usage: -usage["bytes"])
+    return {
+        "sampled_at": time.time(),
+        "duration": time.perf_counter() - started,
+        "rss": read_rss(),
+        "totals": totals,
+        "bots": bots,
+    }
+
+
+def memory_sampler_loop(stop_event):
+    global memory_report
+    while not stop_event.is_set():
+        try:
+            memory_report = sample_memory()
+        except Exception as e:
+            logger.error("Memory sampling failed: %s", e)
+        stop_event.wait(MEMORY_SAMPLE_INTERVAL)
+
+
+def start_memory_sampler():
+    global memory_sampler
+    if MEMORY_SAMPLE_INTERVAL <= 0 or memory_sampler:
+        return
+    stop_event = threading.Event()
+    thread = threading.Thread(target=memory_sampler_loop, args=(stop_event,), name="memory-sampler", daemon=True)
+    thread.start()
+    memory_sampler = (thread, stop_event)
+
+
+def stop_memory_sampler():
+    global memory_sampler
+    if memory_sampler:
+        memory_sampler[1].set()
+        memory_sampler = None
+
+
+def format_bytes(size):
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+
+def merge_memory_reports(reports):
+    reports = [report for report in reports if report]
+    if len(reports) < 2:
+        return reports[0] if reports else {}
+    totals = {name: (0, 0) for name in MEMORY_STRUCTURES}
+    for report in reports:
+        for name, (count, size) in report["totals"].items():
+            total_count, total_size = totals.get(name, (0, 0))
+            totals[name] = (total_count + count, total_size + size)
+    return {
+        "sampled_at": min(report["sampled_at"] for report in reports),
+        "duration": max(report["duration"] for report in reports),
+        "rss": sum(report["rss"] for report in reports),
+        "totals": totals,
+        "bots": sorted((usage for report in reports for usage in report["bots"]), key=lambda usage: -usage["bytes"]),
+        "processes": len(reports),
+    }
+
+
+def format_memory_report(report, limit=10):
+    sampled = datetime.fromtimestamp(report["sampled_at"]).strftime("%H:%M:%S")
+    processes = report.get("processes", 1)
+    title = f"Память процессов ({processes})" if processes > 1 else "Память процесса"
+    lines = [
+        f"🧠 {title}: {format_bytes(report['rss'])} (срез {sampled}, {report['duration'] * 1000:.0f} мс)",
+        "",
+    ]
+    for name, (count, size) in report["totals"].items():
+        lines.append(f"{name}: {count} записей, {format_bytes(size)}")
+    lines.append("")
+    lines.append(f"Крупнейшие чаты (из {len(report['bots'])}):")
+    for usage in report["bots"][:limit]:
+        parts = ", ".join(f"{name} {usage[name][0]}" for name in MEMORY_STRUCTURES if usage[name][0])
+        lines.append(f"@{usage['username']}: {format_bytes(usage['bytes'])} ({parts})")
+    if not report["bots"]:
+        lines.append("Нет данных")
+    return "\n".join(lines)
 
 
 def resolve_reply_target(bot_token, user_id, reply_msg_id, target_uid):
@@ -112,6 +704,37 @@ def format_amount(value):
     return formatted
 
 
+def receipt_markup(receipt_id, status):
+    comment_btn = [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
+    if status == "pending":
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Принять", callback_data=f"receipt_approve_{receipt_id}")],
+            [InlineKeyboardButton("❌ Отклонить", callback_data=f"receipt_decline_{receipt_id}")],
+            comment_btn
+        ])
+    if status == "approved":
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("✏️ Изменить", callback_data=f"receipt_edit_{receipt_id}")],
+            comment_btn
+        ])
+    if status == "declined":
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("↩️ Назад", callback_data=f"receipt_undo_{receipt_id}")],
+            comment_btn
+        ])
+    return InlineKeyboardMarkup([comment_btn])
+
+
+def render_receipt_comments(comments):
+    if not comments:
+        return ""
+    return "\n\n💬 Комментарии:" + "".join(f"\n{c['pseudonym']}: {c['text']}" for c in comments)
+
+
+def render_receipt_caption(receipt_data, status_text, daily_line="", comments_text=""):
+    return f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
+
+
 def get_moscow_now():
     return datetime.now(MOSCOW_TZ)
 
@@ -158,20 +781,61 @@ def get_main_keyboard(is_admin=False):
         keyboard.append(["🔗 Инвайт", "⏰ Смена", "📝 Изм. реквизиты"])
         keyboard.append(["👑 Назначить админа", "🚫 Снять админа", "👢 Кикнуть"])
         keyboard.append(["🔔 Уведомления чеков", "📋 Лист участников"])
+        keyboard.append(["⏳ Ожидающие", "📊 Отчёт"])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
 
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    started = time.perf_counter()
+    module = importlib.import_module(name)
+    import_timings[name] = time.perf_counter() - started
+    return module
+
+
+def record_startup_phase(name, started):
+    startup_phases[name] = (started - IMPORT_STARTED, time.perf_counter() - started)
+
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def sheets_available():
+    if not sheets_ready.is_set() and not in_event_loop():
+        sheets_ready.wait(SHEETS_INIT_WAIT)
+    return spreadsheet is not None
+
+
+async def wait_for_sheets():
+    if not sheets_ready.is_set():
+        await asyncio.to_thread(sheets_ready.wait, SHEETS_INIT_WAIT)
+
+
 def init_google_sheets():
     global google_sheets_client, spreadsheet
     try:
-        if not GOOGLE_SHEETS_CREDS or not GOOGLE_SHEET_ID:
-            logger.warning("Google Sheets credentials not configured")
-            return False
+        if GOOGLE_SHEETS_BACKEND == "fake":
+            fake_gspread = lazy_import("fake_gspread")
+            google_sheets_client = fake_gspread.authorize()
+            spreadsheet = google_sheets_client.open_by_key(GOOGLE_SHEET_ID or "fake")
+            logger.warning("Using in-process fake Google Sheets backend")
+        else:
+            if not GOOGLE_SHEETS_CREDS or not GOOGLE_SHEET_ID:
+                logger.warning("Google Sheets credentials not configured")
+                return False
 
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        creds = Credentials.from_service_account_file(GOOGLE_SHEETS_CREDS, scopes=scope)
-        google_sheets_client = gspread.authorize(creds)
-        spreadsheet = google_sheets_client.open_by_key(GOOGLE_SHEET_ID)
+            gspread = lazy_import("gspread")
+            service_account = lazy_import("google.oauth2.service_account")
+            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+            creds = service_account.Credentials.from_service_account_file(GOOGLE_SHEETS_CREDS, scopes=scope)
+            google_sheets_client = gspread.authorize(creds)
+            spreadsheet = google_sheets_client.open_by_key(GOOGLE_SHEET_ID)
 
         try:
             spreadsheet.worksheet("Dashboard")
@@ -182,60 +846,208 @@ def init_google_sheets():
         logger.info("Google Sheets initialized successfully")
         return True
     except Exception as e:
-        logger.error(f"Failed to initialize Google Sheets: {e}")
+        logger.error("Failed to initialize Google Sheets: %s", e)
         return False
+    finally:
+        sheets_ready.set()
 
 
-def create_bot_sheet(bot_username):
+async def init_google_sheets_background():
+    started = time.perf_counter()
+    await asyncio.to_thread(init_google_sheets)
+    record_startup_phase("sheets_init", started)
+    logger.info("Google Sheets ready after %.2fs in background", startup_phases["sheets_init"][1])
+
+
+def get_bot_token_by_username(bot_username):
+    for token, bot_info in created_bots.items():
+        if bot_info["username"] == bot_username:
+            return token
+    return None
+
+
+def get_sheet_period(bot_token=None):
+    if bot_token:
+        return get_working_day_date(bot_token)[:7]
+    return get_moscow_now().strftime("%Y-%m")
+
+
+def get_partition_title(bot_username, period):
+    return f"{bot_username}_{period}"
+
+
+def get_bot_worksheet(bot_username, period=None):
+    current_period = get_sheet_period(get_bot_token_by_username(bot_username))
+    period = period or current_period
+
+    cached = bot_sheet_partitions.get(bot_username)
+    if cached and cached[0] == period:
+        return cached[1]
+
+    if period != current_period:
+        if db_is_sheet_partition_closed(bot_username, period):
+            return None
+        return spreadsheet.worksheet(get_partition_title(bot_username, period))
+
+    title = get_partition_title(bot_username, period)
+    from gspread.exceptions import WorksheetNotFound
+    try:
+        worksheet = spreadsheet.worksheet(title)
+    except WorksheetNotFound:
+        worksheet = spreadsheet.add_worksheet(title=title, rows=1000, cols=5)
+        worksheet.update('A1:E1', [SHEET_HEADER])
+        logger.info("Created sheet partition: %s", title)
+    db_add_sheet_partition(bot_username, period)
+    bot_sheet_partitions[bot_username] = (period, worksheet)
+
+    for old_period in db_get_open_sheet_partitions(bot_username, before=period):
+        close_sheet_partition(bot_username, old_period)
+
+    return worksheet
+
+
+def close_sheet_partition(bot_username, period):
+    title = get_partition_title(bot_username, period)
+    from gspread.exceptions import WorksheetNotFound
+    try:
+        worksheet = spreadsheet.worksheet(title)
+        used_rows = len(worksheet.col_values(1))
+        if used_rows < worksheet.row_count:
+            worksheet.resize(rows=max(used_rows, 2))
+        worksheet.add_protected_range(
+            f"A1:E{max(used_rows, 2)}",
+            description="Closed period (read-only)",
+        )
+        logger.info("Closed sheet partition: %s", title)
+    except WorksheetNotFound:
+        logger.warning("Sheet partition %s not found, marking closed", title)
+    except Exception as e:
+        logger.error("Failed to close sheet partition %s: %s", title, e)
+        return False
+    db_close_sheet_partition(bot_username, period)
+    refresh_dashboard_bot(bot_username)
+    return True
+
+
+def refresh_dashboard_bot(bot_username):
+    try:
+        total = 0
+        partition = re.compile(rf"^{re.escape(bot_username)}_\d{{4}}-\d{{2}}$")
+        for worksheet in spreadsheet.worksheets():
+            if worksheet.title == bot_username or partition.match(worksheet.title):
+                total += max(len(worksheet.col_values(1)) - 1, 0)
+        return update_dashboard_bot(bot_username, total)
+    except Exception as e:
+        logger.error("Failed to refresh dashboard for %s: %s", bot_username, e)
+        return False
+
+
+def sheets_create_bot_sheet(bot_username):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
-        try:
-            spreadsheet.worksheet(bot_username)
-            logger.info(f"Sheet for {bot_username} already exists")
-            return True
-        except:
-            pass
+        get_bot_worksheet(bot_username)
 
-        worksheet = spreadsheet.add_worksheet(title=bot_username, rows=1000, cols=5)
-        worksheet.update('A1:E1', [['Timestamp', 'Amount', 'Currency', 'Pseudonym', 'Photo URL']])
+        dashboard = spreadsheet.worksheet("Dashboard")
+        if not dashboard.find(bot_username):
+            dashboard.append_row([bot_username, 0])
+
+        logger.info("Sheet for bot ready: %s", bot_username)
+        return True
+    except Exception as e:
+        logger.error("Failed to create bot sheet: %s", e)
+        return False
+
+
+def sheets_create_bot_sheets(bot_usernames):
+    try:
+        if not sheets_available():
+            return False
+
+        existing = {worksheet.title for worksheet in spreadsheet.worksheets()}
+        periods = {u: get_sheet_period(get_bot_token_by_username(u)) for u in bot_usernames}
+        new_titles = [
+            get_partition_title(u, period) for u, period in periods.items()
+            if get_partition_title(u, period) not in existing
+        ]
+        if new_titles:
+            spreadsheet.batch_update({"requests": [
+                {"addSheet": {"properties": {"title": title, "gridProperties": {"rowCount": 1000, "columnCount": 5}}}}
+                for title in new_titles
+            ]})
+            spreadsheet.values_batch_update({
+                "valueInputOption": "RAW",
+                "data": [{"range": f"'{title}'!A1:E1", "values": [SHEET_HEADER]} for title in new_titles],
+            })
+        for bot_username, period in periods.items():
+            db_add_sheet_partition(bot_username, period)
 
-        update_dashboard_bot(bot_username, 0)
+        dashboard = spreadsheet.worksheet("Dashboard")
+        listed = set(dashboard.col_values(1))
+        missing = [[u, 0] for u in bot_usernames if u not in listed]
+        if missing:
+            dashboard.append_rows(missing)
 
-        logger.info(f"Created sheet for bot: {bot_username}")
+        logger.info("Created %s bot sheets in batch", len(new_titles))
         return True
     except Exception as e:
-        logger.error(f"Failed to create bot sheet: {e}")
+        logger.error("Failed to create bot sheets: %s", e)
         return False
 
 
-def add_receipt_to_sheet(bot_username, amount, currency, pseudonym, photo_url=None):
+def sheets_add_receipt(bot_username, amount, currency, pseudonym, photo_url=None, timestamp=None, period=None):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
-        worksheet = spreadsheet.worksheet(bot_username)
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        worksheet = get_bot_worksheet(bot_username, period)
+        if worksheet is None:
+            logger.warning("Sheet partition %s %s is closed, skipping change", bot_username, period)
+            return False
+        timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
         row = [timestamp, str(amount), currency, pseudonym, photo_url or ""]
         worksheet.append_row(row)
 
         update_dashboard_increment(bot_username)
 
-        logger.info(f"Added receipt to {bot_username}: {amount} {currency}")
+        logger.info("Added receipt to %s: %s %s", bot_username, amount, currency)
+        return True
+    except Exception as e:
+        logger.error("Failed to add receipt to sheet: %s", e)
+        return False
+
+
+def sheets_add_receipts(bot_username, rows, period=None):
+    try:
+        if not sheets_available():
+            return False
+
+        worksheet = get_bot_worksheet(bot_username, period)
+        if worksheet is None:
+            logger.warning("Sheet partition %s %s is closed, skipping change", bot_username, period)
+            return False
+        worksheet.append_rows(rows)
+
+        update_dashboard_increment(bot_username, len(rows))
+
+        logger.info("Added %s receipts to %s", len(rows), bot_username)
         return True
     except Exception as e:
-        logger.error(f"Failed to add receipt to sheet: {e}")
+        logger.error("Failed to add receipts to sheet: %s", e)
         return False
 
 
-def remove_receipt_from_sheet(bot_username, amount, pseudonym):
+def sheets_remove_receipt(bot_username, amount, pseudonym, period=None):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
-        worksheet = spreadsheet.worksheet(bot_username)
+        worksheet = get_bot_worksheet(bot_username, period)
+        if worksheet is None:
+            logger.warning("Sheet partition %s %s is closed, skipping change", bot_username, period)
+            return False
         all_rows = worksheet.get_all_values()
 
         for i in range(len(all_rows) - 1, 0, -1):
@@ -243,41 +1055,44 @@ def remove_receipt_from_sheet(bot_username, amount, pseudonym):
             if len(row) >= 4 and row[1] == str(amount) and row[3] == pseudonym:
                 worksheet.delete_rows(i + 1)
                 update_dashboard_decrement(bot_username)
-                logger.info(f"Removed receipt from {bot_username}: {amount} by {pseudonym}")
+                logger.info("Removed receipt from %s: %s by %s", bot_username, amount, pseudonym)
                 return True
 
-        logger.warning(f"Receipt not found in sheet {bot_username}: {amount} by {pseudonym}")
+        logger.warning("Receipt not found in sheet %s: %s by %s", bot_username, amount, pseudonym)
         return False
     except Exception as e:
-        logger.error(f"Failed to remove receipt from sheet: {e}")
+        logger.error("Failed to remove receipt from sheet: %s", e)
         return False
 
 
-def update_receipt_in_sheet(bot_username, old_amount, new_amount, pseudonym):
+def sheets_update_receipt(bot_username, old_amount, new_amount, pseudonym, period=None):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
-        worksheet = spreadsheet.worksheet(bot_username)
+        worksheet = get_bot_worksheet(bot_username, period)
+        if worksheet is None:
+            logger.warning("Sheet partition %s %s is closed, skipping change", bot_username, period)
+            return False
         all_rows = worksheet.get_all_values()
 
         for i in range(len(all_rows) - 1, 0, -1):
             row = all_rows[i]
             if len(row) >= 4 and row[1] == str(old_amount) and row[3] == pseudonym:
                 worksheet.update_cell(i + 1, 2, str(new_amount))
-                logger.info(f"Updated receipt in {bot_username}: {old_amount} -> {new_amount} by {pseudonym}")
+                logger.info("Updated receipt in %s: %s -> %s by %s", bot_username, old_amount, new_amount, pseudonym)
                 return True
 
-        logger.warning(f"Receipt not found for update in {bot_username}: {old_amount} by {pseudonym}")
+        logger.warning("Receipt not found for update in %s: %s by %s", bot_username, old_amount, pseudonym)
         return False
     except Exception as e:
-        logger.error(f"Failed to update receipt in sheet: {e}")
+        logger.error("Failed to update receipt in sheet: %s", e)
         return False
 
 
 def update_dashboard_decrement(bot_username):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
         dashboard = spreadsheet.worksheet("Dashboard")
@@ -290,13 +1105,13 @@ def update_dashboard_decrement(bot_username):
 
         return True
     except Exception as e:
-        logger.error(f"Failed to decrement dashboard: {e}")
+        logger.error("Failed to decrement dashboard: %s", e)
         return False
 
 
 def update_dashboard_bot(bot_username, count):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
         dashboard = spreadsheet.worksheet("Dashboard")
@@ -309,13 +1124,13 @@ def update_dashboard_bot(bot_username, count):
 
         return True
     except Exception as e:
-        logger.error(f"Failed to update dashboard: {e}")
+        logger.error("Failed to update dashboard: %s", e)
         return False
 
 
-def update_dashboard_increment(bot_username):
+def update_dashboard_increment(bot_username, count=1):
     try:
-        if not spreadsheet:
+        if not sheets_available():
             return False
 
         dashboard = spreadsheet.worksheet("Dashboard")
@@ -323,263 +1138,1153 @@ def update_dashboard_increment(bot_username):
 
         if cell:
             current = dashboard.cell(cell.row, 2).value
-            new_count = int(current or 0) + 1
+            new_count = int(current or 0) + count
             dashboard.update_cell(cell.row, 2, new_count)
         else:
-            dashboard.append_row([bot_username, 1])
+            dashboard.append_row([bot_username, count])
 
         return True
     except Exception as e:
-        logger.error(f"Failed to increment dashboard: {e}")
+        logger.error("Failed to increment dashboard: %s", e)
         return False
 
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""CREATE TABLE IF NOT EXISTS bots (
-        token TEXT PRIMARY KEY,
-        username TEXT,
-        admin_user_id INTEGER,
-        geo TEXT DEFAULT 'argentina'
-    )""")
-    try:
-        c.execute("ALTER TABLE bots ADD COLUMN geo TEXT DEFAULT 'argentina'")
-    except sqlite3.OperationalError:
-        pass
-    c.execute("""CREATE TABLE IF NOT EXISTS pseudonyms (
-        bot_token TEXT,
-        user_id INTEGER,
-        pseudonym TEXT,
-        PRIMARY KEY (bot_token, user_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS invite_links_db (
-        code TEXT PRIMARY KEY,
-        bot_token TEXT,
-        expires_at REAL,
-        used INTEGER
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS daily_totals (
-        bot_token TEXT,
-        date TEXT,
-        total REAL DEFAULT 0,
-        PRIMARY KEY (bot_token, date)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS shifts (
-        bot_token TEXT PRIMARY KEY,
-        shift_start INTEGER DEFAULT 0,
-        shift_end INTEGER DEFAULT 23
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS chat_admins (
-        bot_token TEXT,
-        user_id INTEGER,
-        PRIMARY KEY (bot_token, user_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS requisites (
-        bot_token TEXT PRIMARY KEY,
-        text TEXT,
-        photo_id TEXT
-    )""")
-    try:
-        c.execute("ALTER TABLE requisites ADD COLUMN photo_id TEXT")
-    except sqlite3.OperationalError:
-        pass
-    c.execute("""CREATE TABLE IF NOT EXISTS banned_users (
-        bot_token TEXT,
-        user_id INTEGER,
-        PRIMARY KEY (bot_token, user_id)
-    )""")
-    c.execute("""CREATE TABLE IF NOT EXISTS receipt_watchers (
-        bot_token TEXT,
-        user_id INTEGER,
-        PRIMARY KEY (bot_token, user_id)
-    )""")
-    conn.commit()
-    conn.close()
+class SheetsExportBackend:
+    name = "sheets"
 
+    def create_bot(self, bot_username):
+        return sheets_create_bot_sheet(bot_username)
 
-def db_add_bot(token, username, admin_user_id, geo="argentina"):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR REPLACE INTO bots VALUES (?, ?, ?, ?)", (token, username, admin_user_id, geo))
-    conn.commit()
-    conn.close()
+    def create_bots(self, bot_usernames):
+        return sheets_create_bot_sheets(bot_usernames)
 
+    def add_receipt(self, bot_username, amount, currency, pseudonym, photo_url=None, timestamp=None, period=None):
+        return sheets_add_receipt(bot_username, amount, currency, pseudonym, photo_url, timestamp, period)
 
-def db_add_pseudonym(bot_token, user_id, pseudonym):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR REPLACE INTO pseudonyms VALUES (?, ?, ?)", (bot_token, user_id, pseudonym))
-    conn.commit()
-    conn.close()
+    def add_receipts(self, bot_username, rows, period=None):
+        return sheets_add_receipts(bot_username, rows, period)
 
+    def remove_receipt(self, bot_username, amount, pseudonym, period=None):
+        return sheets_remove_receipt(bot_username, amount, pseudonym, period)
 
-def db_remove_pseudonym(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("DELETE FROM pseudonyms WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
-    conn.commit()
-    conn.close()
+    def update_receipt(self, bot_username, old_amount, new_amount, pseudonym, period=None):
+        return sheets_update_receipt(bot_username, old_amount, new_amount, pseudonym, period)
 
+    def flush(self):
+        pass
 
-def db_ban_user(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR IGNORE INTO banned_users VALUES (?, ?)", (bot_token, user_id))
-    conn.commit()
-    conn.close()
+    def close(self):
+        pass
 
 
-def db_unban_user(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("DELETE FROM banned_users WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
-    conn.commit()
-    conn.close()
+class FileExportBackend:
+    name = "csv"
+    columns = ["timestamp", "event", "amount", "old_amount", "currency", "pseudonym", "photo_url"]
+
+    def __init__(self, export_dir, buffer_rows):
+        self.export_dir = export_dir
+        self.buffer_rows = buffer_rows
+        self.buffers = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flush_pending = False
+
+    def get_path(self, bot_username, period):
+        return os.path.join(self.export_dir, bot_username, f"{bot_username}_{period}.csv")
+
+    def append(self, bot_username, event, amount, pseudonym, currency="", photo_url=None,
+               timestamp=None, period=None, old_amount=""):
+        period = period or get_sheet_period(get_bot_token_by_username(bot_username))
+        row = [
+            timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            event, str(amount), str(old_amount), currency or "", pseudonym, photo_url or "",
+        ]
+        with self.lock:
+            self.buffers.setdefault((bot_username, period), []).append(row)
+            self.buffered += 1
+            full = self.buffered >= self.buffer_rows
+        if full:
+            self.request_flush()
+        return True
+
+    def request_flush(self):
+        if not in_event_loop():
+            self.flush()
+            return
+        with self.lock:
+            if self.flush_pending:
+                return
+            self.flush_pending = True
+        start_background_task(asyncio.to_thread(self.flush))
+
+    def create_bot(self, bot_username):
+        os.makedirs(os.path.join(self.export_dir, bot_username), exist_ok=True)
+        return True
+
+    def create_bots(self, bot_usernames):
+        return all([self.create_bot(u) for u in bot_usernames])
+
+    def add_receipt(self, bot_username, amount, currency, pseudonym, photo_url=None, timestamp=None, period=None):
+        return self.append(bot_username, "add", amount, pseudonym, currency, photo_url, timestamp, period)
+
+    def add_receipts(self, bot_username, rows, period=None):
+        for timestamp, amount, currency, pseudonym, photo_url in rows:
+            self.append(bot_username, "add", amount, pseudonym, currency, photo_url, timestamp, period)
+        return True
+
+    def remove_receipt(self, bot_username, amount, pseudonym, period=None):
+        return self.append(bot_username, "remove", amount, pseudonym, period=period)
+
+    def update_receipt(self, bot_username, old_amount, new_amount, pseudonym, period=None):
+        return self.append(bot_username, "update", new_amount, pseudonym, period=period, old_amount=old_amount)
+
+    def write_rows(self, bot_username, period, rows):
+        path = self.get_path(bot_username, period)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path)
+        with open(path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            if is_new:
+                writer.writerow(self.columns)
+            writer.writerows(rows)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                buffers, self.buffers, self.buffered = self.buffers, {}, 0
+                self.flush_pending = False
+            for (bot_username, period), rows in buffers.items():
+                try:
+                    self.write_rows(bot_username, period, rows)
+                except Exception as e:
+                    logger.error("Failed to export %s rows for %s: %s", len(rows), bot_username, e)
+                    with self.lock:
+                        self.buffers.setdefault((bot_username, period), [])[:0] = rows
+                        self.buffered += len(rows)
+
+    def close(self):
+        self.flush()
+
+
+class ParquetExportBackend(FileExportBackend):
+    name = "parquet"
+
+    def __init__(self, export_dir, buffer_rows):
+        pyarrow = lazy_import("pyarrow")
+        lazy_import("pyarrow.parquet")
+        super().__init__(export_dir, buffer_rows)
+        self.pa = pyarrow
+
+    def write_rows(self, bot_username, period, rows):
+        directory = os.path.join(self.export_dir, bot_username, period)
+        os.makedirs(directory, exist_ok=True)
+        table = self.pa.table({name: [row[i] for row in rows] for i, name in enumerate(self.columns)})
+        path = os.path.join(directory, f"{bot_username}_{period}_{time.time_ns()}.parquet")
+        self.pa.parquet.write_table(table, path)
+
+
+def init_export_backend():
+    global export_backend
+    if EXPORT_BACKEND == "parquet":
+        try:
+            export_backend = ParquetExportBackend(EXPORT_DIR, EXPORT_BUFFER_ROWS)
+        except ImportError:
+            logger.error("pyarrow is not installed, falling back to CSV export")
+            export_backend = FileExportBackend(EXPORT_DIR, EXPORT_BUFFER_ROWS)
+    elif EXPORT_BACKEND == "csv":
+        export_backend = FileExportBackend(EXPORT_DIR, EXPORT_BUFFER_ROWS)
+    else:
+        export_backend = SheetsExportBackend()
+    if export_backend.name != "sheets":
+        sheets_ready.set()
+    logger.info("Export backend: %s", export_backend.name)
+    return export_backend
+
+
+async def export_flush_loop():
+    while True:
+        await asyncio.sleep(EXPORT_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(export_backend.flush)
+        except Exception as e:
+            logger.error("Export flush failed: %s", e)
+
+
+export_backend = SheetsExportBackend()
+
+
+def timed_export(op, method, *args):
+    started = time.perf_counter()
+    try:
+        return method(*args)
+    finally:
+        record_export_call(op, time.perf_counter() - started)
+
+
+def create_bot_sheet(bot_username):
+    return timed_export("create_bot", export_backend.create_bot, bot_username)
+
+
+def create_bot_sheets(bot_usernames):
+    return timed_export("create_bots", export_backend.create_bots, bot_usernames)
+
+
+def add_receipt_to_sheet(bot_username, amount, currency, pseudonym, photo_url=None, timestamp=None, period=None):
+    return timed_export(
+        "add_receipt", export_backend.add_receipt, bot_username, amount, currency, pseudonym, photo_url, timestamp, period
+    )
+
+
+def add_receipts_to_sheet(bot_username, rows, period=None):
+    return timed_export("add_receipts", export_backend.add_receipts, bot_username, rows, period)
+
+
+def remove_receipt_from_sheet(bot_username, amount, pseudonym, period=None):
+    return timed_export("remove_receipt", export_backend.remove_receipt, bot_username, amount, pseudonym, period)
+
+
+def update_receipt_in_sheet(bot_username, old_amount, new_amount, pseudonym, period=None):
+    return timed_export(
+        "update_receipt", export_backend.update_receipt, bot_username, old_amount, new_amount, pseudonym, period
+    )
+
+
+def sheet_row_key(amount, pseudonym):
+    try:
+        amount = str(float(amount))
+    except (TypeError, ValueError):
+        amount = str(amount)
+    return amount, pseudonym
+
+
+def iter_sheet_rows(worksheet, chunk_rows=None):
+    chunk_rows = chunk_rows or RECONCILE_CHUNK_ROWS
+    start = 2
+    while start <= worksheet.row_count:
+        end = start + chunk_rows - 1
+        rows = worksheet.get(f"A{start}:E{end}")
+        for offset, row in enumerate(rows):
+            yield start + offset, row
+        start = end + 1
+
+
+def reconcile_bot_sheet(bot_token, bot_username, dry_run=False):
+    report = {
+        "bot": bot_username,
+        "rows_read": 0,
+        "appended": 0,
+        "deleted": 0,
+        "totals_fixed": [],
+        "error": None,
+    }
+    try:
+        report["totals_fixed"] = db_reconcile_daily_totals(bot_token, dry_run=dry_run)
+
+        if not sheets_available():
+            return report
+
+        sheet_period = get_sheet_period(bot_token)
+        ledger_start, expected = db_get_approved_receipt_keys(bot_token, sheet_period)
+        worksheet = get_bot_worksheet(bot_username, sheet_period)
+
+        extra_rows = []
+        seen = Counter()
+        for row_number, row in iter_sheet_rows(worksheet):
+            report["rows_read"] += 1
+            if not any(row):
+                continue
+            if len(row) < 4 or not ledger_start or row[0] < ledger_start:
+                continue
+            key = sheet_row_key(row[1], row[3])
+            seen[key] += 1
+            if expected[key] > 0:
+                expected[key] -= 1
+            else:
+                extra_rows.append((row_number, key))
+
+        missing = db_get_missing_sheet_rows(bot_token, sheet_period, expected)
+        if extra_rows:
+            _, current = db_get_approved_receipt_keys(bot_token, sheet_period)
+            surplus = Counter({key: count - current[key] for key, count in seen.items()})
+            rechecked = []
+            for row_number, key in reversed(extra_rows):
+                if surplus[key] > 0:
+                    surplus[key] -= 1
+                    rechecked.append(row_number)
+            extra_rows = sorted(rechecked)
+        report["appended"] = len(missing)
+        report["deleted"] = len(extra_rows)
+
+        if dry_run or (not missing and not extra_rows):
+            return report
+
+        if extra_rows:
+            spreadsheet.batch_update({"requests": [
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": worksheet.id,
+                            "dimension": "ROWS",
+                            "startIndex": start - 1,
+                            "endIndex": end,
+                        }
+                    }
+                }
+                for start, end in reversed(group_row_ranges(extra_rows))
+            ]})
+        if missing:
+            worksheet.append_rows(missing)
+        refresh_dashboard_bot(bot_username)
+
+        logger.info(
+            "Reconciled sheet %s: +%s -%s rows, %s daily totals fixed",
+            bot_username, len(missing), len(extra_rows), len(report["totals_fixed"])
+        )
+        return report
+    except Exception as e:
+        logger.error("Failed to reconcile sheet %s: %s", bot_username, e)
+        report["error"] = str(e)
+        return report
+
+
+def group_row_ranges(row_numbers):
+    ranges = []
+    for number in sorted(row_numbers):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+
+def reconcile_all_sheets(dry_run=False):
+    reports = []
+    for token, bot_info in list(created_bots.items()):
+        reports.append(reconcile_bot_sheet(token, bot_info["username"], dry_run=dry_run))
+    return reports
+
+
+def format_reconcile_report(reports, dry_run=False):
+    lines = ["🔍 Сверка (без изменений)" if dry_run else "🔍 Сверка завершена", ""]
+    for report in reports:
+        if report["error"]:
+            lines.append(f"@{report['bot']}: ❌ {report['error']}")
+            continue
+        line = (
+            f"@{report['bot']}: строк {report['rows_read']}, "
+            f"+{report['appended']} / -{report['deleted']}"
+        )
+        if report["totals_fixed"]:
+            fixed = ", ".join(
+                f"{date}: {format_amount(old)} → {format_amount(new)}"
+                for date, old, new in report["totals_fixed"]
+            )
+            line += f", итоги: {fixed}"
+        lines.append(line)
+    if not reports:
+        lines.append("Нет ботов")
+    return "\n".join(lines)
+
+
+async def reconcile_loop():
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        try:
+            reports = await asyncio.to_thread(reconcile_all_sheets)
+            changed = [r for r in reports if r["appended"] or r["deleted"] or r["totals_fixed"]]
+            logger.info("Scheduled reconciliation: %s bots checked, %s corrected", len(reports), len(changed))
+        except Exception as e:
+            logger.error("Scheduled reconciliation failed: %s", e)
+
+
+def init_db():
+    conn = db_connect("init_db")
+    c = conn.cursor()
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("""CREATE TABLE IF NOT EXISTS bots (
+        token TEXT PRIMARY KEY,
+        username TEXT,
+        admin_user_id INTEGER,
+        geo TEXT DEFAULT 'argentina',
+        suspended INTEGER DEFAULT 0
+    )""")
+    try:
+        c.execute("ALTER TABLE bots ADD COLUMN geo TEXT DEFAULT 'argentina'")
+    except sqlite3.OperationalError:
+        pass
+    try:
+        c.execute("ALTER TABLE bots ADD COLUMN suspended INTEGER DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
+    c.execute("""CREATE TABLE IF NOT EXISTS pseudonyms (
+        bot_token TEXT,
+        user_id INTEGER,
+        pseudonym TEXT,
+        PRIMARY KEY (bot_token, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS invite_links_db (
+        code TEXT PRIMARY KEY,
+        bot_token TEXT,
+        expires_at REAL,
+        used INTEGER
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS daily_totals (
+        bot_token TEXT,
+        date TEXT,
+        total REAL DEFAULT 0,
+        PRIMARY KEY (bot_token, date)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS shifts (
+        bot_token TEXT PRIMARY KEY,
+        shift_start INTEGER DEFAULT 0,
+        shift_end INTEGER DEFAULT 23
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS chat_admins (
+        bot_token TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (bot_token, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS requisites (
+        bot_token TEXT PRIMARY KEY,
+        text TEXT,
+        photo_id TEXT
+    )""")
+    try:
+        c.execute("ALTER TABLE requisites ADD COLUMN photo_id TEXT")
+    except sqlite3.OperationalError:
+        pass
+    c.execute("""CREATE TABLE IF NOT EXISTS banned_users (
+        bot_token TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (bot_token, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS receipt_watchers (
+        bot_token TEXT,
+        user_id INTEGER,
+        PRIMARY KEY (bot_token, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS receipts_db (
+        receipt_id TEXT PRIMARY KEY,
+        bot_token TEXT,
+        owner_id INTEGER,
+        pseudonym TEXT,
+        amount REAL,
+        currency TEXT,
+        status TEXT,
+        created_at REAL,
+        sheet_ts TEXT,
+        photo_url TEXT,
+        sheet_period TEXT,
+        photo_id TEXT,
+        document_id TEXT,
+        edited_by TEXT,
+        comments TEXT
+    )""")
+    for column in ("sheet_period", "photo_id", "document_id", "edited_by", "comments"):
+        try:
+            c.execute(f"ALTER TABLE receipts_db ADD COLUMN {column} TEXT")
+        except sqlite3.OperationalError:
+            pass
+    c.execute("CREATE INDEX IF NOT EXISTS idx_receipts_db_bot_status ON receipts_db (bot_token, status)")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_receipts_db_bot_created "
+        "ON receipts_db (bot_token, created_at, pseudonym, status, amount)"
+    )
+    c.execute("""CREATE TABLE IF NOT EXISTS receipt_messages (
+        receipt_id TEXT,
+        user_id INTEGER,
+        message_id INTEGER,
+        PRIMARY KEY (receipt_id, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS message_map_db (
+        bot_token TEXT,
+        user_id INTEGER,
+        message_id INTEGER,
+        entry TEXT,
+        created_at REAL,
+        PRIMARY KEY (bot_token, user_id, message_id)
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_message_map_db_bot_created ON message_map_db (bot_token, created_at)")
+    c.execute("""CREATE TABLE IF NOT EXISTS user_states_db (
+        bot_token TEXT,
+        user_id INTEGER,
+        state TEXT,
+        PRIMARY KEY (bot_token, user_id)
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS totals_ledger (
+        receipt_id TEXT,
+        bot_token TEXT,
+        date TEXT,
+        delta REAL,
+        created_at REAL
+    )""")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_totals_ledger_bot_date ON totals_ledger (bot_token, date)")
+    c.execute("""CREATE TABLE IF NOT EXISTS bot_assignments (
+        token TEXT PRIMARY KEY,
+        worker_id INTEGER
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS workers (
+        worker_id INTEGER PRIMARY KEY,
+        pid INTEGER,
+        heartbeat REAL
+    )""")
+    c.execute("""CREATE TABLE IF NOT EXISTS sheet_partitions (
+        bot_username TEXT,
+        period TEXT,
+        closed INTEGER DEFAULT 0,
+        PRIMARY KEY (bot_username, period)
+    )""")
+    conn.commit()
+    conn.close()
+
+
+def db_add_bot(token, username, admin_user_id, geo="argentina"):
+    conn = db_connect("add_bot")
+    conn.execute(
+        "INSERT OR REPLACE INTO bots (token, username, admin_user_id, geo) VALUES (?, ?, ?, ?)",
+        (token, username, admin_user_id, geo)
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_add_bots(rows):
+    conn = db_connect("add_bots")
+    conn.executemany("INSERT OR REPLACE INTO bots (token, username, admin_user_id, geo) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def db_add_pseudonym(bot_token, user_id, pseudonym):
+    conn = db_connect("add_pseudonym")
+    conn.execute("INSERT OR REPLACE INTO pseudonyms VALUES (?, ?, ?)", (bot_token, user_id, pseudonym))
+    conn.commit()
+    conn.close()
+
+
+def db_remove_pseudonym(bot_token, user_id):
+    conn = db_connect("remove_pseudonym")
+    conn.execute("DELETE FROM pseudonyms WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
+    conn.commit()
+    conn.close()
+
+
+def db_ban_user(bot_token, user_id):
+    conn = db_connect("ban_user")
+    conn.execute("INSERT OR IGNORE INTO banned_users VALUES (?, ?)", (bot_token, user_id))
+    conn.commit()
+    conn.close()
+
+
+def db_unban_user(bot_token, user_id):
+    conn = db_connect("unban_user")
+    conn.execute("DELETE FROM banned_users WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
+    conn.commit()
+    conn.close()
 
 
 def db_add_receipt_watcher(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("add_receipt_watcher")
     conn.execute("INSERT OR IGNORE INTO receipt_watchers VALUES (?, ?)", (bot_token, user_id))
     conn.commit()
     conn.close()
 
 
 def db_remove_receipt_watcher(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("remove_receipt_watcher")
     conn.execute("DELETE FROM receipt_watchers WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
     conn.commit()
     conn.close()
 
 
 def db_update_pseudonym(bot_token, user_id, pseudonym):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("update_pseudonym")
     conn.execute("UPDATE pseudonyms SET pseudonym = ? WHERE bot_token = ? AND user_id = ?", (pseudonym, bot_token, user_id))
     conn.commit()
     conn.close()
 
 
 def db_add_invite(code, bot_token, expires_at, used):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("add_invite")
     conn.execute("INSERT OR REPLACE INTO invite_links_db VALUES (?, ?, ?, ?)", (code, bot_token, expires_at, int(used)))
     conn.commit()
     conn.close()
 
 
 def db_mark_invite_used(code):
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("mark_invite_used")
     conn.execute("UPDATE invite_links_db SET used = 1 WHERE code = ?", (code,))
     conn.commit()
     conn.close()
 
 
-def db_add_daily_total(bot_token, amount):
+def db_add_daily_total(bot_token, amount, receipt_id=None):
     date = get_working_day_date(bot_token)
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("add_daily_total")
     conn.execute(
         "INSERT INTO daily_totals (bot_token, date, total) VALUES (?, ?, ?) "
         "ON CONFLICT(bot_token, date) DO UPDATE SET total = total + ?",
         (bot_token, date, amount, amount)
     )
+    conn.execute(
+        "INSERT INTO totals_ledger VALUES (?, ?, ?, ?, ?)",
+        (receipt_id, bot_token, date, amount, time.time())
+    )
     conn.commit()
     conn.close()
 
 
-def db_subtract_daily_total(bot_token, amount):
+def db_subtract_daily_total(bot_token, amount, receipt_id=None):
     date = get_working_day_date(bot_token)
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute(
+    conn = db_connect("subtract_daily_total")
+    cur = conn.execute(
         "UPDATE daily_totals SET total = total - ? WHERE bot_token = ? AND date = ?",
         (amount, bot_token, date)
     )
+    if cur.rowcount:
+        conn.execute(
+            "INSERT INTO totals_ledger VALUES (?, ?, ?, ?, ?)",
+            (receipt_id, bot_token, date, -amount, time.time())
+        )
     conn.commit()
     conn.close()
 
 
 def db_get_daily_total(bot_token):
     date = get_working_day_date(bot_token)
-    conn = sqlite3.connect(DB_PATH)
+    conn = db_connect("get_daily_total")
     c = conn.cursor()
     row = c.execute("SELECT total FROM daily_totals WHERE bot_token = ? AND date = ?", (bot_token, date)).fetchone()
     conn.close()
     return row[0] if row else 0.0
 
 
-def db_add_chat_admin(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR IGNORE INTO chat_admins VALUES (?, ?)", (bot_token, user_id))
+def db_add_receipt(receipt_id, receipt_data):
+    conn = db_connect("add_receipt")
+    conn.execute(
+        "INSERT OR REPLACE INTO receipts_db (receipt_id, bot_token, owner_id, pseudonym, amount, currency, "
+        "status, created_at, photo_id, document_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            receipt_id, receipt_data["bot_token"], receipt_data.get("owner_id"),
+            receipt_data["pseudonym"], receipt_data.get("amount"), receipt_data.get("currency"),
+            receipt_data.get("status", "pending"), receipt_data.get("created_ts") or time.time(),
+            receipt_data.get("photo_id"), receipt_data.get("document_id")
+        )
+    )
     conn.commit()
     conn.close()
 
 
-def db_remove_chat_admin(bot_token, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("DELETE FROM chat_admins WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
+def db_update_receipt_status(receipt_id, status, sheet_ts=None, photo_url=None, sheet_period=None):
+    conn = db_connect("update_receipt_status")
+    if status == "approved":
+        conn.execute(
+            "UPDATE receipts_db SET status = ?, sheet_ts = ?, photo_url = ?, sheet_period = ? WHERE receipt_id = ?",
+            (status, sheet_ts, photo_url, sheet_period, receipt_id)
+        )
+    else:
+        conn.execute("UPDATE receipts_db SET status = ? WHERE receipt_id = ?", (status, receipt_id))
     conn.commit()
     conn.close()
 
 
-def db_save_requisites(bot_token, text, photo_id=None):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR REPLACE INTO requisites VALUES (?, ?, ?)", (bot_token, text, photo_id))
+def db_apply_receipt_decisions(bot_token, status, updates, ledger):
+    date = get_working_day_date(bot_token)
+    conn = db_connect("apply_receipt_decisions")
+    if status == "approved":
+        conn.executemany(
+            "UPDATE receipts_db SET status = ?, sheet_ts = ?, photo_url = ?, sheet_period = ? WHERE receipt_id = ?",
+            [(status, sheet_ts, photo_url, sheet_period, receipt_id)
+             for receipt_id, sheet_ts, photo_url, sheet_period in updates]
+        )
+    else:
+        conn.executemany(
+            "UPDATE receipts_db SET status = ? WHERE receipt_id = ?",
+            [(status, receipt_id) for receipt_id, *_ in updates]
+        )
+    if ledger:
+        total = sum(amount for _, amount in ledger)
+        conn.execute(
+            "INSERT INTO daily_totals (bot_token, date, total) VALUES (?, ?, ?) "
+            "ON CONFLICT(bot_token, date) DO UPDATE SET total = total + ?",
+            (bot_token, date, total, total)
+        )
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO totals_ledger VALUES (?, ?, ?, ?, ?)",
+            [(receipt_id, bot_token, date, amount, now) for receipt_id, amount in ledger]
+        )
     conn.commit()
     conn.close()
 
 
-def db_save_shift(bot_token, shift_start, shift_end):
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("INSERT OR REPLACE INTO shifts VALUES (?, ?, ?)", (bot_token, shift_start, shift_end))
+def db_update_receipt_amount(receipt_id, amount, edited_by=None):
+    conn = db_connect("update_receipt_amount")
+    conn.execute("UPDATE receipts_db SET amount = ?, edited_by = ? WHERE receipt_id = ?", (amount, edited_by, receipt_id))
     conn.commit()
     conn.close()
 
 
-def db_load_all():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+def db_update_receipt_comments(receipt_id, comments):
+    conn = db_connect("update_receipt_comments")
+    conn.execute(
+        "UPDATE receipts_db SET comments = ? WHERE receipt_id = ?",
+        (json.dumps(comments, ensure_ascii=False), receipt_id)
+    )
+    conn.commit()
+    conn.close()
 
-    bots_list = c.execute("SELECT token, username, admin_user_id, COALESCE(geo, 'argentina') FROM bots").fetchall()
 
-    pseudonyms_list = c.execute("SELECT bot_token, user_id, pseudonym FROM pseudonyms").fetchall()
-    for bot_token, user_id, pseudonym in pseudonyms_list:
-        if bot_token not in user_pseudonyms:
-            user_pseudonyms[bot_token] = {}
-        user_pseudonyms[bot_token][user_id] = pseudonym
+def queue_state_write(writes):
+    if state_writer is None:
+        db_apply_state_writes(writes)
+    else:
+        state_writes.put(writes)
 
-    invites_list = c.execute("SELECT code, bot_token, expires_at, used FROM invite_links_db").fetchall()
-    for code, bot_token, expires_at, used in invites_list:
-        invite_links[code] = {
-            "bot_token": bot_token,
-            "expires_at": expires_at,
-            "used": bool(used)
-        }
 
-    shifts_list = c.execute("SELECT bot_token, shift_start, shift_end FROM shifts").fetchall()
-    for bot_token, shift_start, shift_end in shifts_list:
-        bot_shifts[bot_token] = {"start": shift_start, "end": shift_end}
+def db_apply_state_writes(writes):
+    conn = db_connect("state_writes")
+    for sql, rows in writes:
+        conn.executemany(sql, rows)
+    conn.commit()
+    conn.close()
 
-    admins_list = c.execute("SELECT bot_token, user_id FROM chat_admins").fetchall()
-    for bot_token, user_id in admins_list:
-        if bot_token not in bot_chat_admins:
-            bot_chat_admins[bot_token] = set()
-        bot_chat_admins[bot_token].add(user_id)
 
-    reqs_list = c.execute("SELECT bot_token, text, photo_id FROM requisites").fetchall()
-    for bot_token, text, photo_id in reqs_list:
-        bot_requisites[bot_token] = {"text": text, "photo_id": photo_id}
+def state_writer_loop():
+    while True:
+        batch = [state_writes.get()]
+        while True:
+            try:
+                batch.append(state_writes.get_nowait())
+            except queue.Empty:
+                break
+        writes = [write for item in batch if item is not None for write in item]
+        if writes:
+            try:
+                db_apply_state_writes(writes)
+            except Exception as e:
+                logger.error("State write failed: %s", e)
+        if None in batch:
+            return
 
-    banned_list = c.execute("SELECT bot_token, user_id FROM banned_users").fetchall()
-    for bot_token, user_id in banned_list:
-        if bot_token not in banned_users:
-            banned_users[bot_token] = set()
-        banned_users[bot_token].add(user_id)
 
-    watchers_list = c.execute("SELECT bot_token, user_id FROM receipt_watchers").fetchall()
-    for bot_token, user_id in watchers_list:
-        if bot_token not in receipt_watchers:
-            receipt_watchers[bot_token] = set()
-        receipt_watchers[bot_token].add(user_id)
+def start_state_writer():
+    global state_writer
+    if state_writer:
+        return
+    state_writer = threading.Thread(target=state_writer_loop, name="state-writer", daemon=True)
+    state_writer.start()
 
-    conn.close()
-    return bots_list
 
+def stop_state_writer():
+    global state_writer
+    if state_writer:
+        thread, state_writer = state_writer, None
+        state_writes.put(None)
+        thread.join()
 
-def setup_secret_bot_handlers(app):
-    app.add_handler(CommandHandler("start", secret_chat_start))
+
+def db_save_message_map(bot_token, entries, receipt_messages=()):
+    now = time.time()
+    queue_state_write([
+        (
+            "INSERT OR REPLACE INTO message_map_db VALUES (?, ?, ?, ?, ?)",
+            [(bot_token, uid, msg_id, json.dumps(entry, ensure_ascii=False), now) for (uid, msg_id), entry in entries]
+        ),
+        ("INSERT OR REPLACE INTO receipt_messages VALUES (?, ?, ?)", list(receipt_messages)),
+    ])
+
+
+def db_save_user_state(bot_token, user_id, state):
+    if state is None:
+        queue_state_write([("DELETE FROM user_states_db WHERE bot_token = ? AND user_id = ?", [(bot_token, user_id)])])
+    else:
+        queue_state_write([(
+            "INSERT OR REPLACE INTO user_states_db VALUES (?, ?, ?)",
+            [(bot_token, user_id, json.dumps(state, ensure_ascii=False))]
+        )])
+
+
+RECEIPT_TOTALS_COLUMNS = (
+    "COUNT(*), "
+    "SUM(status = 'approved'), TOTAL(CASE WHEN status = 'approved' THEN amount END), "
+    "SUM(status = 'pending'), TOTAL(CASE WHEN status = 'pending' THEN amount END), "
+    "SUM(status = 'declined'), TOTAL(CASE WHEN status = 'declined' THEN amount END)"
+)
+
+
+def db_get_receipt_totals(bot_token, start_ts, end_ts, offset=0, limit=20):
+    conn = db_connect("get_receipt_totals")
+    c = conn.cursor()
+    totals = c.execute(
+        f"SELECT {RECEIPT_TOTALS_COLUMNS}, COUNT(DISTINCT pseudonym) FROM receipts_db "
+        "WHERE bot_token = ? AND created_at >= ? AND created_at < ?",
+        (bot_token, start_ts, end_ts)
+    ).fetchone()
+    members = c.execute(
+        f"SELECT pseudonym, {RECEIPT_TOTALS_COLUMNS} FROM receipts_db "
+        "WHERE bot_token = ? AND created_at >= ? AND created_at < ? "
+        "GROUP BY pseudonym ORDER BY 4 DESC, 2 DESC, pseudonym LIMIT ? OFFSET ?",
+        (bot_token, start_ts, end_ts, limit, offset)
+    ).fetchall()
+    conn.close()
+    return totals, members
+
+
+def db_get_approved_receipt_keys(bot_token, sheet_period):
+    conn = db_connect("get_approved_receipt_keys")
+    c = conn.cursor()
+    row = c.execute("SELECT MIN(created_at) FROM receipts_db WHERE bot_token = ?", (bot_token,)).fetchone()
+    ledger_start = None
+    if row and row[0] is not None:
+        ledger_start = datetime.fromtimestamp(row[0]).strftime("%Y-%m-%d %H:%M:%S")
+    expected = Counter()
+    for amount, pseudonym, count in c.execute(
+        "SELECT amount, pseudonym, COUNT(*) FROM receipts_db "
+        "WHERE bot_token = ? AND status = 'approved' AND sheet_period = ? GROUP BY amount, pseudonym",
+        (bot_token, sheet_period)
+    ):
+        expected[sheet_row_key(amount, pseudonym)] = count
+    conn.close()
+    return ledger_start, expected
+
+
+def db_get_missing_sheet_rows(bot_token, sheet_period, remaining):
+    rows = []
+    conn = db_connect("get_missing_sheet_rows")
+    c = conn.cursor()
+    for (amount, pseudonym), count in remaining.items():
+        if count <= 0:
+            continue
+        for sheet_ts, currency, photo_url in c.execute(
+            "SELECT sheet_ts, currency, photo_url FROM receipts_db "
+            "WHERE bot_token = ? AND status = 'approved' AND sheet_period = ? AND amount = ? AND pseudonym = ? "
+            "ORDER BY created_at DESC LIMIT ?",
+            (bot_token, sheet_period, float(amount), pseudonym, count)
+        ):
+            rows.append([sheet_ts or "", amount, currency or get_bot_currency(bot_token), pseudonym, photo_url or ""])
+    conn.close()
+    rows.sort(key=lambda r: r[0])
+    return rows
+
+
+def db_reconcile_daily_totals(bot_token, dry_run=False):
+    conn = db_connect("reconcile_daily_totals")
+    c = conn.cursor()
+    first, ledger_started = c.execute(
+        "SELECT MIN(date), MIN(created_at) FROM totals_ledger WHERE bot_token = ?", (bot_token,)
+    ).fetchone()
+    if first is None:
+        conn.close()
+        return []
+    pre_ledger = c.execute(
+        "SELECT 1 FROM receipts_db WHERE bot_token = ? AND status = 'approved' AND created_at < ? LIMIT 1",
+        (bot_token, ledger_started)
+    ).fetchone()
+    rows = c.execute(
+        "SELECT l.date, SUM(l.delta), COALESCE(d.total, 0) FROM totals_ledger l "
+        "LEFT JOIN daily_totals d ON d.bot_token = l.bot_token AND d.date = l.date "
+        f"WHERE l.bot_token = ? AND l.date {'>' if pre_ledger else '>='} ? GROUP BY l.date",
+        (bot_token, first)
+    ).fetchall()
+    fixed = [(date, actual, expected) for date, expected, actual in rows if abs(expected - actual) > 0.005]
+    if fixed and not dry_run:
+        conn.executemany(
+            "INSERT INTO daily_totals (bot_token, date, total) VALUES (?, ?, ?) "
+            "ON CONFLICT(bot_token, date) DO UPDATE SET total = excluded.total",
+            [(bot_token, date, expected) for date, _, expected in fixed]
+        )
+        conn.commit()
+    conn.close()
+    return fixed
+
+
+def db_add_sheet_partition(bot_username, period):
+    conn = db_connect("add_sheet_partition")
+    conn.execute("INSERT OR IGNORE INTO sheet_partitions VALUES (?, ?, 0)", (bot_username, period))
+    conn.commit()
+    conn.close()
+
+
+def db_close_sheet_partition(bot_username, period):
+    conn = db_connect("close_sheet_partition")
+    conn.execute(
+        "INSERT INTO sheet_partitions VALUES (?, ?, 1) "
+        "ON CONFLICT(bot_username, period) DO UPDATE SET closed = 1",
+        (bot_username, period)
+    )
+    conn.commit()
+    conn.close()
+
+
+def db_is_sheet_partition_closed(bot_username, period):
+    conn = db_connect("is_sheet_partition_closed")
+    row = conn.execute(
+        "SELECT closed FROM sheet_partitions WHERE bot_username = ? AND period = ?",
+        (bot_username, period)
+    ).fetchone()
+    conn.close()
+    return bool(row and row[0])
+
+
+def db_get_open_sheet_partitions(bot_username, before):
+    conn = db_connect("get_open_sheet_partitions")
+    rows = conn.execute(
+        "SELECT period FROM sheet_partitions WHERE bot_username = ? AND closed = 0 AND period < ?",
+        (bot_username, before)
+    ).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def db_add_chat_admin(bot_token, user_id):
+    conn = db_connect("add_chat_admin")
+    conn.execute("INSERT OR IGNORE INTO chat_admins VALUES (?, ?)", (bot_token, user_id))
+    conn.commit()
+    conn.close()
+
+
+def db_remove_chat_admin(bot_token, user_id):
+    conn = db_connect("remove_chat_admin")
+    conn.execute("DELETE FROM chat_admins WHERE bot_token = ? AND user_id = ?", (bot_token, user_id))
+    conn.commit()
+    conn.close()
+
+
+def db_save_requisites(bot_token, text, photo_id=None):
+    conn = db_connect("save_requisites")
+    conn.execute("INSERT OR REPLACE INTO requisites VALUES (?, ?, ?)", (bot_token, text, photo_id))
+    conn.commit()
+    conn.close()
+
+
+def db_save_shift(bot_token, shift_start, shift_end):
+    conn = db_connect("save_shift")
+    conn.execute("INSERT OR REPLACE INTO shifts VALUES (?, ?, ?)", (bot_token, shift_start, shift_end))
+    conn.commit()
+    conn.close()
+
+
+def db_get_bots(include_suspended=False):
+    conn = db_connect("get_bots")
+    rows = conn.execute(
+        "SELECT token, username, admin_user_id, COALESCE(geo, 'argentina') FROM bots"
+        + ("" if include_suspended else " WHERE COALESCE(suspended, 0) = 0")
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def db_find_bot(name):
+    conn = db_connect("find_bot")
+    row = conn.execute(
+        "SELECT token, username, admin_user_id, COALESCE(geo, 'argentina'), COALESCE(suspended, 0) FROM bots "
+        "WHERE token = ? OR lower(username) = ?",
+        (name, name.lstrip("@").lower())
+    ).fetchone()
+    conn.close()
+    return row
+
+
+def db_get_suspended_bots():
+    conn = db_connect("get_suspended_bots")
+    rows = conn.execute("SELECT username FROM bots WHERE suspended = 1 ORDER BY username").fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+
+def db_set_bot_suspended(token, suspended):
+    conn = db_connect("set_bot_suspended")
+    conn.execute("UPDATE bots SET suspended = ? WHERE token = ?", (int(suspended), token))
+    conn.commit()
+    conn.close()
+
+
+def db_delete_bot(token):
+    conn = db_connect("delete_bot")
+    conn.execute("DELETE FROM bots WHERE token = ?", (token,))
+    for table in ("pseudonyms", "invite_links_db", "shifts", "chat_admins", "requisites",
+                  "banned_users", "receipt_watchers"):
+        conn.execute(f"DELETE FROM {table} WHERE bot_token = ?", (token,))
+    conn.execute("DELETE FROM bot_assignments WHERE token = ?", (token,))
+    conn.commit()
+    conn.close()
+
+
+def db_set_assignments(assignments):
+    conn = db_connect("set_assignments")
+    conn.execute("DELETE FROM bot_assignments")
+    conn.executemany("INSERT INTO bot_assignments VALUES (?, ?)", list(assignments.items()))
+    conn.commit()
+    conn.close()
+
+
+def db_get_assigned_bots(worker_id):
+    conn = db_connect("get_assigned_bots")
+    rows = conn.execute(
+        "SELECT b.token, b.username, b.admin_user_id, COALESCE(b.geo, 'argentina') FROM bots b "
+        "JOIN bot_assignments a ON a.token = b.token WHERE a.worker_id = ? AND COALESCE(b.suspended, 0) = 0",
+        (worker_id,)
+    ).fetchall()
+    conn.close()
+    return rows
+
+
+def db_worker_heartbeat(worker_id):
+    conn = db_connect("worker_heartbeat")
+    conn.execute("INSERT OR REPLACE INTO workers VALUES (?, ?, ?)", (worker_id, os.getpid(), time.time()))
+    conn.commit()
+    conn.close()
+
+
+def db_get_pseudonyms(bot_token):
+    conn = db_connect("get_pseudonyms")
+    rows = conn.execute("SELECT user_id, pseudonym FROM pseudonyms WHERE bot_token = ?", (bot_token,)).fetchall()
+    conn.close()
+    return dict(rows)
+
+
+def get_bot_members(bot_token):
+    if BOT_WORKERS and WORKER_ID is None:
+        return db_get_pseudonyms(bot_token)
+    return user_pseudonyms.get(bot_token, {})
+
+
+def db_remove_worker(worker_id):
+    conn = db_connect("remove_worker")
+    conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+    conn.commit()
+    conn.close()
+
+
+def db_get_live_workers(timeout):
+    conn = db_connect("get_live_workers")
+    rows = conn.execute("SELECT worker_id FROM workers WHERE heartbeat >= ?", (time.time() - timeout,)).fetchall()
+    conn.close()
+    return sorted(row[0] for row in rows)
+
+
+def db_checkpoint():
+    conn = db_connect("checkpoint")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def db_load_all(token=None):
+    conn = db_connect("load_all")
+    c = conn.cursor()
+    if token:
+        where, params = " WHERE bot_token = ?", (token,)
+    else:
+        where, params = " WHERE bot_token NOT IN (SELECT token FROM bots WHERE suspended = 1)", ()
+
+    bots_list = c.execute(
+        "SELECT token, username, admin_user_id, COALESCE(geo, 'argentina') FROM bots"
+        + (" WHERE token = ?" if token else " WHERE COALESCE(suspended, 0) = 0"), params
+    ).fetchall()
+
+    pseudonyms_list = c.execute("SELECT bot_token, user_id, pseudonym FROM pseudonyms" + where, params).fetchall()
+    for bot_token, user_id, pseudonym in pseudonyms_list:
+        if bot_token not in user_pseudonyms:
+            user_pseudonyms[bot_token] = {}
+        user_pseudonyms[bot_token][user_id] = pseudonym
+
+    invites_list = c.execute("SELECT code, bot_token, expires_at, used FROM invite_links_db" + where, params).fetchall()
+    for code, bot_token, expires_at, used in invites_list:
+        invite_links[code] = {
+            "bot_token": bot_token,
+            "expires_at": expires_at,
+            "used": bool(used)
+        }
+
+    shifts_list = c.execute("SELECT bot_token, shift_start, shift_end FROM shifts" + where, params).fetchall()
+    for bot_token, shift_start, shift_end in shifts_list:
+        bot_shifts[bot_token] = {"start": shift_start, "end": shift_end}
+
+    admins_list = c.execute("SELECT bot_token, user_id FROM chat_admins" + where, params).fetchall()
+    for bot_token, user_id in admins_list:
+        if bot_token not in bot_chat_admins:
+            bot_chat_admins[bot_token] = set()
+        bot_chat_admins[bot_token].add(user_id)
+
+    reqs_list = c.execute("SELECT bot_token, text, photo_id FROM requisites" + where, params).fetchall()
+    for bot_token, text, photo_id in reqs_list:
+        bot_requisites[bot_token] = {"text": text, "photo_id": photo_id}
+
+    banned_list = c.execute("SELECT bot_token, user_id FROM banned_users" + where, params).fetchall()
+    for bot_token, user_id in banned_list:
+        if bot_token not in banned_users:
+            banned_users[bot_token] = set()
+        banned_users[bot_token].add(user_id)
+
+    watchers_list = c.execute("SELECT bot_token, user_id FROM receipt_watchers" + where, params).fetchall()
+    for bot_token, user_id in watchers_list:
+        if bot_token not in receipt_watchers:
+            receipt_watchers[bot_token] = set()
+        receipt_watchers[bot_token].add(user_id)
+
+    cutoff = time.time() - STATE_RESTORE_DAYS * 86400
+    recent = " AND (status = 'pending' OR created_at >= ?)"
+    receipts_list = c.execute(
+        "SELECT receipt_id, bot_token, owner_id, pseudonym, amount, currency, status, created_at, sheet_period, "
+        "photo_id, document_id, edited_by, comments FROM receipts_db" + where + recent, params + (cutoff,)
+    ).fetchall()
+    for (receipt_id, bot_token, owner_id, pseudonym, amount, currency, status, created_at, sheet_period,
+         photo_id, document_id, edited_by, comments) in receipts_list:
+        receipt_data = {
+            "text": f"{format_amount(amount)} {currency}",
+            "status": status,
+            "pseudonym": pseudonym,
+            "bot_token": bot_token,
+            "amount": amount,
+            "currency": currency,
+            "owner_id": owner_id,
+            "created_at": datetime.fromtimestamp(created_at, MOSCOW_TZ).strftime("%H:%M"),
+            "created_ts": created_at,
+        }
+        for key, value in (("sheet_period", sheet_period), ("photo_id", photo_id),
+                           ("document_id", document_id), ("edited_by", edited_by)):
+            if value is not None:
+                receipt_data[key] = value
+        if comments:
+            receipt_data["comments"] = json.loads(comments)
+        receipts[receipt_id] = receipt_data
+        index_receipt(receipt_id, receipt_data)
+
+    messages_list = c.execute(
+        "SELECT receipt_id, user_id, message_id FROM receipt_messages WHERE receipt_id IN "
+        "(SELECT receipt_id FROM receipts_db" + where + recent + ")", params + (cutoff,)
+    ).fetchall()
+    for receipt_id, user_id, message_id in messages_list:
+        if receipt_id in receipts:
+            receipts[receipt_id].setdefault("message_ids", {})[user_id] = message_id
+
+    map_list = c.execute(
+        "SELECT bot_token, user_id, message_id, entry FROM message_map_db" + where + " AND created_at >= ?",
+        params + (cutoff,)
+    ).fetchall()
+    for bot_token, user_id, message_id, entry in map_list:
+        entry = json.loads(entry)
+        if "sent_to" in entry:
+            entry["sent_to"] = {int(uid): msg_id for uid, msg_id in entry["sent_to"].items()}
+        message_map.setdefault(bot_token, {})[(user_id, message_id)] = entry
+
+    states_list = c.execute("SELECT bot_token, user_id, state FROM user_states_db" + where, params).fetchall()
+    for bot_token, user_id, state in states_list:
+        user_states[f"{bot_token}_{user_id}"] = json.loads(state)
+
+    conn.close()
+    return bots_list
+
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metric_inc("bot_updates_total", (("bot", context.bot.username),))
+
+
+def setup_secret_bot_handlers(app):
+    app.add_handler(TypeHandler(Update, count_update), group=-1)
+    app.add_handler(CommandHandler("start", secret_chat_start))
     app.add_handler(CommandHandler("invite", invite_command))
     app.add_handler(CommandHandler("change_name", change_name_command))
     app.add_handler(CommandHandler("setshift", setshift_command))
@@ -587,37 +2292,816 @@ def setup_secret_bot_handlers(app):
     app.add_handler(CommandHandler("deop", deop_command))
     app.add_handler(CommandHandler("kick", kick_command))
     app.add_handler(CommandHandler("chrq", chrq_command))
+    app.add_handler(CommandHandler("report", report_command))
     app.add_handler(MessageHandler(filters.PHOTO, secret_chat_photo))
     app.add_handler(CallbackQueryHandler(debug_callback_handler), group=0)
+    app.add_handler(CallbackQueryHandler(report_callback, pattern="^report_"), group=1)
+    app.add_handler(CallbackQueryHandler(bulk_callback, pattern="^bulk_"), group=1)
     app.add_handler(CallbackQueryHandler(receipt_callback), group=1)
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, secret_chat_message))
     app.add_handler(MessageHandler(filters.VIDEO | filters.VIDEO_NOTE | filters.VOICE | filters.AUDIO | filters.Document.ALL, secret_chat_media))
+    instrument_handlers(app)
+
+
+class TracingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request):
+        stats = self.stats
+        started = time.perf_counter()
+        marks = {}
+
+        async def trace(name, info):
+            if name == "connection.connect_tcp.started":
+                marks.setdefault("acquired", time.perf_counter())
+                marks["new"] = True
+            elif name.endswith("send_request_headers.started"):
+                marks.setdefault("acquired", time.perf_counter())
+
+        request.extensions = {**request.extensions, "trace": trace}
+        stats["in_flight"] += 1
+        try:
+            return await super().handle_async_request(request)
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            stats["in_flight"] -= 1
+            stats["requests"] += 1
+            if marks.get("new"):
+                stats["new_connections"] += 1
+            elif "acquired" in marks:
+                stats["reused_connections"] += 1
+            wait = marks.get("acquired", started) - started
+            if wait > 0.005:
+                stats["pool_waits"] += 1
+                stats["pool_wait_seconds"] += wait
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    def __init__(self, name, connection_pool_size, **kwargs):
+        self.name = name
+        self.pool_size = connection_pool_size
+        self.stats = {
+            "requests": 0, "in_flight": 0, "errors": 0,
+            "new_connections": 0, "reused_connections": 0,
+            "pool_waits": 0, "pool_wait_seconds": 0.0,
+        }
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self):
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        transport = TracingTransport(
+            self.stats,
+            limits=limits,
+            http1=self._client_kwargs["http1"],
+            http2=self._client_kwargs["http2"],
+        )
+        return httpx.AsyncClient(**{**self._client_kwargs, "limits": limits, "transport": transport})
+
+    async def shutdown(self):
+        pass
+
+    async def close(self):
+        await super().shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        started = time.perf_counter()
+        result = "error"
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+            result = "ok" if code == 200 else str(code)
+            return code, payload
+        except Exception as e:
+            result = type(e).__name__
+            raise
+        finally:
+            record_api_call(url.rsplit("/", 1)[-1], time.perf_counter() - started, result)
+
+
+async def close_shared_requests():
+    for request in list(shared_requests.values()):
+        try:
+            await request.close()
+        except Exception as e:
+            logger.warning("Failed to close HTTP pool %s: %s", request.name, e)
+
+
+def get_shared_request(name):
+    if name not in shared_requests:
+        shared_requests[name] = SharedHTTPXRequest(
+            name,
+            connection_pool_size=HTTP_UPDATES_POOL_SIZE if name == "updates" else HTTP_POOL_SIZE,
+            connect_timeout=HTTP_CONNECT_TIMEOUT,
+            read_timeout=HTTP_READ_TIMEOUT,
+            write_timeout=HTTP_WRITE_TIMEOUT,
+            pool_timeout=HTTP_POOL_TIMEOUT,
+        )
+    return shared_requests[name]
+
+
+def new_application_builder(token):
+    return (
+        Application.builder()
+        .token(token)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .request(get_shared_request("api"))
+        .get_updates_request(get_shared_request("updates"))
+    )
+
+
+def format_http_stats():
+    lines = ["🌐 HTTP пулы", ""]
+    for name, request in shared_requests.items():
+        stats = request.stats
+        connections = stats["new_connections"] + stats["reused_connections"]
+        reuse = stats["reused_connections"] / connections * 100 if connections else 0.0
+        avg_wait = stats["pool_wait_seconds"] / stats["pool_waits"] * 1000 if stats["pool_waits"] else 0.0
+        lines.append(
+            f"{name}: размер {request.pool_size}, ботов {len(created_bots)}, запросов {stats['requests']}, "
+            f"в работе {stats['in_flight']}, ошибок {stats['errors']}\n"
+            f"  новых соединений {stats['new_connections']}, повторно {stats['reused_connections']} ({reuse:.1f}%)\n"
+            f"  ожиданий пула {stats['pool_waits']} (в среднем {avg_wait:.1f} мс)"
+        )
+    if not shared_requests:
+        lines.append("Нет активных пулов")
+    return "\n".join(lines)
+
+
+def summarize_receipt_traces(traces):
+    durations = {}
+    for trace in traces:
+        spans = trace["spans"]
+        for span in spans:
+            durations.setdefault(span["name"], []).append(span["ms"])
+        upload = next((span for span in spans if span["name"] == "upload"), None)
+        decision = next((span for span in spans if span["name"] in ("approve", "decline")), None)
+        if upload and decision:
+            durations.setdefault("upload→decision", []).append(
+                (decision["start"] + decision["ms"] / 1000 - upload["start"]) * 1000
+            )
+    summary = {}
+    for name, values in durations.items():
+        values.sort()
+        count = len(values)
+        summary[name] = {
+            "count": count,
+            "p50_ms": values[count // 2],
+            "p95_ms": values[min(int(count * 0.95), count - 1)],
+            "p99_ms": values[min(int(count * 0.99), count - 1)],
+            "max_ms": values[-1],
+        }
+    return summary
+
+
+async def fetch_worker_states():
+    if not BOT_WORKERS or not METRICS_PORT:
+        return [], 0
+    host = "127.0.0.1" if METRICS_LISTEN in ("", "0.0.0.0", "::") else METRICS_LISTEN
+    worker_ids = db_get_live_workers(WORKER_TIMEOUT)
+
+    async def fetch(client, worker_id):
+        try:
+            response = await client.get(f"http://{host}:{METRICS_PORT + 1 + worker_id}/state")
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            logger.error("Failed to fetch state from worker %s: %s", worker_id, e)
+            return None
+
+    async with httpx.AsyncClient(timeout=WORKER_STATE_TIMEOUT) as client:
+        states = await asyncio.gather(*(fetch(client, worker_id) for worker_id in worker_ids))
+    return [state for state in states if state is not None], len(worker_ids)
+
+
+def format_worker_coverage(fetched, expected):
+    if not BOT_WORKERS:
+        return ""
+    if not METRICS_PORT:
+        return "\n\n⚠️ Только процесс админ-бота: задайте METRICS_PORT, чтобы собирать данные воркеров"
+    if fetched < expected:
+        return f"\n\n⚠️ Ответили воркеры: {fetched} из {expected}"
+    return ""
+
+
+def format_receipt_trace_summary(summary, count):
+    lines = [f"🧾 Трассы чеков: {count} (мс)", ""]
+    for name, stats in sorted(summary.items(), key=lambda item: -item[1]["p50_ms"]):
+        lines.append(
+            f"{name} ×{stats['count']}: p50 {stats['p50_ms']:.0f}, p95 {stats['p95_ms']:.0f}, "
+            f"p99 {stats['p99_ms']:.0f}, max {stats['max_ms']:.0f}"
+        )
+    if not summary:
+        lines.append("Нет данных")
+    return "\n".join(lines)
+
+
+def count_slow_updates():
+    return sum(value for (name, _), value in metric_counters.items() if name == "slow_updates_total")
+
+
+def merge_handler_timings(states):
+    merged = {name: list(samples) for name, samples in handler_timings.items()}
+    for state in states:
+        for name, samples in state["handlers"].items():
+            merged.setdefault(name, []).extend(samples)
+    return merged
+
+
+def format_handler_stats(timings, slow):
+    lines = [f"⏱ Хендлеры (последние {HANDLER_STATS_WINDOW} вызовов на процесс, мс)", ""]
+    ranked = sorted(timings.items(), key=lambda item: -sum(sample[0] for sample in item[1]))
+    for name, samples in ranked:
+        totals = sorted(sample[0] for sample in samples)
+        count = len(totals)
+        spent = sum(totals) or 1.0
+        api, db, sheets = (sum(sample[i] for sample in samples) / spent * 100 for i in (1, 2, 3))
+        lines.append(
+            f"{name}: {count} вызовов\n"
+            f"  p50 {totals[count // 2] * 1000:.1f}, p95 {totals[min(int(count * 0.95), count - 1)] * 1000:.1f}, "
+            f"p99 {totals[min(int(count * 0.99), count - 1)] * 1000:.1f}, max {totals[-1] * 1000:.1f}\n"
+            f"  API {api:.0f}%, БД {db:.0f}%, таблицы {sheets:.0f}%"
+        )
+    if not timings:
+        lines.append("Нет данных")
+    lines.append("")
+    lines.append(f"Медленных апдейтов (≥ {SLOW_UPDATE_SECONDS:g} с): {slow}")
+    return "\n".join(lines)
+
+
+HTTP_STATUS_TEXT = {
+    200: "OK", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+    413: "Payload Too Large", 429: "Too Many Requests",
+}
+
+
+async def serve_http(host, port, handler, max_body=1024 * 1024):
+    async def on_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 75)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, path, _ = lines[0].split(" ", 2)
+                except ValueError:
+                    return
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                raw_length = headers.get("content-length") or "0"
+                length = int(raw_length) if raw_length.isascii() and raw_length.isdigit() else None
+                if length is None:
+                    status, content_type, body = 400, "text/plain", b""
+                elif length > max_body:
+                    status, content_type, body = 413, "text/plain", b""
+                else:
+                    payload = await reader.readexactly(length) if length else b""
+                    try:
+                        status, content_type, body = await handler(method, path, headers, payload)
+                    except Exception as e:
+                        logger.error("HTTP handler error for %s %s: %s", method, path, e)
+                        status, content_type, body = 400, "text/plain", b""
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close" and length is not None and length <= max_body
+                )
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_STATUS_TEXT.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+                )
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+
+def get_webhook_path(token):
+    path = hashlib.sha256(f"{WEBHOOK_SECRET}:path:{token}".encode()).hexdigest()[:32]
+    if WORKER_ID is not None:
+        return f"w{WORKER_ID}/{path}"
+    return path
+
+
+def get_webhook_secret(token):
+    return hashlib.sha256(f"{WEBHOOK_SECRET}:secret:{token}".encode()).hexdigest()
+
+
+async def handle_webhook_request(method, path, headers, body):
+    route = webhook_routes.get(path.strip("/"))
+    if method != "POST" or not route:
+        return 404, "text/plain", b""
+    app, secret = route
+    if headers.get("x-telegram-bot-api-secret-token") != secret:
+        return 403, "text/plain", b""
+    update = Update.de_json(json.loads(body), app.bot)
+    await app.update_queue.put(update)
+    return 200, "text/plain", b""
+
+
+async def start_webhook_server():
+    server = await serve_http(WEBHOOK_LISTEN, WEBHOOK_PORT, handle_webhook_request)
+    logger.info("Webhook server listening on %s:%s", WEBHOOK_LISTEN, WEBHOOK_PORT)
+    return server
+
+
+def build_secret_app(token):
+    builder = new_application_builder(token)
+    if WEBHOOK_URL or ADAPTIVE_POLLING:
+        builder = builder.updater(None)
+    new_app = builder.build()
+    setup_secret_bot_handlers(new_app)
+    return new_app
+
+
+async def start_secret_app(app):
+    await app.initialize()
+    await app.start()
+    if WEBHOOK_URL:
+        token = app.bot.token
+        path = get_webhook_path(token)
+        secret = get_webhook_secret(token)
+        webhook_routes[path] = (app, secret)
+        await app.bot.set_webhook(url=f"{WEBHOOK_URL}/{path}", secret_token=secret)
+    elif ADAPTIVE_POLLING:
+        await start_adaptive_polling(app)
+    else:
+        await app.updater.start_polling()
+
+
+def choose_poll_params(bot_token, poller, now):
+    idle = now - poller["last_update"]
+    if idle < POLL_ACTIVE_WINDOW:
+        return "active", POLL_TIMEOUT_ACTIVE
+    if idle < POLL_IDLE_AFTER or is_working_hours(bot_token):
+        return "idle", POLL_TIMEOUT_IDLE
+    return "sleeping", min(max(poller["timeout"] * 2, POLL_TIMEOUT_IDLE), POLL_TIMEOUT_SLEEPING)
+
+
+async def adaptive_poll_loop(app, poller):
+    token = app.bot.token
+    username = app.bot.username
+    while True:
+        cycle_started = time.monotonic()
+        mode, timeout = choose_poll_params(token, poller, cycle_started)
+        if mode != poller["mode"]:
+            logger.info("Polling @%s: %s -> %s (timeout %ss)", username, poller["mode"], mode, timeout)
+            poller["decisions"][mode] += 1
+        poller.update(mode=mode, timeout=timeout)
+
+        try:
+            updates = await app.bot.get_updates(
+                offset=poller["offset"], timeout=timeout, allowed_updates=POLL_ALLOWED_UPDATES
+            )
+            poller["errors"] = 0
+        except InvalidToken:
+            logger.error("Polling @%s stopped: token was revoked", username)
+            return
+        except RetryAfter as e:
+            logger.warning("Polling @%s rate limited, retrying in %ss", username, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            continue
+        except Exception as e:
+            poller["errors"] += 1
+            delay = min(2 ** poller["errors"], 60)
+            logger.warning("Polling @%s failed (%s), retrying in %ss", username, e, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        poller["polls"] += 1
+        if updates:
+            poller["last_update"] = time.monotonic()
+            poller["updates"] += len(updates)
+            poller["baseline"] += 1
+            for update in updates:
+                await app.update_queue.put(update)
+            poller["offset"] = updates[-1].update_id + 1
+        else:
+            poller["baseline"] += max((time.monotonic() - cycle_started) / POLL_TIMEOUT_ACTIVE, 1)
+
+
+async def start_adaptive_polling(app):
+    await app.bot.delete_webhook()
+    poller = {
+        "application": app,
+        "username": app.bot.username,
+        "offset": None,
+        "mode": "active",
+        "timeout": POLL_TIMEOUT_ACTIVE,
+        "last_update": time.monotonic(),
+        "polls": 0,
+        "baseline": 0,
+        "updates": 0,
+        "errors": 0,
+        "decisions": Counter(),
+    }
+    poller["task"] = asyncio.create_task(adaptive_poll_loop(app, poller))
+    bot_pollers[app.bot.token] = poller
+
+
+async def stop_adaptive_polling(token):
+    poller = bot_pollers.pop(token, None)
+    if not poller:
+        return
+    poller["task"].cancel()
+    await asyncio.gather(poller["task"], return_exceptions=True)
+    if poller["offset"] is not None:
+        try:
+            await poller["application"].bot.get_updates(offset=poller["offset"], timeout=0)
+        except Exception as e:
+            logger.warning("Failed to confirm last updates for @%s: %s", poller["username"], e)
+
+
+def format_polling_report():
+    if not bot_pollers:
+        return "ℹ️ Адаптивный опрос не запущен в этом процессе"
+    pollers = list(bot_pollers.values())
+    polls = sum(p["polls"] for p in pollers)
+    baseline = sum(p["baseline"] for p in pollers)
+    modes = Counter(p["mode"] for p in pollers)
+    saved = 1 - polls / baseline if baseline else 0
+    lines = [
+        f"📡 Опрос: {len(pollers)} ботов",
+        f"Активных: {modes['active']}, ожидающих: {modes['idle']}, спящих: {modes['sleeping']}",
+        f"Запросов getUpdates: {polls} (при фиксированном опросе ≈{baseline:.0f}, экономия {saved:.0%})",
+        "",
+    ]
+    for p in sorted(pollers, key=lambda p: p["polls"], reverse=True)[:15]:
+        lines.append(
+            f"@{p['username']}: {p['mode']}, timeout {p['timeout']} с, "
+            f"запросов {p['polls']}, апдейтов {p['updates']}"
+        )
+    return "\n".join(lines)
+
+
+async def stop_secret_app(app):
+    webhook_routes.pop(get_webhook_path(app.bot.token), None)
+    await stop_adaptive_polling(app.bot.token)
+    if app.updater and app.updater.running:
+        await app.updater.stop()
+    if app.running:
+        await app.stop()
+    await app.shutdown()
+
+
+def evict_bot_state(token):
+    bot_info = created_bots.pop(token, None)
+    if bot_info:
+        bot_sheet_partitions.pop(bot_info["username"], None)
+    for state in (user_pseudonyms, bot_admins, bot_chat_admins, bot_geos, bot_shifts,
+                  bot_requisites, message_map, banned_users, receipt_watchers):
+        state.pop(token, None)
+    for bucket in receipt_index.pop(token, {}).values():
+        for receipt_id in bucket:
+            receipts.pop(receipt_id, None)
+    for code in [code for code, invite in invite_links.items() if invite["bot_token"] == token]:
+        del invite_links[code]
+    prefix = f"{token}_"
+    for key in [key for key in user_states if key.startswith(prefix)]:
+        del user_states[key]
+
+
+async def retire_bot(token):
+    bot_info = created_bots.get(token)
+    reclaimed = {
+        "members": len(get_bot_members(token)),
+        "messages": len(message_map.get(token, {})),
+        "receipts": sum(len(bucket) for bucket in receipt_index.get(token, {}).values()),
+    }
+    if bot_info:
+        app = bot_info["application"]
+        if WEBHOOK_URL:
+            try:
+                await app.bot.delete_webhook()
+            except Exception as e:
+                logger.warning("Failed to delete webhook for @%s: %s", bot_info["username"], e)
+        try:
+            await stop_secret_app(app)
+        except Exception as e:
+            logger.error("Failed to stop bot @%s: %s", bot_info["username"], e)
+    evict_bot_state(token)
+    return reclaimed
+
+
+async def restore_bot(semaphore, token, username, admin_user_id, geo):
+    async with semaphore:
+        started = time.perf_counter()
+        new_app = build_secret_app(token)
+
+        bot_admins[token] = admin_user_id
+        bot_geos[token] = geo
+        if token not in user_pseudonyms:
+            user_pseudonyms[token] = {}
+
+        created_bots[token] = {
+            "token": token,
+            "application": new_app,
+            "username": username
+        }
+
+        try:
+            if BOT_WORKERS and WORKER_ID is None:
+                await asyncio.wait_for(new_app.initialize(), RESTORE_TIMEOUT)
+            else:
+                await asyncio.wait_for(start_secret_app(new_app), RESTORE_TIMEOUT)
+            logger.info("Restored bot @%s (geo: %s)", username, geo)
+            return {"username": username, "seconds": time.perf_counter() - started, "error": None}
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.error("Failed to restore bot @%s: %s", username, error)
+            created_bots.pop(token, None)
+            bot_admins.pop(token, None)
+            bot_geos.pop(token, None)
+            try:
+                await stop_secret_app(new_app)
+            except Exception as stop_error:
+                logger.error("Failed to stop bot @%s after failed restore: %s", username, stop_error)
+            return {"username": username, "seconds": time.perf_counter() - started, "error": error}
 
 
 async def restore_bots(app):
+    started = time.perf_counter()
+    record_startup_phase("admin_ready", IMPORT_STARTED)
     bots_list = db_load_all()
-    for token, username, admin_user_id, geo in bots_list:
+    semaphore = asyncio.Semaphore(max(RESTORE_CONCURRENCY, 1))
+    results = await asyncio.gather(*(restore_bot(semaphore, *row) for row in bots_list))
+
+    record_startup_phase("restore_bots", started)
+    startup_report.clear()
+    startup_report.update({
+        "total_seconds": time.perf_counter() - started,
+        "concurrency": RESTORE_CONCURRENCY,
+        "bots": sorted(results, key=lambda r: r["seconds"], reverse=True),
+    })
+    failed = [r for r in results if r["error"]]
+    logger.info(
+        "Restored %s/%s bots in %.2fs (concurrency %s)",
+        len(results) - len(failed), len(results), startup_report["total_seconds"], RESTORE_CONCURRENCY
+    )
+    for r in failed:
+        logger.warning("Bot @%s failed to start: %s", r["username"], r["error"])
+
+
+async def shutdown_secret_bots():
+    started = time.monotonic()
+    deadline = started + SHUTDOWN_TIMEOUT
+    apps = {token: bot_info["application"] for token, bot_info in created_bots.items()}
+    logger.info("Shutting down %s bots (deadline %.0fs)", len(apps), SHUTDOWN_TIMEOUT)
+
+    webhook_routes.clear()
+    await asyncio.gather(
+        *(app.updater.stop() for app in apps.values() if app.updater and app.updater.running),
+        *(stop_adaptive_polling(token) for token in list(bot_pollers)),
+        return_exceptions=True
+    )
+
+    stopping = {asyncio.ensure_future(app.stop()): token for token, app in apps.items() if app.running}
+    if stopping:
+        _, unfinished = await asyncio.wait(stopping, timeout=max(deadline - time.monotonic(), 0))
+        for task in unfinished:
+            logger.warning("Bot @%s did not finish in-flight updates in time", created_bots[stopping[task]]["username"])
+            task.cancel()
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+    logger.info("Drained in-flight updates in %.2fs", time.monotonic() - started)
+
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        await asyncio.wait_for(asyncio.to_thread(export_backend.close), max(deadline - time.monotonic(), 1))
+    except Exception as e:
+        logger.error("Failed to flush export backend on shutdown: %s", str(e) or type(e).__name__)
+    try:
+        db_checkpoint()
+    except Exception as e:
+        logger.error("Failed to checkpoint database on shutdown: %s", e)
+
+    await asyncio.gather(*(app.shutdown() for app in apps.values()), return_exceptions=True)
+    await close_shared_requests()
+    logger.info("Shutdown complete in %.2fs", time.monotonic() - started)
+
+
+def build_hash_ring(worker_ids, replicas=64):
+    ring = []
+    for worker_id in worker_ids:
+        for replica in range(replicas):
+            point = int(hashlib.md5(f"worker-{worker_id}-{replica}".encode()).hexdigest()[:16], 16)
+            ring.append((point, worker_id))
+    ring.sort()
+    return ring
+
+
+def ring_lookup(ring, token):
+    point = int(hashlib.md5(token.encode()).hexdigest()[:16], 16)
+    index = bisect.bisect(ring, (point, -1)) % len(ring)
+    return ring[index][1]
+
+
+def spawn_worker(worker_id):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", str(worker_id)])
+    worker_processes[worker_id] = {"process": process, "started": time.time(), "restart_at": None}
+    logger.info("Started worker %s (pid %s)", worker_id, process.pid)
+
+
+def stop_workers():
+    for info in worker_processes.values():
+        if info["process"].poll() is None:
+            info["process"].terminate()
+    for worker_id, info in worker_processes.items():
         try:
-            new_app = Application.builder().token(token).build()
-            setup_secret_bot_handlers(new_app)
-
-            bot_admins[token] = admin_user_id
-            bot_geos[token] = geo
-            if token not in user_pseudonyms:
-                user_pseudonyms[token] = {}
-
-            created_bots[token] = {
-                "token": token,
-                "application": new_app,
-                "username": username
-            }
+            info["process"].wait(timeout=SHUTDOWN_TIMEOUT + 10)
+        except subprocess.TimeoutExpired:
+            logger.warning("Worker %s did not stop in time, killing", worker_id)
+            info["process"].kill()
+
+
+def sync_worker_assignments(previous):
+    now = time.time()
+    for worker_id, info in worker_processes.items():
+        process = info["process"]
+        if process.poll() is not None and info["restart_at"] is None:
+            logger.error("Worker %s exited with code %s, reassigning its bots", worker_id, process.returncode)
+            db_remove_worker(worker_id)
+            info["restart_at"] = now + WORKER_RESTART_DELAY
+        elif info["restart_at"] is not None and now >= info["restart_at"]:
+            spawn_worker(worker_id)
+
+    heartbeats = db_get_live_workers(WORKER_TIMEOUT)
+    for worker_id, info in worker_processes.items():
+        process = info["process"]
+        if process.poll() is None and worker_id not in heartbeats and now - info["started"] > WORKER_TIMEOUT:
+            logger.error("Worker %s stopped sending heartbeats, killing it", worker_id)
+            process.kill()
+
+    live = [
+        worker_id for worker_id in heartbeats
+        if worker_id in worker_processes and worker_processes[worker_id]["process"].poll() is None
+    ]
+    if not live:
+        return previous
+
+    ring = build_hash_ring(live)
+    assignments = {token: ring_lookup(ring, token) for token, *_ in db_get_bots()}
+    if assignments != previous:
+        db_set_assignments(assignments)
+        moved = sum(1 for token, worker_id in assignments.items() if previous.get(token) != worker_id)
+        logger.info("Assigned %s bots to workers %s (%s moved)", len(assignments), live, moved)
+    return assignments
+
+
+async def supervise_workers():
+    for worker_id in range(BOT_WORKERS):
+        spawn_worker(worker_id)
+    assignments = {}
+    while True:
+        try:
+            assignments = await asyncio.to_thread(sync_worker_assignments, assignments)
+        except Exception as e:
+            logger.error("Worker supervision failed: %s", e)
+        await asyncio.sleep(WORKER_SYNC_INTERVAL)
 
-            await new_app.initialize()
-            await new_app.start()
-            await new_app.updater.start_polling()
-            logger.info(f"Restored bot @{username} (geo: {geo})")
+
+async def worker_heartbeat_loop(worker_id):
+    while True:
+        try:
+            db_worker_heartbeat(worker_id)
         except Exception as e:
-            logger.error(f"Failed to restore bot @{username}: {e}")
+            logger.error("Worker heartbeat failed: %s", e)
+        await asyncio.sleep(WORKER_SYNC_INTERVAL)
+
+
+async def sync_worker_bots(worker_id, semaphore):
+    assigned = {row[0]: row for row in db_get_assigned_bots(worker_id)}
+
+    for token in [token for token in created_bots if token not in assigned]:
+        bot_info = created_bots[token]
+        logger.info("Releasing bot @%s", bot_info["username"])
+        try:
+            await stop_secret_app(bot_info["application"])
+        except Exception as e:
+            logger.error("Failed to stop bot @%s: %s", bot_info["username"], e)
+        evict_bot_state(token)
+
+    new_rows = [row for token, row in assigned.items() if token not in created_bots]
+    for token, *_ in new_rows:
+        evict_bot_state(token)
+        db_load_all(token)
+    if new_rows:
+        await asyncio.gather(*(restore_bot(semaphore, *row) for row in new_rows))
+
+
+async def run_worker(worker_id):
+    global WORKER_ID, logger
+    WORKER_ID = worker_id
+    logger = logging.getLogger(f"{__name__}.worker{worker_id}")
+    setup_logging()
+
+    init_db()
+    if init_export_backend().name == "sheets":
+        start_background_task(init_google_sheets_background())
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = await serve_http(METRICS_LISTEN, METRICS_PORT + 1 + worker_id, handle_worker_request)
+        logger.info("Worker metrics listening on port %s", METRICS_PORT + 1 + worker_id)
+    start_memory_sampler()
+    start_state_writer()
+    server = None
+    if WEBHOOK_URL:
+        server = await serve_http(WEBHOOK_LISTEN, WEBHOOK_PORT + 1 + worker_id, handle_webhook_request)
+        logger.info("Worker webhook server listening on port %s", WEBHOOK_PORT + 1 + worker_id)
+    if export_backend.name != "sheets" and EXPORT_FLUSH_INTERVAL > 0:
+        start_background_task(export_flush_loop())
+    if PENDING_ESCALATE_AFTER > 0:
+        start_background_task(pending_escalation_loop())
+
+    heartbeat = start_background_task(worker_heartbeat_loop(worker_id))
+    semaphore = asyncio.Semaphore(max(RESTORE_CONCURRENCY, 1))
+    logger.info("Worker %s started (pid %s)", worker_id, os.getpid())
+    while not stop_event.is_set():
+        try:
+            await sync_worker_bots(worker_id, semaphore)
+        except Exception as e:
+            logger.error("Worker sync failed: %s", e)
+        try:
+            await asyncio.wait_for(stop_event.wait(), WORKER_SYNC_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    logger.info("Worker %s stopping", worker_id)
+    heartbeat.cancel()
+    if server:
+        server.close()
+    await shutdown_secret_bots()
+    stop_memory_sampler()
+    stop_state_writer()
+    if metrics_server:
+        metrics_server.close()
+    db_remove_worker(worker_id)
+    stop_logging()
+
+
+def format_startup_phases():
+    lines = ["⏱ Фазы запуска (от начала импорта):"]
+    for name, (offset, seconds) in sorted(startup_phases.items(), key=lambda item: item[1][0]):
+        lines.append(f"  {name}: {seconds:.2f} с (с {offset:.2f} с)")
+    if import_timings:
+        lines.append("Отложенные импорты:")
+        for name, seconds in sorted(import_timings.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name}: {seconds * 1000:.0f} мс")
+    return "\n".join(lines)
+
+
+def format_startup_report():
+    if not startup_report:
+        return "ℹ️ Отчёт о запуске ещё не готов\n\n" + format_startup_phases()
+    bots = startup_report["bots"]
+    failed = [r for r in bots if r["error"]]
+    lines = [
+        f"🚀 Запуск: {len(bots) - len(failed)}/{len(bots)} ботов за {startup_report['total_seconds']:.2f} с "
+        f"(параллельно: {startup_report['concurrency']})",
+        "",
+    ]
+    for r in bots:
+        mark = "❌" if r["error"] else "✅"
+        lines.append(f"{mark} @{r['username']}: {r['seconds']:.2f} с")
+    if failed:
+        lines.append("")
+        lines.append("Не запустились:")
+        for r in failed:
+            lines.append(f"  • @{r['username']}: {r['error']}")
+    lines.append("")
+    lines.append(format_startup_phases())
+    return "\n".join(lines)
 
 
 async def start_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -630,8 +3114,19 @@ async def start_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "👋 Добро пожаловать в менеджер секретных чатов\n\n"
         "Команды:\n"
         "/create_secret_chat - Создать нового бота для секретного чата\n"
+        "/import - Массовый импорт ботов (строки token,geo)\n"
+        "/suspend @bot - Приостановить бота\n"
+        "/resume [@bot] - Возобновить бота\n"
+        "/delete @bot - Удалить бота\n"
         "/add <user_id> - Добавить пользователя в whitelist\n"
         "/msg <текст> - Массовая рассылка по всем ботам\n"
+        "/reconcile [dry] - Сверка таблиц с базой\n"
+        "/startup - Отчёт о запуске ботов\n"
+        "/http - Статистика HTTP пулов\n"
+        "/polling - Режимы опроса ботов\n"
+        "/stats - Время обработки по хендлерам\n"
+        "/memory [now] - Память по структурам и чатам\n"
+        "/traces [N] - Трассы чеков (JSON и перцентили)\n"
         "Отправьте токен бота от @BotFather, чтобы создать нового бота"
     )
 
@@ -649,6 +3144,146 @@ async def create_secret_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 admin_pending_tokens = {}
+admin_import_waiting = set()
+
+
+async def fetch_bot_username(token):
+    bot = Bot(
+        token,
+        base_url=f"{TELEGRAM_API_URL}/bot",
+        base_file_url=f"{TELEGRAM_API_URL}/file/bot",
+        request=get_shared_request("api"),
+        get_updates_request=get_shared_request("updates"),
+    )
+    async with bot:
+        return bot.username
+
+
+def mask_token(token):
+    return f"{token.split(':', 1)[0]}:…"
+
+
+def parse_import_lines(text):
+    entries = []
+    errors = []
+    seen = {}
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part.strip() for part in line.replace(";", ",").split(",")]
+        token = parts[0]
+        geo = (parts[1] if len(parts) > 1 and parts[1] else "argentina").lower()
+        if ":" not in token or len(token) <= 20:
+            errors.append({"line": number, "token": mask_token(token), "username": None, "geo": geo, "error": "неверный формат токена"})
+        elif geo not in GEO_CURRENCIES:
+            errors.append({"line": number, "token": mask_token(token), "username": None, "geo": geo, "error": "неизвестное гео"})
+        elif token in seen:
+            errors.append({"line": number, "token": mask_token(token), "username": None, "geo": geo, "error": f"дубликат строки {seen[token]}"})
+        else:
+            seen[token] = number
+            entries.append((number, token, geo))
+    return entries, errors
+
+
+async def import_bots(entries, admin_user_id):
+    semaphore = asyncio.Semaphore(max(IMPORT_CONCURRENCY, 1))
+    existing = {row[0] for row in db_get_bots(include_suspended=True)}
+
+    async def validate(number, token, geo):
+        result = {"line": number, "token": mask_token(token), "username": None, "geo": geo, "error": None}
+        if token in existing:
+            result["error"] = "уже добавлен"
+            return token, result
+        async with semaphore:
+            try:
+                result["username"] = await asyncio.wait_for(fetch_bot_username(token), RESTORE_TIMEOUT)
+            except InvalidToken:
+                result["error"] = "неверный токен"
+            except Exception as e:
+                result["error"] = str(e) or type(e).__name__
+        return token, result
+
+    validated = await gather_api(*(validate(*entry) for entry in entries))
+    valid = [(token, result) for token, result in validated if not result["error"]]
+
+    if valid:
+        started = await gather_api(*(
+            restore_bot(semaphore, token, r["username"], admin_user_id, r["geo"]) for token, r in valid
+        ))
+        for (token, result), start in zip(valid, started):
+            result["error"] = start["error"]
+        added = [(token, r) for token, r in valid if not r["error"]]
+        if added:
+            db_add_bots([(token, r["username"], admin_user_id, r["geo"]) for token, r in added])
+            await asyncio.to_thread(create_bot_sheets, [r["username"] for _, r in added])
+
+    return [result for _, result in validated]
+
+
+def format_import_report(results):
+    ok = [r for r in results if not r["error"]]
+    lines = [f"📥 Импорт: {len(ok)}/{len(results)} ботов добавлено", ""]
+    for r in sorted(results, key=lambda r: r["line"]):
+        name = f"@{r['username']}" if r["username"] else r["token"]
+        if r["error"]:
+            lines.append(f"❌ стр. {r['line']}: {name} — {r['error']}")
+        else:
+            lines.append(f"✅ стр. {r['line']}: {name} ({r['geo']}, {GEO_CURRENCIES[r['geo']]})")
+    return "\n".join(lines)
+
+
+async def run_import(update, user_id, text):
+    entries, errors = parse_import_lines(text)
+    if not entries and not errors:
+        await update.message.reply_text("❌ Нет строк для импорта. Формат: token,geo")
+        return
+    await update.message.reply_text(f"⏳ Проверяю {len(entries)} токенов...")
+    results = errors + await import_bots(entries, user_id)
+    report = format_import_report(results)
+    if len(report) > 4000:
+        await update.message.reply_document(
+            document=io.BytesIO(report.encode("utf-8")),
+            filename="import_report.txt",
+            caption=report.split("\n", 1)[0]
+        )
+    else:
+        await update.message.reply_text(report)
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1] if len(parts) > 1 else ""
+    if text.strip():
+        await run_import(update, user_id, text)
+        return
+
+    admin_import_waiting.add(user_id)
+    await update.message.reply_text(
+        "📥 Отправьте файл или сообщение со строками вида:\n"
+        "token,geo\n\n"
+        f"Доступные гео: {', '.join(GEO_CURRENCIES)}"
+    )
+
+
+async def handle_admin_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        return
+
+    caption = update.message.caption or ""
+    if user_id not in admin_import_waiting and not caption.startswith("/import"):
+        return
+    admin_import_waiting.discard(user_id)
+
+    document_file = await update.message.document.get_file()
+    data = await document_file.download_as_bytearray()
+    await run_import(update, user_id, data.decode("utf-8-sig", errors="replace"))
 
 
 async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -658,12 +3293,18 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
     text = update.message.text
 
+    if user_id in admin_import_waiting:
+        admin_import_waiting.discard(user_id)
+        await run_import(update, user_id, text)
+        return
+
     if ":" in text and len(text) > 20:
         try:
-            response = requests.get(f"https://api.telegram.org/bot{text}/getMe")
-            if response.status_code == 200:
-                bot_info = response.json()["result"]
-                bot_username = bot_info["username"]
+            try:
+                bot_username = await fetch_bot_username(text)
+            except InvalidToken:
+                bot_username = None
+            if bot_username:
 
                 admin_pending_tokens[user_id] = {
                     "token": text,
@@ -692,7 +3333,7 @@ async def handle_admin_message(update: Update, context: ContextTypes.DEFAULT_TYP
             else:
                 await update.message.reply_text("❌ Неверный токен")
         except Exception as e:
-            logger.error(f"Error validating token: {e}")
+            logger.error("Error validating token: %s", e)
             await update.message.reply_text(f"❌ Ошибка: {str(e)}")
 
 
@@ -713,8 +3354,7 @@ async def admin_geo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     bot_username = pending["username"]
 
     try:
-        new_app = Application.builder().token(token).build()
-        setup_secret_bot_handlers(new_app)
+        new_app = build_secret_app(token)
 
         user_pseudonyms[token] = {}
         bot_admins[token] = user_id
@@ -727,11 +3367,13 @@ async def admin_geo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         }
 
         db_add_bot(token, bot_username, user_id, geo)
+        await wait_for_sheets()
         create_bot_sheet(bot_username)
 
-        await new_app.initialize()
-        await new_app.start()
-        await new_app.updater.start_polling()
+        if BOT_WORKERS:
+            await new_app.initialize()
+        else:
+            await start_secret_app(new_app)
 
         currency = GEO_CURRENCIES.get(geo, "ARS")
         geo_name = {
@@ -749,7 +3391,7 @@ async def admin_geo_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             f"Пользователи теперь могут присоединиться и выбрать псевдоним"
         )
     except Exception as e:
-        logger.error(f"Error creating bot: {e}")
+        logger.error("Error creating bot: %s", e)
         await query.edit_message_text(f"❌ Ошибка: {str(e)}")
 
 
@@ -807,627 +3449,1091 @@ async def secret_chat_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Недействительная ссылка-приглашение")
             return
 
-    if bot_token in user_pseudonyms and user_id in user_pseudonyms[bot_token]:
-        pseudonym = user_pseudonyms[bot_token][user_id]
+    if bot_token in user_pseudonyms and user_id in user_pseudonyms[bot_token]:
+        pseudonym = user_pseudonyms[bot_token][user_id]
+
+        is_admin = is_chat_admin(bot_token, user_id)
+
+        await update.message.reply_text(
+            f"👋 С возвращением!\n\n"
+            f"Ваш псевдоним: {pseudonym}\n\n"
+            f"Отправьте фото — оно будет определено как чек",
+            reply_markup=get_main_keyboard(is_admin)
+        )
+    else:
+        is_admin = is_chat_admin(bot_token, user_id)
+        if not is_admin:
+            await update.message.reply_text(
+                "❌ Это приватный чат. Для входа нужна ссылка-приглашение.\n\n"
+                "Попросите ссылку у администратора чата."
+            )
+        else:
+            await update.message.reply_text(
+                "👋 Добро пожаловать в секретный чат!\n\n"
+                "Вы являетесь администратором этого чата.\n\n"
+                "Выберите свой псевдоним — отправьте любое имя"
+            )
+
+
+def persist_message_fanout(bot_token, sender_key):
+    entries = message_map[bot_token]
+    root = entries[sender_key]
+    db_save_message_map(
+        bot_token,
+        [(sender_key, root)] + [((uid, msg_id), entries[(uid, msg_id)]) for uid, msg_id in root["sent_to"].items()]
+    )
+
+
+def persist_receipt_messages(bot_token, receipt_id):
+    message_ids = receipts[receipt_id].get("message_ids", {})
+    if message_ids:
+        db_save_message_map(
+            bot_token,
+            [((uid, msg_id), message_map[bot_token][(uid, msg_id)]) for uid, msg_id in message_ids.items()],
+            [(receipt_id, uid, msg_id) for uid, msg_id in message_ids.items()]
+        )
+
+
+def get_user_state(bot_token, user_id):
+    key = f"{bot_token}_{user_id}"
+    return user_states.get(key)
+
+
+def set_user_state(bot_token, user_id, state):
+    key = f"{bot_token}_{user_id}"
+    if state is None:
+        if user_states.pop(key, None) is None:
+            return
+    else:
+        user_states[key] = state
+    db_save_user_state(bot_token, user_id, state)
+
+
+async def button_send_photo(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "send_photo"})
+    await update.message.reply_text(
+        "📷 Отправьте фото, и оно будет переслано как обычное фото (не чек).",
+        reply_markup=get_main_keyboard(is_admin)
+    )
+
+
+async def button_requisites(update, context, bot_token, user_id, is_admin, text, state):
+    reqs = bot_requisites.get(bot_token)
+    if reqs:
+        req_text = reqs.get("text") or ""
+        if reqs.get("photo_id"):
+            try:
+                await context.bot.send_photo(
+                    chat_id=user_id,
+                    photo=reqs["photo_id"],
+                    caption=f"📋 Актуальные реквизиты:\n\n{req_text}"
+                )
+            except Exception as e:
+                logger.error("Error sending requisites photo: %s", e)
+                if req_text:
+                    await update.message.reply_text(f"📋 Актуальные реквизиты:\n\n{req_text}")
+                else:
+                    await update.message.reply_text("📋 Ошибка при загрузке реквизитов. Попросите админа обновить их.")
+        else:
+            if req_text:
+                await update.message.reply_text(f"📋 Актуальные реквизиты:\n\n{req_text}")
+            else:
+                await update.message.reply_text("📋 Реквизиты пустые. Попросите админа обновить их.")
+    else:
+        await update.message.reply_text("📋 Реквизиты ещё не установлены")
+
+
+async def button_change_name(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_new_name"})
+    await update.message.reply_text("Введите новый никнейм:")
+
+
+async def button_invite(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_invite_minutes"})
+    await update.message.reply_text("Введите время действия ссылки в минутах (или 0 для бессрочной):")
+
+
+async def button_shift(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "setshift_start"})
+    await update.message.reply_text("Введите час начала смены (0-23, МСК):")
+
+
+async def button_edit_requisites(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_requisites"})
+    await update.message.reply_text("📋 Отправьте новые реквизиты (текст или фото с подписью):")
+
+
+async def button_op(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_op_id"})
+    await update.message.reply_text("Введите ID пользователя для назначения админом:")
+
+
+async def button_deop(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_deop_id"})
+    await update.message.reply_text("Введите ID пользователя для снятия прав админа:")
+
+
+async def button_kick(update, context, bot_token, user_id, is_admin, text, state):
+    set_user_state(bot_token, user_id, {"mode": "waiting_kick_id"})
+    await update.message.reply_text("Введите ID пользователя для исключения:")
+
+
+async def button_receipt_watchers(update, context, bot_token, user_id, is_admin, text, state):
+    watchers = receipt_watchers.get(bot_token, set())
+    watcher_names = []
+    for wid in watchers:
+        name = user_pseudonyms.get(bot_token, {}).get(wid, str(wid))
+        watcher_names.append(f"  • {name} (ID: {wid})")
+    watcher_list = "\n".join(watcher_names) if watcher_names else "  Пока никого"
+    set_user_state(bot_token, user_id, {"mode": "waiting_watcher_action"})
+    await update.message.reply_text(
+        f"🔔 Уведомления о чеках\n\n"
+        f"Уведомления получают:\n"
+        f"  • Автор чека (всегда)\n"
+        f"{watcher_list}\n\n"
+        f"Отправьте ID пользователя чтобы добавить/убрать из списка,\n"
+        f"или напишите «отмена» для выхода.",
+        reply_markup=get_main_keyboard(is_admin)
+    )
+
+
+async def button_members(update, context, bot_token, user_id, is_admin, text, state):
+    users = user_pseudonyms.get(bot_token, {})
+    if not users:
+        await update.message.reply_text("📋 Участников пока нет", reply_markup=get_main_keyboard(is_admin))
+        return
+    lines = ["📋 Участники чата:\n"]
+    for uid, pseudonym_name in users.items():
+        admin_mark = " 👑" if is_chat_admin(bot_token, uid) else ""
+        lines.append(f"  • {pseudonym_name} | ID: <code>{uid}</code>{admin_mark}")
+    lines.append(f"\nВсего: {len(users)}")
+    await update.message.reply_text("\n".join(lines), reply_markup=get_main_keyboard(is_admin), parse_mode="HTML")
+
+
+def parse_report_range(args):
+    today = get_moscow_now().date()
+    if not args or args[0] in ("day", "день"):
+        return today, today
+    if args[0] in ("week", "неделя"):
+        return today - timedelta(days=6), today
+    try:
+        start = datetime.strptime(args[0], "%Y-%m-%d").date()
+        end = datetime.strptime(args[1], "%Y-%m-%d").date() if len(args) > 1 else start
+    except ValueError:
+        return None
+    if end < start:
+        start, end = end, start
+    return start, end
+
+
+def report_timestamps(start, end):
+    start_ts = datetime(start.year, start.month, start.day, tzinfo=MOSCOW_TZ).timestamp()
+    end_ts = datetime(end.year, end.month, end.day, tzinfo=MOSCOW_TZ).timestamp() + 24 * 60 * 60
+    return start_ts, end_ts
+
+
+def format_status_totals(count, total, currency):
+    return f"{count} · {format_amount(total)} {currency}" if count else "0"
+
+
+def build_report(bot_token, start, end, page=0):
+    currency = get_bot_currency(bot_token)
+    start_ts, end_ts = report_timestamps(start, end)
+    totals, members = db_get_receipt_totals(bot_token, start_ts, end_ts, page * REPORT_PAGE_SIZE, REPORT_PAGE_SIZE)
+    count, approved, approved_sum, pending, pending_sum, declined, declined_sum, people = totals
+    pages = max((people + REPORT_PAGE_SIZE - 1) // REPORT_PAGE_SIZE, 1)
+    period = start.isoformat() if start == end else f"{start.isoformat()} — {end.isoformat()}"
+
+    lines = [
+        f"📊 Чеки за {period} (МСК)",
+        f"Всего: {count}",
+        f"✅ Принято: {format_status_totals(approved, approved_sum, currency)}",
+        f"⏳ Ожидают: {format_status_totals(pending, pending_sum, currency)}",
+        f"❌ Отклонено: {format_status_totals(declined, declined_sum, currency)}",
+    ]
+    if members:
+        lines.append("")
+        lines.append(f"По участникам (стр. {page + 1}/{pages}):")
+        for pseudonym, _, m_approved, m_approved_sum, m_pending, m_pending_sum, m_declined, m_declined_sum in members:
+            lines.append(
+                f"• {pseudonym}: ✅ {format_status_totals(m_approved, m_approved_sum, currency)}"
+                f" | ⏳ {format_status_totals(m_pending, m_pending_sum, currency)}"
+                f" | ❌ {format_status_totals(m_declined, m_declined_sum, currency)}"
+            )
+
+    key = f"{start.strftime('%Y%m%d')}_{end.strftime('%Y%m%d')}"
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️", callback_data=f"report_{key}_{page - 1}"))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton("▶️", callback_data=f"report_{key}_{page + 1}"))
+    today = get_moscow_now().date()
+    week = f"{(today - timedelta(days=6)).strftime('%Y%m%d')}_{today.strftime('%Y%m%d')}"
+    keyboard = [navigation] if navigation else []
+    keyboard.append([
+        InlineKeyboardButton("Сегодня", callback_data=f"report_{today.strftime('%Y%m%d')}_{today.strftime('%Y%m%d')}_0"),
+        InlineKeyboardButton("7 дней", callback_data=f"report_{week}_0"),
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+async def button_report(update, context, bot_token, user_id, is_admin, text, state):
+    today = get_moscow_now().date()
+    report_text, markup = build_report(bot_token, today, today)
+    await update.message.reply_text(report_text, reply_markup=markup)
+
+
+async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    bot_token = context.application.bot.token
+
+    if not is_chat_admin(bot_token, user_id):
+        await update.message.reply_text("❌ Только админы могут смотреть отчёты")
+        return
+
+    report_range = parse_report_range(context.args)
+    if not report_range:
+        await update.message.reply_text(
+            "❌ Использование: /report [day|week|ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]]"
+        )
+        return
+
+    report_text, markup = build_report(bot_token, *report_range)
+    await update.message.reply_text(report_text, reply_markup=markup)
+
+
+async def report_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    bot_token = context.application.bot.token
+
+    if not is_chat_admin(bot_token, query.from_user.id):
+        await query.answer("❌ Только админы могут смотреть отчёты", show_alert=True)
+        return
+
+    try:
+        _, start, end, page = query.data.split("_")
+        start = datetime.strptime(start, "%Y%m%d").date()
+        end = datetime.strptime(end, "%Y%m%d").date()
+        page = int(page)
+    except ValueError:
+        await query.answer("Неверные данные", show_alert=True)
+        return
+
+    report_text, markup = build_report(bot_token, start, end, page)
+    await query.answer()
+    try:
+        await query.edit_message_text(report_text, reply_markup=markup)
+    except Exception as e:
+        logger.debug("Report not updated: %s", e)
+
+
+def index_receipt(receipt_id, receipt_data, previous=None):
+    buckets = receipt_index.setdefault(receipt_data["bot_token"], {})
+    if previous:
+        buckets.get(previous, {}).pop(receipt_id, None)
+    buckets.setdefault(receipt_data["status"], {})[receipt_id] = receipt_data.get("created_ts", 0)
+
+
+def set_receipt_status(receipt_id, status):
+    receipt_data = receipts[receipt_id]
+    previous = receipt_data.get("status")
+    receipt_data["status"] = status
+    if status == "pending":
+        receipt_data.pop("escalated", None)
+    index_receipt(receipt_id, receipt_data, previous)
+
+
+def get_pending_ids(bot_token):
+    pending = receipt_index.get(bot_token, {}).get("pending", {})
+    return sorted(pending, key=pending.get)
+
+
+def get_pending_receipts(bot_token, page=0):
+    ordered = get_pending_ids(bot_token)
+    pages = max((len(ordered) + PENDING_PAGE_SIZE - 1) // PENDING_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    chunk = ordered[page * PENDING_PAGE_SIZE:(page + 1) * PENDING_PAGE_SIZE]
+    return [(receipt_id, receipts[receipt_id]) for receipt_id in chunk], len(ordered), page, pages
+
+
+def format_age(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60:02d} мин"
+
+
+def build_pending_view(bot_token, selected, page=0):
+    pending, total, page, pages = get_pending_receipts(bot_token, page)
+    if not pending:
+        return "⏳ Ожидающих чеков нет", None
+    now = time.time()
+    oldest = receipts[get_pending_ids(bot_token)[0]].get("created_ts") or now
+    lines = [f"⏳ Ожидающие чеки: {total}", f"Самый старый ждёт {format_age(now - oldest)}"]
+    if pages > 1:
+        lines.append(f"Страница {page + 1}/{pages}")
+    lines.append("Решите по каждому чеку или отметьте несколько и примените действие сразу")
+    keyboard = []
+    for receipt_id, receipt in pending:
+        mark = "☑️" if receipt_id in selected else "⬜"
+        age = format_age(now - (receipt.get("created_ts") or now))
+        label = f"{mark} {receipt['pseudonym']} · {receipt['text']} · {age}"
+        keyboard.append([InlineKeyboardButton(label, callback_data=f"bulk_toggle_{page}_{receipt_id}")])
+        keyboard.append([
+            InlineKeyboardButton("✅ Принять", callback_data=f"bulk_yes_{page}_{receipt_id}"),
+            InlineKeyboardButton("❌ Отклонить", callback_data=f"bulk_no_{page}_{receipt_id}"),
+        ])
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"bulk_page_{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"bulk_page_{page + 1}"))
+        keyboard.append(nav)
+    count = len(selected)
+    keyboard.append([
+        InlineKeyboardButton("☑️ Все", callback_data=f"bulk_all_{page}"),
+        InlineKeyboardButton("⬜ Сброс", callback_data=f"bulk_none_{page}"),
+    ])
+    keyboard.append([
+        InlineKeyboardButton(f"✅ Принять ({count})", callback_data=f"bulk_approve_{page}"),
+        InlineKeyboardButton(f"❌ Отклонить ({count})", callback_data=f"bulk_decline_{page}"),
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def get_bulk_selection(message):
+    selected = set()
+    if message and message.reply_markup:
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                data = button.callback_data or ""
+                if data.startswith("bulk_toggle_") and button.text.startswith("☑️"):
+                    selected.add(data.rsplit("_", 1)[1])
+    return selected
+
+
+def edit_receipt_messages(bot_to_use, receipt_id, receipt_data, text, markup, semaphore):
+    async def edit(uid, msg_id):
+        async with semaphore:
+            edit_started = time.perf_counter()
+            try:
+                if "photo_id" in receipt_data or "document_id" in receipt_data:
+                    await bot_to_use.edit_message_caption(chat_id=uid, message_id=msg_id, caption=text, reply_markup=markup)
+                else:
+                    await bot_to_use.edit_message_text(chat_id=uid, message_id=msg_id, text=text, reply_markup=markup)
+                add_receipt_span(receipt_id, "caption_edit", edit_started, uid=uid)
+            except Exception as e:
+                logger.error("Error updating receipt for %s: %s", uid, e)
+                add_receipt_span(receipt_id, "caption_edit", edit_started, uid=uid, error=type(e).__name__)
+
+    return [edit(uid, msg_id) for uid, msg_id in receipt_data.get("message_ids", {}).items()]
 
-        is_admin = is_chat_admin(bot_token, user_id)
 
-        await update.message.reply_text(
-            f"👋 С возвращением!\n\n"
-            f"Ваш псевдоним: {pseudonym}\n\n"
-            f"Отправьте фото — оно будет определено как чек",
-            reply_markup=get_main_keyboard(is_admin)
-        )
+async def apply_bulk_decision(bot_to_use, bot_token, receipt_ids, action, approver_id):
+    started = time.perf_counter()
+    status = "approved" if action == "approve" else "declined"
+    chosen = [
+        (receipt_id, receipts[receipt_id]) for receipt_id in receipt_ids
+        if receipt_id in receipts and receipts[receipt_id].get("bot_token") == bot_token
+        and receipts[receipt_id].get("status") == "pending"
+    ]
+    if not chosen:
+        return []
+
+    approver_name = user_pseudonyms.get(bot_token, {}).get(approver_id, "Неизвестный")
+    bot_username = bot_to_use.username
+    currency = get_bot_currency(bot_token)
+    sheet_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    period = get_sheet_period(bot_token)
+    working = is_working_hours(bot_token)
+
+    updates, sheet_rows, ledger = [], [], []
+    for receipt_id, receipt_data in chosen:
+        set_receipt_status(receipt_id, status)
+        photo_url = f"https://t.me/c/{receipt_data['photo_id']}" if "photo_id" in receipt_data else None
+        if status == "approved":
+            receipt_data["sheet_period"] = period
+            amount = receipt_data.get("amount")
+            if amount:
+                sheet_rows.append([sheet_ts, str(amount), receipt_data.get("currency") or currency,
+                                   receipt_data["pseudonym"], photo_url or ""])
+                if working:
+                    ledger.append((receipt_id, amount))
+        updates.append((receipt_id, sheet_ts, photo_url, period))
+
+    db_started = time.perf_counter()
+    db_apply_receipt_decisions(bot_token, status, updates, ledger)
+    for receipt_id, _ in chosen:
+        add_receipt_span(receipt_id, "db_update", db_started, status=status, bulk=len(chosen))
+    if sheet_rows:
+        await wait_for_sheets()
+        sheet_started = time.perf_counter()
+        add_receipts_to_sheet(bot_username, sheet_rows, period)
+        for receipt_id, _ in chosen:
+            add_receipt_span(receipt_id, "sheet_write", sheet_started, op="add", bulk=len(sheet_rows))
+
+    if working:
+        daily_line = f"\nИтого за смену: {format_amount(db_get_daily_total(bot_token))} {currency}"
     else:
-        is_admin = is_chat_admin(bot_token, user_id)
-        if not is_admin:
-            await update.message.reply_text(
-                "❌ Это приватный чат. Для входа нужна ссылка-приглашение.\n\n"
-                "Попросите ссылку у администратора чата."
-            )
-        else:
-            await update.message.reply_text(
-                "👋 Добро пожаловать в секретный чат!\n\n"
-                "Вы являетесь администратором этого чата.\n\n"
-                "Выберите свой псевдоним — отправьте любое имя"
-            )
+        shift = bot_shifts.get(bot_token, {"start": 0, "end": 23})
+        daily_line = f"\nНерабочее время (смена: {shift['start']}:00–{shift['end']}:00 МСК)"
+    if status == "approved":
+        status_text = f"Статус: Принят ✅ ({approver_name})"
+    else:
+        status_text = f"Статус: Отклонён ❌ ({approver_name})"
 
+    semaphore = asyncio.Semaphore(max(BULK_EDIT_CONCURRENCY, 1))
+    edits = []
+    for receipt_id, receipt_data in chosen:
+        text = render_receipt_caption(
+            receipt_data, status_text, daily_line, render_receipt_comments(receipt_data.get("comments"))
+        )
+        edits.extend(edit_receipt_messages(
+            bot_to_use, receipt_id, receipt_data, text, receipt_markup(receipt_id, status), semaphore
+        ))
+    fanout_started = time.perf_counter()
+    await gather_api(*edits)
+    record_fanout("receipt_bulk_update", fanout_started)
+
+    await notify_bulk_decision(bot_to_use, bot_token, chosen, status, approver_id, approver_name)
+    for receipt_id, _ in chosen:
+        add_receipt_span(receipt_id, action, started, by=approver_id, bulk=len(chosen))
+    logger.info("Bulk %s of %s receipts in @%s by %s", action, len(chosen), bot_username, approver_name)
+    return [receipt_id for receipt_id, _ in chosen]
+
+
+async def notify_bulk_decision(bot_to_use, bot_token, chosen, status, approver_id, approver_name):
+    now_msk = get_moscow_now().strftime("%H:%M")
+    verb = "приняты" if status == "approved" else "отклонены"
+    mark = "✅" if status == "approved" else "❌"
+    by_owner = {}
+    for receipt_id, receipt_data in chosen:
+        by_owner.setdefault(receipt_data.get("owner_id"), []).append(receipt_data)
+
+    messages = {}
+    for owner_id, owned in by_owner.items():
+        if owner_id and owner_id != approver_id:
+            lines = [f"{mark} Ваши чеки {verb} ({approver_name}, {now_msk}):"]
+            lines.extend(f"• {r['text']}" for r in owned)
+            messages[owner_id] = "\n".join(lines)
+    watchers = receipt_watchers.get(bot_token, set()) - {approver_id}
+    if watchers:
+        lines = [f"{mark} Чеки {verb}: {len(chosen)} ({approver_name}, {now_msk})"]
+        lines.extend(f"• {r['pseudonym']}: {r['text']}" for _, r in chosen)
+        for uid in watchers:
+            if uid not in messages:
+                messages[uid] = "\n".join(lines)
+
+    async def send(uid, text):
+        try:
+            await bot_to_use.send_message(chat_id=uid, text=text)
+        except Exception as e:
+            logger.error("Error sending receipt notification to %s: %s", uid, e)
 
-def get_user_state(bot_token, user_id):
-    key = f"{bot_token}_{user_id}"
-    return user_states.get(key)
+    await gather_api(*(send(uid, text) for uid, text in messages.items()))
 
 
-def set_user_state(bot_token, user_id, state):
-    key = f"{bot_token}_{user_id}"
-    if state is None:
-        user_states.pop(key, None)
-    else:
-        user_states[key] = state
+async def button_pending(update, context, bot_token, user_id, is_admin, text, state):
+    view_text, markup = build_pending_view(bot_token, set())
+    await update.message.reply_text(view_text, reply_markup=markup)
 
 
-async def secret_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
+async def bulk_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
     bot_token = context.application.bot.token
-    text = update.message.text
+    user_id = query.from_user.id
 
-    if user_id in banned_users.get(bot_token, set()):
-        await update.message.reply_text("❌ Вы заблокированы в этом чате")
+    if not is_chat_admin(bot_token, user_id):
+        await query.answer("❌ Только админы могут управлять чеками", show_alert=True)
         return
 
-    if bot_token not in user_pseudonyms:
-        user_pseudonyms[bot_token] = {}
+    parts = query.data.split("_", 3)
+    if len(parts) < 3 or not parts[2].isdigit():
+        await query.answer("Неверные данные", show_alert=True)
+        return
+    action, page = parts[1], int(parts[2])
+    receipt_id = parts[3] if len(parts) > 3 else None
+
+    selected = get_bulk_selection(query.message)
+    if action == "toggle" and receipt_id:
+        selected ^= {receipt_id}
+        await query.answer()
+    elif action == "page":
+        selected = set()
+        await query.answer()
+    elif action == "all":
+        selected = {receipt_id for receipt_id, _ in get_pending_receipts(bot_token, page)[0]}
+        await query.answer()
+    elif action == "none":
+        selected = set()
+        await query.answer()
+    elif action in ("yes", "no") and receipt_id:
+        done = await apply_bulk_decision(
+            context.bot, bot_token, [receipt_id], "approve" if action == "yes" else "decline", user_id
+        )
+        selected.discard(receipt_id)
+        if not done:
+            await query.answer("Этот чек уже обработан", show_alert=True)
+        else:
+            await query.answer("Чек принят!" if action == "yes" else "Чек отклонён!")
+    elif action in ("approve", "decline"):
+        if not selected:
+            await query.answer("Сначала отметьте чеки", show_alert=True)
+            return
+        await query.answer("Применяю…")
+        ordered = [receipt_id for receipt_id in get_pending_ids(bot_token) if receipt_id in selected]
+        done = await apply_bulk_decision(context.bot, bot_token, ordered, action, user_id)
+        selected = set()
+        verb = "Принято" if action == "approve" else "Отклонено"
+        await context.bot.send_message(chat_id=user_id, text=f"{verb} чеков: {len(done)}")
+    else:
+        await query.answer()
+        return
 
-    if user_id not in user_pseudonyms[bot_token]:
-        user_pseudonyms[bot_token][user_id] = text
-        db_add_pseudonym(bot_token, user_id, text)
+    view_text, markup = build_pending_view(bot_token, selected, page)
+    try:
+        await query.edit_message_text(view_text, reply_markup=markup)
+    except Exception as e:
+        logger.debug("Pending view not updated: %s", e)
 
-        is_admin = is_chat_admin(bot_token, user_id)
 
-        await update.message.reply_text(
-            f"✅ Ваш псевдоним установлен: {text}\n\n"
-            f"Теперь вы можете отправлять сообщения в секретный чат!",
-            reply_markup=get_main_keyboard(is_admin)
+async def escalate_pending_receipts():
+    now = time.time()
+    escalated = 0
+    for bot_token, buckets in list(receipt_index.items()):
+        bot_info = created_bots.get(bot_token)
+        watchers = receipt_watchers.get(bot_token)
+        if not bot_info or not watchers:
+            continue
+        overdue = [
+            receipts[receipt_id] for receipt_id, created_ts in list(buckets.get("pending", {}).items())
+            if now - created_ts >= PENDING_ESCALATE_AFTER and not receipts[receipt_id].get("escalated")
+        ]
+        if not overdue:
+            continue
+        overdue.sort(key=lambda r: r.get("created_ts", 0))
+        for receipt_data in overdue:
+            receipt_data["escalated"] = True
+        lines = [f"⏰ Чеки ждут решения дольше {format_age(PENDING_ESCALATE_AFTER)}: {len(overdue)}"]
+        lines.extend(
+            f"• {r['pseudonym']}: {r['text']} ({format_age(now - r.get('created_ts', now))})" for r in overdue
         )
-        return
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("⏳ Открыть очередь", callback_data="bulk_page_0")]])
+        for uid in list(watchers):
+            try:
+                await bot_info["application"].bot.send_message(
+                    chat_id=uid, text="\n".join(lines), reply_markup=markup if is_chat_admin(bot_token, uid) else None
+                )
+            except Exception as e:
+                logger.error("Error sending receipt escalation to %s: %s", uid, e)
+        metric_inc("receipts_escalated_total", (("bot", bot_info["username"]),), len(overdue))
+        logger.info("Escalated %s pending receipts in @%s", len(overdue), bot_info["username"])
+        escalated += len(overdue)
+    return escalated
 
-    is_admin = is_chat_admin(bot_token, user_id)
 
-    if text == "📷 Отправить фото":
-        set_user_state(bot_token, user_id, {"mode": "send_photo"})
-        await update.message.reply_text(
-            "📷 Отправьте фото, и оно будет переслано как обычное фото (не чек).",
-            reply_markup=get_main_keyboard(is_admin)
-        )
-        return
+async def pending_escalation_loop():
+    while True:
+        await asyncio.sleep(PENDING_ESCALATE_INTERVAL)
+        try:
+            await escalate_pending_receipts()
+        except Exception as e:
+            logger.error("Receipt escalation failed: %s", e)
 
-    if text == "📋 Реквизиты":
-        reqs = bot_requisites.get(bot_token)
-        if reqs:
-            req_text = reqs.get("text") or ""
-            if reqs.get("photo_id"):
-                try:
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=reqs["photo_id"],
-                        caption=f"📋 Актуальные реквизиты:\n\n{req_text}"
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending requisites photo: {e}")
-                    if req_text:
-                        await update.message.reply_text(f"📋 Актуальные реквизиты:\n\n{req_text}")
-                    else:
-                        await update.message.reply_text("📋 Ошибка при загрузке реквизитов. Попросите админа обновить их.")
-            else:
-                if req_text:
-                    await update.message.reply_text(f"📋 Актуальные реквизиты:\n\n{req_text}")
-                else:
-                    await update.message.reply_text("📋 Реквизиты пустые. Попросите админа обновить их.")
-        else:
-            await update.message.reply_text("📋 Реквизиты ещё не установлены")
-        return
 
-    if text == "✏️ Сменить ник":
-        set_user_state(bot_token, user_id, {"mode": "waiting_new_name"})
-        await update.message.reply_text("Введите новый никнейм:")
-        return
+async def mode_new_name(update, context, bot_token, user_id, is_admin, text, state):
+    old_pseudonym = user_pseudonyms[bot_token][user_id]
+    user_pseudonyms[bot_token][user_id] = text
+    db_update_pseudonym(bot_token, user_id, text)
+    set_user_state(bot_token, user_id, None)
+    await update.message.reply_text(f"✅ Никнейм изменён: {old_pseudonym} → {text}", reply_markup=get_main_keyboard(is_admin))
 
-    if text == "🔗 Инвайт" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "waiting_invite_minutes"})
-        await update.message.reply_text("Введите время действия ссылки в минутах (или 0 для бессрочной):")
-        return
 
-    if text == "⏰ Смена" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "setshift_start"})
-        await update.message.reply_text("Введите час начала смены (0-23, МСК):")
+async def mode_invite_minutes(update, context, bot_token, user_id, is_admin, text, state):
+    try:
+        minutes = int(text)
+    except ValueError:
+        await update.message.reply_text("❌ Введите число!")
         return
+    set_user_state(bot_token, user_id, None)
+    code = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    if minutes > 0:
+        expires_at = time.time() + (minutes * 60)
+    else:
+        expires_at = time.time() + (365 * 24 * 60 * 60)
+    invite_links[code] = {"bot_token": bot_token, "expires_at": expires_at, "used": False}
+    db_add_invite(code, bot_token, expires_at, False)
+    bot_username = context.bot.username
+    link = f"https://t.me/{bot_username}?start={code}"
+    await update.message.reply_text(f"🔗 Ссылка-приглашение:\n{link}", reply_markup=get_main_keyboard(is_admin))
 
-    if text == "📝 Изм. реквизиты" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "waiting_requisites"})
-        await update.message.reply_text("📋 Отправьте новые реквизиты (текст или фото с подписью):")
-        return
 
-    if text == "👑 Назначить админа" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "waiting_op_id"})
-        await update.message.reply_text("Введите ID пользователя для назначения админом:")
+async def mode_op(update, context, bot_token, user_id, is_admin, text, state):
+    try:
+        target_id = int(text)
+    except ValueError:
+        await update.message.reply_text("❌ ID должен быть числом")
         return
-
-    if text == "🚫 Снять админа" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "waiting_deop_id"})
-        await update.message.reply_text("Введите ID пользователя для снятия прав админа:")
+    set_user_state(bot_token, user_id, None)
+    if target_id not in user_pseudonyms.get(bot_token, {}):
+        await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
         return
-
-    if text == "👢 Кикнуть" and is_admin:
-        set_user_state(bot_token, user_id, {"mode": "waiting_kick_id"})
-        await update.message.reply_text("Введите ID пользователя для исключения:")
+    if is_chat_admin(bot_token, target_id):
+        await update.message.reply_text("ℹ️ Этот пользователь уже является админом", reply_markup=get_main_keyboard(is_admin))
         return
+    if bot_token not in bot_chat_admins:
+        bot_chat_admins[bot_token] = set()
+    bot_chat_admins[bot_token].add(target_id)
+    db_add_chat_admin(bot_token, target_id)
+    target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
+    await update.message.reply_text(f"✅ {target_name} назначен админом", reply_markup=get_main_keyboard(is_admin))
 
-    if text == "🔔 Уведомления чеков" and is_admin:
-        watchers = receipt_watchers.get(bot_token, set())
-        watcher_names = []
-        for wid in watchers:
-            name = user_pseudonyms.get(bot_token, {}).get(wid, str(wid))
-            watcher_names.append(f"  • {name} (ID: {wid})")
-        watcher_list = "\n".join(watcher_names) if watcher_names else "  Пока никого"
-        set_user_state(bot_token, user_id, {"mode": "waiting_watcher_action"})
-        await update.message.reply_text(
-            f"🔔 Уведомления о чеках\n\n"
-            f"Уведомления получают:\n"
-            f"  • Автор чека (всегда)\n"
-            f"{watcher_list}\n\n"
-            f"Отправьте ID пользователя чтобы добавить/убрать из списка,\n"
-            f"или напишите «отмена» для выхода.",
-            reply_markup=get_main_keyboard(is_admin)
-        )
-        return
 
-    if text == "📋 Лист участников" and is_admin:
-        users = user_pseudonyms.get(bot_token, {})
-        if not users:
-            await update.message.reply_text("📋 Участников пока нет", reply_markup=get_main_keyboard(is_admin))
-            return
-        lines = ["📋 Участники чата:\n"]
-        for uid, pseudonym_name in users.items():
-            admin_mark = " 👑" if is_chat_admin(bot_token, uid) else ""
-            lines.append(f"  • {pseudonym_name} | ID: <code>{uid}</code>{admin_mark}")
-        lines.append(f"\nВсего: {len(users)}")
-        await update.message.reply_text("\n".join(lines), reply_markup=get_main_keyboard(is_admin), parse_mode="HTML")
+async def mode_deop(update, context, bot_token, user_id, is_admin, text, state):
+    try:
+        target_id = int(text)
+    except ValueError:
+        await update.message.reply_text("❌ ID должен быть числом")
         return
+    set_user_state(bot_token, user_id, None)
+    if bot_token in bot_admins and bot_admins[bot_token] == target_id:
+        await update.message.reply_text("❌ Нельзя снять права создателя чата", reply_markup=get_main_keyboard(is_admin))
+        return
+    if target_id not in bot_chat_admins.get(bot_token, set()):
+        await update.message.reply_text("ℹ️ Этот пользователь не является админом", reply_markup=get_main_keyboard(is_admin))
+        return
+    bot_chat_admins[bot_token].discard(target_id)
+    db_remove_chat_admin(bot_token, target_id)
+    target_name = user_pseudonyms.get(bot_token, {}).get(target_id, str(target_id))
+    await update.message.reply_text(f"✅ {target_name} больше не админ", reply_markup=get_main_keyboard(is_admin))
 
-    state = get_user_state(bot_token, user_id)
 
-    if state and state.get("mode") == "waiting_new_name":
-        old_pseudonym = user_pseudonyms[bot_token][user_id]
-        user_pseudonyms[bot_token][user_id] = text
-        db_update_pseudonym(bot_token, user_id, text)
-        set_user_state(bot_token, user_id, None)
-        await update.message.reply_text(f"✅ Никнейм изменён: {old_pseudonym} → {text}", reply_markup=get_main_keyboard(is_admin))
+async def mode_kick(update, context, bot_token, user_id, is_admin, text, state):
+    try:
+        target_id = int(text)
+    except ValueError:
+        await update.message.reply_text("❌ ID должен быть числом")
         return
-
-    if state and state.get("mode") == "waiting_invite_minutes":
-        try:
-            minutes = int(text)
-        except ValueError:
-            await update.message.reply_text("❌ Введите число!")
-            return
-        set_user_state(bot_token, user_id, None)
-        code = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-        if minutes > 0:
-            expires_at = time.time() + (minutes * 60)
-        else:
-            expires_at = time.time() + (365 * 24 * 60 * 60)
-        invite_links[code] = {"bot_token": bot_token, "expires_at": expires_at, "used": False}
-        db_add_invite(code, bot_token, expires_at, False)
-        bot_username = context.bot.username
-        link = f"https://t.me/{bot_username}?start={code}"
-        await update.message.reply_text(f"🔗 Ссылка-приглашение:\n{link}", reply_markup=get_main_keyboard(is_admin))
+    set_user_state(bot_token, user_id, None)
+    if bot_token in bot_admins and bot_admins[bot_token] == target_id:
+        await update.message.reply_text("❌ Нельзя кикнуть создателя чата", reply_markup=get_main_keyboard(is_admin))
         return
-
-    if state and state.get("mode") == "waiting_op_id":
-        try:
-            target_id = int(text)
-        except ValueError:
-            await update.message.reply_text("❌ ID должен быть числом")
-            return
-        set_user_state(bot_token, user_id, None)
-        if target_id not in user_pseudonyms.get(bot_token, {}):
-            await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
-            return
-        if is_chat_admin(bot_token, target_id):
-            await update.message.reply_text("ℹ️ Этот пользователь уже является админом", reply_markup=get_main_keyboard(is_admin))
-            return
-        if bot_token not in bot_chat_admins:
-            bot_chat_admins[bot_token] = set()
-        bot_chat_admins[bot_token].add(target_id)
-        db_add_chat_admin(bot_token, target_id)
-        target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
-        await update.message.reply_text(f"✅ {target_name} назначен админом", reply_markup=get_main_keyboard(is_admin))
+    if target_id not in user_pseudonyms.get(bot_token, {}):
+        await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
         return
-
-    if state and state.get("mode") == "waiting_deop_id":
-        try:
-            target_id = int(text)
-        except ValueError:
-            await update.message.reply_text("❌ ID должен быть числом")
-            return
-        set_user_state(bot_token, user_id, None)
-        if bot_token in bot_admins and bot_admins[bot_token] == target_id:
-            await update.message.reply_text("❌ Нельзя снять права создателя чата", reply_markup=get_main_keyboard(is_admin))
-            return
-        if target_id not in bot_chat_admins.get(bot_token, set()):
-            await update.message.reply_text("ℹ️ Этот пользователь не является админом", reply_markup=get_main_keyboard(is_admin))
-            return
+    target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
+    del user_pseudonyms[bot_token][target_id]
+    db_remove_pseudonym(bot_token, target_id)
+    if target_id in bot_chat_admins.get(bot_token, set()):
         bot_chat_admins[bot_token].discard(target_id)
         db_remove_chat_admin(bot_token, target_id)
-        target_name = user_pseudonyms.get(bot_token, {}).get(target_id, str(target_id))
-        await update.message.reply_text(f"✅ {target_name} больше не админ", reply_markup=get_main_keyboard(is_admin))
-        return
+    if bot_token not in banned_users:
+        banned_users[bot_token] = set()
+    banned_users[bot_token].add(target_id)
+    db_ban_user(bot_token, target_id)
+    try:
+        await context.bot.send_message(chat_id=target_id, text="❌ Вы были исключены из этого чата")
+    except Exception:
+        pass
+    await update.message.reply_text(f"✅ {target_name} был исключён и заблокирован", reply_markup=get_main_keyboard(is_admin))
 
-    if state and state.get("mode") == "waiting_kick_id":
-        try:
-            target_id = int(text)
-        except ValueError:
-            await update.message.reply_text("❌ ID должен быть числом")
-            return
-        set_user_state(bot_token, user_id, None)
-        if bot_token in bot_admins and bot_admins[bot_token] == target_id:
-            await update.message.reply_text("❌ Нельзя кикнуть создателя чата", reply_markup=get_main_keyboard(is_admin))
-            return
-        if target_id not in user_pseudonyms.get(bot_token, {}):
-            await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
-            return
-        target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
-        del user_pseudonyms[bot_token][target_id]
-        db_remove_pseudonym(bot_token, target_id)
-        if target_id in bot_chat_admins.get(bot_token, set()):
-            bot_chat_admins[bot_token].discard(target_id)
-            db_remove_chat_admin(bot_token, target_id)
-        if bot_token not in banned_users:
-            banned_users[bot_token] = set()
-        banned_users[bot_token].add(target_id)
-        db_ban_user(bot_token, target_id)
-        try:
-            await context.bot.send_message(chat_id=target_id, text="❌ Вы были исключены из этого чата")
-        except Exception:
-            pass
-        await update.message.reply_text(f"✅ {target_name} был исключён и заблокирован", reply_markup=get_main_keyboard(is_admin))
-        return
 
-    if state and state.get("mode") == "waiting_watcher_action":
-        if text.lower() in ("отмена", "cancel"):
-            set_user_state(bot_token, user_id, None)
-            await update.message.reply_text("✅ Готово", reply_markup=get_main_keyboard(is_admin))
-            return
-        try:
-            target_id = int(text)
-        except ValueError:
-            await update.message.reply_text("❌ Введите ID (число) или «отмена»")
-            return
-        if target_id not in user_pseudonyms.get(bot_token, {}):
-            await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
-            set_user_state(bot_token, user_id, None)
-            return
-        target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
-        if bot_token not in receipt_watchers:
-            receipt_watchers[bot_token] = set()
-        if target_id in receipt_watchers[bot_token]:
-            receipt_watchers[bot_token].discard(target_id)
-            db_remove_receipt_watcher(bot_token, target_id)
-            await update.message.reply_text(f"🔕 {target_name} убран из уведомлений о чеках", reply_markup=get_main_keyboard(is_admin))
-        else:
-            receipt_watchers[bot_token].add(target_id)
-            db_add_receipt_watcher(bot_token, target_id)
-            await update.message.reply_text(f"🔔 {target_name} добавлен в уведомления о чеках", reply_markup=get_main_keyboard(is_admin))
+async def mode_watcher_action(update, context, bot_token, user_id, is_admin, text, state):
+    if text.lower() in ("отмена", "cancel"):
         set_user_state(bot_token, user_id, None)
+        await update.message.reply_text("✅ Готово", reply_markup=get_main_keyboard(is_admin))
         return
-
-    if state and state.get("mode") == "waiting_requisites":
-        bot_requisites[bot_token] = {"text": text, "photo_id": None}
-        db_save_requisites(bot_token, text, None)
-        set_user_state(bot_token, user_id, None)
-        await update.message.reply_text("✅ Реквизиты обновлены!", reply_markup=get_main_keyboard(is_admin))
-        for uid in user_pseudonyms[bot_token].keys():
-            if uid != user_id:
-                try:
-                    await context.bot.send_message(chat_id=uid, text="📋 Реквизиты были обновлены")
-                except Exception:
-                    pass
+    try:
+        target_id = int(text)
+    except ValueError:
+        await update.message.reply_text("❌ Введите ID (число) или «отмена»")
         return
-
-    if state and state.get("mode") in ("setshift_start", "setshift_end"):
-        await handle_setshift_flow(update, context, bot_token, user_id, state, text)
+    if target_id not in user_pseudonyms.get(bot_token, {}):
+        await update.message.reply_text("❌ Пользователь не найден в этом чате", reply_markup=get_main_keyboard(is_admin))
+        set_user_state(bot_token, user_id, None)
         return
+    target_name = user_pseudonyms[bot_token].get(target_id, str(target_id))
+    if bot_token not in receipt_watchers:
+        receipt_watchers[bot_token] = set()
+    if target_id in receipt_watchers[bot_token]:
+        receipt_watchers[bot_token].discard(target_id)
+        db_remove_receipt_watcher(bot_token, target_id)
+        await update.message.reply_text(f"🔕 {target_name} убран из уведомлений о чеках", reply_markup=get_main_keyboard(is_admin))
+    else:
+        receipt_watchers[bot_token].add(target_id)
+        db_add_receipt_watcher(bot_token, target_id)
+        await update.message.reply_text(f"🔔 {target_name} добавлен в уведомления о чеках", reply_markup=get_main_keyboard(is_admin))
+    set_user_state(bot_token, user_id, None)
 
-    if state and state.get("mode") == "waiting_edit_amount":
-        clean_text = text.strip().replace(',', '.')
-        try:
-            new_amount = float(clean_text)
-        except ValueError:
-            await update.message.reply_text("❌ Неверный формат! Введите число (например 100 или 100.50)")
-            return
-
-        receipt_id = state.get("receipt_id")
-        if receipt_id not in receipts:
-            await update.message.reply_text("❌ Чек не найден")
-            set_user_state(bot_token, user_id, None)
-            return
-
-        receipt_data = receipts[receipt_id]
-        old_amount = receipt_data.get("amount")
-        currency = receipt_data.get("currency") or get_bot_currency(bot_token)
-        editor_name = user_pseudonyms.get(bot_token, {}).get(user_id, "Неизвестный")
 
-        bot_app = None
-        for cid, bot_info in created_bots.items():
-            if bot_info["token"] == receipt_data.get("bot_token"):
-                bot_app = bot_info["application"]
-                break
-        bot_to_use = bot_app.bot if bot_app else context.bot
-        bot_username = bot_to_use.username if hasattr(bot_to_use, 'username') else "unknown"
+async def mode_requisites(update, context, bot_token, user_id, is_admin, text, state):
+    bot_requisites[bot_token] = {"text": text, "photo_id": None}
+    db_save_requisites(bot_token, text, None)
+    set_user_state(bot_token, user_id, None)
+    await update.message.reply_text("✅ Реквизиты обновлены!", reply_markup=get_main_keyboard(is_admin))
+    for uid in user_pseudonyms[bot_token].keys():
+        if uid != user_id:
+            try:
+                await context.bot.send_message(chat_id=uid, text="📋 Реквизиты были обновлены")
+            except Exception:
+                pass
 
-        update_receipt_in_sheet(bot_username, old_amount, new_amount, receipt_data["pseudonym"])
 
-        if is_working_hours(bot_token):
-            diff = new_amount - old_amount
-            if diff > 0:
-                db_add_daily_total(bot_token, diff)
-            elif diff < 0:
-                db_subtract_daily_total(bot_token, abs(diff))
+async def mode_setshift(update, context, bot_token, user_id, is_admin, text, state):
+    await handle_setshift_flow(update, context, bot_token, user_id, state, text)
 
-        receipt_data["amount"] = new_amount
-        receipt_data["text"] = f"{format_amount(new_amount)} {currency}"
-        receipt_data["edited_by"] = editor_name
 
-        if is_working_hours(bot_token):
-            daily_total = db_get_daily_total(bot_token)
-            daily_line = f"\nИтого за смену: {format_amount(daily_total)} {currency}"
-        else:
-            shift = bot_shifts.get(bot_token, {"start": 0, "end": 23})
-            daily_line = f"\nНерабочее время (смена: {shift['start']}:00–{shift['end']}:00 МСК)"
+async def mode_edit_amount(update, context, bot_token, user_id, is_admin, text, state):
+    clean_text = text.strip().replace(',', '.')
+    try:
+        new_amount = float(clean_text)
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат! Введите число (например 100 или 100.50)")
+        return
 
-        status_text = f"Статус: Принят ✅\nИзменён: {editor_name} ({format_amount(old_amount)} → {format_amount(new_amount)})"
+    receipt_id = state.get("receipt_id")
+    if receipt_id not in receipts:
+        await update.message.reply_text("❌ Чек не найден")
+        set_user_state(bot_token, user_id, None)
+        return
 
-        action_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✏️ Изменить", callback_data=f"receipt_edit_{receipt_id}")],
-            [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
-        ])
+    receipt_data = receipts[receipt_id]
+    old_amount = receipt_data.get("amount")
+    currency = receipt_data.get("currency") or get_bot_currency(bot_token)
+    editor_name = user_pseudonyms.get(bot_token, {}).get(user_id, "Неизвестный")
 
-        comments_text = ""
-        if receipt_data.get("comments"):
-            comments_text = "\n\n💬 Комментарии:"
-            for c in receipt_data["comments"]:
-                comments_text += f"\n{c['pseudonym']}: {c['text']}"
+    bot_app = None
+    for cid, bot_info in created_bots.items():
+        if bot_info["token"] == receipt_data.get("bot_token"):
+            bot_app = bot_info["application"]
+            break
+    bot_to_use = bot_app.bot if bot_app else context.bot
+    bot_username = bot_to_use.username if hasattr(bot_to_use, 'username') else "unknown"
 
-        if "message_ids" in receipt_data:
-            for uid, msg_id in receipt_data["message_ids"].items():
-                try:
-                    if "photo_id" in receipt_data or "document_id" in receipt_data:
-                        new_caption = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
-                        await bot_to_use.edit_message_caption(
-                            chat_id=uid,
-                            message_id=msg_id,
-                            caption=new_caption,
-                            reply_markup=action_markup
-                        )
-                    else:
-                        new_text = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
-                        await bot_to_use.edit_message_text(
-                            chat_id=uid,
-                            message_id=msg_id,
-                            text=new_text,
-                            reply_markup=action_markup
-                        )
-                except Exception as e:
-                    logger.error(f"Error updating edited receipt for {uid}: {e}")
+    await wait_for_sheets()
+    update_receipt_in_sheet(bot_username, old_amount, new_amount, receipt_data["pseudonym"], receipt_data.get("sheet_period"))
+    db_update_receipt_amount(receipt_id, new_amount, editor_name)
 
-        set_user_state(bot_token, user_id, None)
-        await update.message.reply_text(f"✅ Сумма чека изменена: {format_amount(old_amount)} → {format_amount(new_amount)} {currency}")
-        logger.info(f"Receipt {receipt_id} edited by {editor_name}: {old_amount} -> {new_amount}")
-        return
+    if is_working_hours(bot_token):
+        diff = new_amount - old_amount
+        if diff > 0:
+            db_add_daily_total(bot_token, diff, receipt_id)
+        elif diff < 0:
+            db_subtract_daily_total(bot_token, abs(diff), receipt_id)
 
-    if state and state.get("mode") == "waiting_receipt_comment":
-        receipt_id = state.get("receipt_id")
-        if receipt_id not in receipts:
-            await update.message.reply_text("❌ Чек не найден")
-            set_user_state(bot_token, user_id, None)
-            return
+    receipt_data["amount"] = new_amount
+    receipt_data["text"] = f"{format_amount(new_amount)} {currency}"
+    receipt_data["edited_by"] = editor_name
 
-        receipt_data = receipts[receipt_id]
-        commenter_name = user_pseudonyms.get(bot_token, {}).get(user_id, "Неизвестный")
+    if is_working_hours(bot_token):
+        daily_total = db_get_daily_total(bot_token)
+        daily_line = f"\nИтого за смену: {format_amount(daily_total)} {currency}"
+    else:
+        shift = bot_shifts.get(bot_token, {"start": 0, "end": 23})
+        daily_line = f"\nНерабочее время (смена: {shift['start']}:00–{shift['end']}:00 МСК)"
 
-        if "comments" not in receipt_data:
-            receipt_data["comments"] = []
-        receipt_data["comments"].append({"pseudonym": commenter_name, "text": text})
+    status_text = f"Статус: Принят ✅\nИзменён: {editor_name} ({format_amount(old_amount)} → {format_amount(new_amount)})"
 
-        bot_app = None
-        for cid, bot_info in created_bots.items():
-            if bot_info["token"] == receipt_data.get("bot_token"):
-                bot_app = bot_info["application"]
-                break
-        bot_to_use = bot_app.bot if bot_app else context.bot
+    action_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✏️ Изменить", callback_data=f"receipt_edit_{receipt_id}")],
+        [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
+    ])
 
-        status = receipt_data.get("status", "pending")
-        status_map = {"pending": "Статус: Ожидание", "approved": "Статус: Принят ✅", "declined": "Статус: Отклонён ❌"}
-        status_text = status_map.get(status, "Статус: Ожидание")
+    comments_text = render_receipt_comments(receipt_data.get("comments"))
 
-        if receipt_data.get("edited_by"):
-            old_amount = receipt_data.get("amount")
-            status_text += f"\nИзменён: {receipt_data['edited_by']}"
+    if "message_ids" in receipt_data:
+        for uid, msg_id in receipt_data["message_ids"].items():
+            try:
+                if "photo_id" in receipt_data or "document_id" in receipt_data:
+                    new_caption = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
+                    await bot_to_use.edit_message_caption(
+                        chat_id=uid,
+                        message_id=msg_id,
+                        caption=new_caption,
+                        reply_markup=action_markup
+                    )
+                else:
+                    new_text = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
+                    await bot_to_use.edit_message_text(
+                        chat_id=uid,
+                        message_id=msg_id,
+                        text=new_text,
+                        reply_markup=action_markup
+                    )
+            except Exception as e:
+                logger.error("Error updating edited receipt for %s: %s", uid, e)
 
-        currency = receipt_data.get("currency") or get_bot_currency(bot_token)
-        if is_working_hours(bot_token):
-            daily_total = db_get_daily_total(bot_token)
-            daily_line = f"\nИтого за смену: {format_amount(daily_total)} {currency}"
-        else:
-            shift = bot_shifts.get(bot_token, {"start": 0, "end": 23})
-            daily_line = f"\nНерабочее время (смена: {shift['start']}:00–{shift['end']}:00 МСК)"
-
-        comments_text = "\n\n💬 Комментарии:"
-        for c in receipt_data["comments"]:
-            comments_text += f"\n{c['pseudonym']}: {c['text']}"
-
-        comment_btn = [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
-        if status == "pending":
-            action_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Принять", callback_data=f"receipt_approve_{receipt_id}")],
-                [InlineKeyboardButton("❌ Отклонить", callback_data=f"receipt_decline_{receipt_id}")],
-                comment_btn
-            ])
-        elif status == "approved":
-            action_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✏️ Изменить", callback_data=f"receipt_edit_{receipt_id}")],
-                comment_btn
-            ])
-        elif status == "declined":
-            action_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton("↩️ Назад", callback_data=f"receipt_undo_{receipt_id}")],
-                comment_btn
-            ])
-        else:
-            action_markup = InlineKeyboardMarkup([comment_btn])
+    set_user_state(bot_token, user_id, None)
+    await update.message.reply_text(f"✅ Сумма чека изменена: {format_amount(old_amount)} → {format_amount(new_amount)} {currency}")
+    logger.info("Receipt %s edited by %s: %s -> %s", receipt_id, editor_name, old_amount, new_amount)
 
-        if "message_ids" in receipt_data:
-            for uid, msg_id in receipt_data["message_ids"].items():
-                try:
-                    if "photo_id" in receipt_data or "document_id" in receipt_data:
-                        new_caption = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
-                        await bot_to_use.edit_message_caption(
-                            chat_id=uid,
-                            message_id=msg_id,
-                            caption=new_caption,
-                            reply_markup=action_markup
-                        )
-                    else:
-                        new_text = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
-                        await bot_to_use.edit_message_text(
-                            chat_id=uid,
-                            message_id=msg_id,
-                            text=new_text,
-                            reply_markup=action_markup
-                        )
-                except Exception as e:
-                    logger.error(f"Error updating receipt comment for {uid}: {e}")
 
+async def mode_receipt_comment(update, context, bot_token, user_id, is_admin, text, state):
+    receipt_id = state.get("receipt_id")
+    if receipt_id not in receipts:
+        await update.message.reply_text("❌ Чек не найден")
         set_user_state(bot_token, user_id, None)
-        await update.message.reply_text("✅ Комментарий добавлен", reply_markup=get_main_keyboard(is_admin))
         return
 
-    if state and state.get("mode") == "waiting_amount":
-        clean_text = text.strip().replace(',', '.')
-        try:
-            amount = float(clean_text)
-        except ValueError:
-            await update.message.reply_text("❌ Неверный формат! Введите число (например 100 или 100.50)")
-            return
+    receipt_data = receipts[receipt_id]
+    commenter_name = user_pseudonyms.get(bot_token, {}).get(user_id, "Неизвестный")
 
-        currency = get_bot_currency(bot_token)
-        photo_id = state.get("photo_id")
-        document_id = state.get("document_id")
-        saved_reply_msg_id = state.get("reply_msg_id")
-        pseudonym = user_pseudonyms[bot_token][user_id]
-        receipt_text = f"{format_amount(amount)} {currency}"
+    if "comments" not in receipt_data:
+        receipt_data["comments"] = []
+    receipt_data["comments"].append({"pseudonym": commenter_name, "text": text})
+    db_update_receipt_comments(receipt_id, receipt_data["comments"])
 
-        set_user_state(bot_token, user_id, None)
+    bot_app = None
+    for cid, bot_info in created_bots.items():
+        if bot_info["token"] == receipt_data.get("bot_token"):
+            bot_app = bot_info["application"]
+            break
+    bot_to_use = bot_app.bot if bot_app else context.bot
 
-        receipt_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    status = receipt_data.get("status", "pending")
+    status_map = {"pending": "Статус: Ожидание", "approved": "Статус: Принят ✅", "declined": "Статус: Отклонён ❌"}
+    status_text = status_map.get(status, "Статус: Ожидание")
 
-        keyboard = [
-            [InlineKeyboardButton("✅ Принять", callback_data=f"receipt_approve_{receipt_id}")],
-            [InlineKeyboardButton("❌ Отклонить", callback_data=f"receipt_decline_{receipt_id}")],
-            [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if receipt_data.get("edited_by"):
+        old_amount = receipt_data.get("amount")
+        status_text += f"\nИзменён: {receipt_data['edited_by']}"
 
-        receipt_data = {
-            "text": receipt_text,
-            "status": "pending",
-            "pseudonym": pseudonym,
-            "bot_token": bot_token,
-            "amount": amount,
-            "currency": currency,
-            "owner_id": user_id,
-            "created_at": get_moscow_now().strftime("%H:%M"),
-        }
-        if photo_id:
-            receipt_data["photo_id"] = photo_id
-        if document_id:
-            receipt_data["document_id"] = document_id
+    currency = receipt_data.get("currency") or get_bot_currency(bot_token)
+    if is_working_hours(bot_token):
+        daily_total = db_get_daily_total(bot_token)
+        daily_line = f"\nИтого за смену: {format_amount(daily_total)} {currency}"
+    else:
+        shift = bot_shifts.get(bot_token, {"start": 0, "end": 23})
+        daily_line = f"\nНерабочее время (смена: {shift['start']}:00–{shift['end']}:00 МСК)"
 
-        receipts[receipt_id] = receipt_data
+    comments_text = render_receipt_comments(receipt_data["comments"])
 
-        if bot_token not in message_map:
-            message_map[bot_token] = {}
+    action_markup = receipt_markup(receipt_id, status)
 
-        for uid in user_pseudonyms[bot_token].keys():
+    if "message_ids" in receipt_data:
+        for uid, msg_id in receipt_data["message_ids"].items():
             try:
-                target_reply_id = resolve_reply_target(bot_token, user_id, saved_reply_msg_id, uid) if saved_reply_msg_id else None
-                caption = f"{pseudonym}: {receipt_text}\n\nНовый чек\nСтатус: Ожидание"
-                if photo_id:
-                    sent = await context.bot.send_photo(
+                if "photo_id" in receipt_data or "document_id" in receipt_data:
+                    new_caption = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
+                    await bot_to_use.edit_message_caption(
                         chat_id=uid,
-                        photo=photo_id,
-                        caption=caption,
-                        reply_markup=reply_markup,
-                        reply_to_message_id=target_reply_id,
-                        allow_sending_without_reply=True
+                        message_id=msg_id,
+                        caption=new_caption,
+                        reply_markup=action_markup
                     )
-                elif document_id:
-                    sent = await context.bot.send_document(
+                else:
+                    new_text = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
+                    await bot_to_use.edit_message_text(
                         chat_id=uid,
-                        document=document_id,
-                        caption=caption,
-                        reply_markup=reply_markup,
-                        reply_to_message_id=target_reply_id,
-                        allow_sending_without_reply=True
+                        message_id=msg_id,
+                        text=new_text,
+                        reply_markup=action_markup
                     )
-                else:
-                    continue
-                if "message_ids" not in receipts[receipt_id]:
-                    receipts[receipt_id]["message_ids"] = {}
-                receipts[receipt_id]["message_ids"][uid] = sent.message_id
-                message_map[bot_token][(uid, sent.message_id)] = {
-                    "pseudonym": pseudonym,
-                    "text": f"Чек: {receipt_text}",
-                    "sender_id": user_id,
-                    "receipt_id": receipt_id
-                }
             except Exception as e:
-                logger.error(f"Error sending receipt to {uid}: {e}")
+                logger.error("Error updating receipt comment for %s: %s", uid, e)
+
+    set_user_state(bot_token, user_id, None)
+    await update.message.reply_text("✅ Комментарий добавлен", reply_markup=get_main_keyboard(is_admin))
 
-        file_type = "PDF" if document_id else "photo"
-        logger.info(f"Receipt created ({file_type}): {receipt_id} - {amount} {currency} by {pseudonym}")
+
+async def mode_amount(update, context, bot_token, user_id, is_admin, text, state):
+    entry_started = time.perf_counter()
+    clean_text = text.strip().replace(',', '.')
+    try:
+        amount = float(clean_text)
+    except ValueError:
+        await update.message.reply_text("❌ Неверный формат! Введите число (например 100 или 100.50)")
         return
 
+    currency = get_bot_currency(bot_token)
+    photo_id = state.get("photo_id")
+    document_id = state.get("document_id")
+    saved_reply_msg_id = state.get("reply_msg_id")
     pseudonym = user_pseudonyms[bot_token][user_id]
+    receipt_text = f"{format_amount(amount)} {currency}"
 
-    if update.message.reply_to_message and text.lower() in ("удалить", "/удалить", "/delete", "delete"):
-        reply_msg_id = update.message.reply_to_message.message_id
-        original = message_map.get(bot_token, {}).get((user_id, reply_msg_id))
-        if original:
-            if original.get("sender_id") == user_id or is_chat_admin(bot_token, user_id):
-                deleted_count = 0
-                if "sent_to" in original:
-                    for uid, msg_id in original["sent_to"].items():
+    set_user_state(bot_token, user_id, None)
+
+    receipt_id = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+    start_receipt_trace(receipt_id, bot_token, state.get("upload"))
+
+    keyboard = [
+        [InlineKeyboardButton("✅ Принять", callback_data=f"receipt_approve_{receipt_id}")],
+        [InlineKeyboardButton("❌ Отклонить", callback_data=f"receipt_decline_{receipt_id}")],
+        [InlineKeyboardButton("💬 Комментарий", callback_data=f"receipt_comment_{receipt_id}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    receipt_data = {
+        "text": receipt_text,
+        "status": "pending",
+        "pseudonym": pseudonym,
+        "bot_token": bot_token,
+        "amount": amount,
+        "currency": currency,
+        "owner_id": user_id,
+        "created_at": get_moscow_now().strftime("%H:%M"),
+        "created_ts": time.time(),
+    }
+    if photo_id:
+        receipt_data["photo_id"] = photo_id
+    if document_id:
+        receipt_data["document_id"] = document_id
+
+    receipts[receipt_id] = receipt_data
+    index_receipt(receipt_id, receipt_data)
+    db_started = time.perf_counter()
+    db_add_receipt(receipt_id, receipt_data)
+    add_receipt_span(receipt_id, "db_insert", db_started)
+    add_receipt_span(receipt_id, "amount_entry", entry_started)
+
+    if bot_token not in message_map:
+        message_map[bot_token] = {}
+
+    fanout_started = time.perf_counter()
+    for uid in user_pseudonyms[bot_token].keys():
+        send_started = time.perf_counter()
+        try:
+            target_reply_id = resolve_reply_target(bot_token, user_id, saved_reply_msg_id, uid) if saved_reply_msg_id else None
+            caption = f"{pseudonym}: {receipt_text}\n\nНовый чек\nСтатус: Ожидание"
+            if photo_id:
+                sent = await context.bot.send_photo(
+                    chat_id=uid,
+                    photo=photo_id,
+                    caption=caption,
+                    reply_markup=reply_markup,
+                    reply_to_message_id=target_reply_id,
+                    allow_sending_without_reply=True
+                )
+            elif document_id:
+                sent = await context.bot.send_document(
+                    chat_id=uid,
+                    document=document_id,
+                    caption=caption,
+                    reply_markup=reply_markup,
+                    reply_to_message_id=target_reply_id,
+                    allow_sending_without_reply=True
+                )
+            else:
+                continue
+            if "message_ids" not in receipts[receipt_id]:
+                receipts[receipt_id]["message_ids"] = {}
+            receipts[receipt_id]["message_ids"][uid] = sent.message_id
+            message_map[bot_token][(uid, sent.message_id)] = {
+                "pseudonym": pseudonym,
+                "text": f"Чек: {receipt_text}",
+                "sender_id": user_id,
+                "receipt_id": receipt_id
+            }
+            add_receipt_span(receipt_id, "send", send_started, uid=uid)
+        except Exception as e:
+            logger.error("Error sending receipt to %s: %s", uid, e)
+            add_receipt_span(receipt_id, "send", send_started, uid=uid, error=type(e).__name__)
+    record_fanout("receipt", fanout_started)
+    add_receipt_span(receipt_id, "fanout", fanout_started)
+    persist_receipt_messages(bot_token, receipt_id)
+
+    file_type = "PDF" if document_id else "photo"
+    logger.info("Receipt created (%s): %s - %s %s by %s", file_type, receipt_id, amount, currency, pseudonym)
+
+
+SECRET_CHAT_BUTTONS = {
+    "📷 Отправить фото": (button_send_photo, False),
+    "📋 Реквизиты": (button_requisites, False),
+    "✏️ Сменить ник": (button_change_name, False),
+    "🔗 Инвайт": (button_invite, True),
+    "⏰ Смена": (button_shift, True),
+    "📝 Изм. реквизиты": (button_edit_requisites, True),
+    "👑 Назначить админа": (button_op, True),
+    "🚫 Снять админа": (button_deop, True),
+    "👢 Кикнуть": (button_kick, True),
+    "🔔 Уведомления чеков": (button_receipt_watchers, True),
+    "📋 Лист участников": (button_members, True),
+    "📊 Отчёт": (button_report, True),
+    "⏳ Ожидающие": (button_pending, True),
+}
+
+SECRET_CHAT_MODES = {
+    "waiting_new_name": mode_new_name,
+    "waiting_invite_minutes": mode_invite_minutes,
+    "waiting_op_id": mode_op,
+    "waiting_deop_id": mode_deop,
+    "waiting_kick_id": mode_kick,
+    "waiting_watcher_action": mode_watcher_action,
+    "waiting_requisites": mode_requisites,
+    "setshift_start": mode_setshift,
+    "setshift_end": mode_setshift,
+    "waiting_edit_amount": mode_edit_amount,
+    "waiting_receipt_comment": mode_receipt_comment,
+    "waiting_amount": mode_amount,
+}
+
+DELETE_COMMANDS = {"удалить", "/удалить", "/delete", "delete"}
+
+
+def resolve_secret_chat_route(bot_token, user_id, text):
+    route = SECRET_CHAT_BUTTONS.get(text)
+    if route and (not route[1] or is_chat_admin(bot_token, user_id)):
+        return route[0], None
+    state = get_user_state(bot_token, user_id)
+    if state:
+        handler = SECRET_CHAT_MODES.get(state.get("mode"))
+        if handler:
+            return handler, state
+    return None, None
+
+
+async def delete_relayed_message(update, context, bot_token, user_id):
+    reply_msg_id = update.message.reply_to_message.message_id
+    original = message_map.get(bot_token, {}).get((user_id, reply_msg_id))
+    if original:
+        if original.get("sender_id") == user_id or is_chat_admin(bot_token, user_id):
+            deleted_count = 0
+            if "sent_to" in original:
+                for uid, msg_id in original["sent_to"].items():
+                    try:
+                        await context.bot.delete_message(chat_id=uid, message_id=msg_id)
+                        deleted_count += 1
+                    except Exception as e:
+                        logger.error("Error deleting message for %s: %s", uid, e)
+                try:
+                    await context.bot.delete_message(chat_id=user_id, message_id=reply_msg_id)
+                    deleted_count += 1
+                except Exception:
+                    pass
+            elif "sender_msg_id" in original:
+                sender_id = original["sender_id"]
+                sender_msg_id = original["sender_msg_id"]
+                sender_original = message_map.get(bot_token, {}).get((sender_id, sender_msg_id))
+                if sender_original and "sent_to" in sender_original:
+                    for uid, msg_id in sender_original["sent_to"].items():
                         try:
                             await context.bot.delete_message(chat_id=uid, message_id=msg_id)
                             deleted_count += 1
                         except Exception as e:
-                            logger.error(f"Error deleting message for {uid}: {e}")
+                            logger.error("Error deleting message for %s: %s", uid, e)
                     try:
-                        await context.bot.delete_message(chat_id=user_id, message_id=reply_msg_id)
+                        await context.bot.delete_message(chat_id=sender_id, message_id=sender_msg_id)
                         deleted_count += 1
                     except Exception:
                         pass
-                elif "sender_msg_id" in original:
-                    sender_id = original["sender_id"]
-                    sender_msg_id = original["sender_msg_id"]
-                    sender_original = message_map.get(bot_token, {}).get((sender_id, sender_msg_id))
-                    if sender_original and "sent_to" in sender_original:
-                        for uid, msg_id in sender_original["sent_to"].items():
-                            try:
-                                await context.bot.delete_message(chat_id=uid, message_id=msg_id)
-                                deleted_count += 1
-                            except Exception as e:
-                                logger.error(f"Error deleting message for {uid}: {e}")
-                        try:
-                            await context.bot.delete_message(chat_id=sender_id, message_id=sender_msg_id)
-                            deleted_count += 1
-                        except Exception:
-                            pass
-                try:
-                    await context.bot.delete_message(chat_id=user_id, message_id=update.message.message_id)
-                except Exception:
-                    pass
-                if deleted_count > 0:
-                    await update.message.reply_text(f"✅ Сообщение удалено у {deleted_count} участников")
-                else:
-                    await update.message.reply_text("❌ Не удалось удалить сообщение")
+            try:
+                await context.bot.delete_message(chat_id=user_id, message_id=update.message.message_id)
+            except Exception:
+                pass
+            if deleted_count > 0:
+                await update.message.reply_text(f"✅ Сообщение удалено у {deleted_count} участников")
             else:
-                await update.message.reply_text("❌ Вы можете удалять только свои сообщения")
-            return
+                await update.message.reply_text("❌ Не удалось удалить сообщение")
         else:
-            await update.message.reply_text("❌ Сообщение не найдено или слишком старое")
-            return
+            await update.message.reply_text("❌ Вы можете удалять только свои сообщения")
+    else:
+        await update.message.reply_text("❌ Сообщение не найдено или слишком старое")
+
+
+async def relay_chat_text(update, context, bot_token, user_id, text):
+    pseudonym = user_pseudonyms[bot_token][user_id]
 
     reply_msg_id = None
     if update.message.reply_to_message:
@@ -1447,6 +4553,7 @@ async def secret_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         "sent_to": {}
     }
 
+    fanout_started = time.perf_counter()
     for uid in user_pseudonyms[bot_token].keys():
         if uid != user_id:
             try:
@@ -1466,7 +4573,46 @@ async def secret_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                     "sender_msg_id": update.message.message_id
                 }
             except Exception as e:
-                logger.error(f"Error sending to {uid}: {e}")
+                logger.error("Error sending to %s: %s", uid, e)
+    record_fanout("message", fanout_started)
+    persist_message_fanout(bot_token, sender_key)
+
+
+async def secret_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    bot_token = context.application.bot.token
+    text = update.message.text
+
+    if user_id in banned_users.get(bot_token, set()):
+        await update.message.reply_text("❌ Вы заблокированы в этом чате")
+        return
+
+    if bot_token not in user_pseudonyms:
+        user_pseudonyms[bot_token] = {}
+
+    if user_id not in user_pseudonyms[bot_token]:
+        user_pseudonyms[bot_token][user_id] = text
+        db_add_pseudonym(bot_token, user_id, text)
+
+        is_admin = is_chat_admin(bot_token, user_id)
+
+        await update.message.reply_text(
+            f"✅ Ваш псевдоним установлен: {text}\n\n"
+            f"Теперь вы можете отправлять сообщения в секретный чат!",
+            reply_markup=get_main_keyboard(is_admin)
+        )
+        return
+
+    handler, state = resolve_secret_chat_route(bot_token, user_id, text)
+    if handler:
+        await handler(update, context, bot_token, user_id, is_chat_admin(bot_token, user_id), text, state)
+        return
+
+    if update.message.reply_to_message and text.lower() in DELETE_COMMANDS:
+        await delete_relayed_message(update, context, bot_token, user_id)
+        return
+
+    await relay_chat_text(update, context, bot_token, user_id, text)
 
 
 async def secret_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1519,6 +4665,7 @@ async def secret_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "sender_msg_id": update.message.message_id,
             "sent_to": {}
         }
+        fanout_started = time.perf_counter()
         for uid in user_pseudonyms[bot_token].keys():
             if uid != user_id:
                 try:
@@ -1539,16 +4686,20 @@ async def secret_chat_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "sender_msg_id": update.message.message_id
                     }
                 except Exception as e:
-                    logger.error(f"Error sending photo to {uid}: {e}")
+                    logger.error("Error sending photo to %s: %s", uid, e)
+        record_fanout("photo", fanout_started)
+        persist_message_fanout(bot_token, (user_id, update.message.message_id))
         await update.message.reply_text("✅ Фото отправлено.", reply_markup=get_main_keyboard(is_admin))
         return
 
+    upload_started = time.perf_counter()
     photo_id = update.message.photo[-1].file_id
     state_data = {"mode": "waiting_amount", "photo_id": photo_id}
     if update.message.reply_to_message:
         state_data["reply_msg_id"] = update.message.reply_to_message.message_id
     set_user_state(bot_token, user_id, state_data)
     await update.message.reply_text("Введите сумму чека (например 100 или 100.50):")
+    state_data["upload"] = make_span(upload_started, kind="photo")
 
 
 async def secret_chat_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1571,12 +4722,14 @@ async def secret_chat_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.document and update.message.document.mime_type:
         mime = update.message.document.mime_type
         if mime == "application/pdf" or mime.startswith("image/"):
+            upload_started = time.perf_counter()
             doc_id = update.message.document.file_id
             state_data = {"mode": "waiting_amount", "document_id": doc_id}
             if update.message.reply_to_message:
                 state_data["reply_msg_id"] = update.message.reply_to_message.message_id
             set_user_state(bot_token, user_id, state_data)
             await update.message.reply_text("Введите сумму чека (например 100 или 100.50):")
+            state_data["upload"] = make_span(upload_started, kind="document")
             return
 
     media_label = "[Медиа]"
@@ -1605,6 +4758,7 @@ async def secret_chat_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "sent_to": {}
     }
 
+    fanout_started = time.perf_counter()
     for uid in user_pseudonyms[bot_token].keys():
         if uid != user_id:
             try:
@@ -1660,22 +4814,24 @@ async def secret_chat_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         "sender_msg_id": update.message.message_id
                     }
             except Exception as e:
-                logger.error(f"Error sending media to {uid}: {e}")
+                logger.error("Error sending media to %s: %s", uid, e)
+    record_fanout("media", fanout_started)
+    persist_message_fanout(bot_token, (user_id, update.message.message_id))
 
 
 async def debug_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.callback_query:
-        logger.info(f"!!! DEBUG: Callback query received: {update.callback_query.data}")
-        logger.info(f"!!! DEBUG: From user: {update.callback_query.from_user.id}")
-        logger.info(f"!!! DEBUG: Bot: {context.bot.username}")
+        logger.debug(
+            "Callback query %s from %s on @%s",
+            update.callback_query.data, update.callback_query.from_user.id, context.bot.username,
+            extra={"event": "callback"}
+        )
 
 
 async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
 
-    logger.info(f"=== Receipt callback triggered ===")
-    logger.info(f"Callback data: {query.data}")
-    logger.info(f"User ID: {query.from_user.id}")
+    logger.debug("Receipt callback %s from %s", query.data, query.from_user.id, extra={"event": "callback"})
 
     if not query.data.startswith("receipt_"):
         return
@@ -1693,6 +4849,7 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     receipt_data = receipts[receipt_id]
+    callback_started = time.perf_counter()
 
     bot_token = receipt_data.get("bot_token")
     if not bot_token:
@@ -1712,14 +4869,14 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if prev_status == "approved":
             await query.answer("Этот чек уже принят", show_alert=True)
             return
-        receipt_data["status"] = "approved"
+        set_receipt_status(receipt_id, "approved")
         status_text = f"Статус: Принят ✅ ({approver_name})"
         await query.answer("Чек принят!")
     elif action == "decline":
         if prev_status == "declined":
             await query.answer("Этот чек уже отклонён", show_alert=True)
             return
-        receipt_data["status"] = "declined"
+        set_receipt_status(receipt_id, "declined")
         status_text = f"Статус: Отклонён ❌ ({approver_name})"
         await query.answer("Чек отклонён!")
     elif action == "edit":
@@ -1733,7 +4890,7 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if receipt_data.get("status") != "declined":
             await query.answer("Этот чек не был отклонён", show_alert=True)
             return
-        receipt_data["status"] = "pending"
+        set_receipt_status(receipt_id, "pending")
         status_text = "Статус: Ожидание"
         await query.answer("Чек возвращён на рассмотрение!")
     elif action == "comment":
@@ -1757,44 +4914,66 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     bot_username = bot_to_use.username if hasattr(bot_to_use, 'username') else "unknown"
     amount = receipt_data.get("amount")
     currency = receipt_data.get("currency")
+    await wait_for_sheets()
 
     if action == "approve":
+        photo_url = None
+        if "photo_id" in receipt_data:
+            photo_url = f"https://t.me/c/{receipt_data['photo_id']}"
+        sheet_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        receipt_data["sheet_period"] = get_sheet_period(bot_token)
+        db_started = time.perf_counter()
+        db_update_receipt_status(receipt_id, "approved", sheet_ts, photo_url, receipt_data["sheet_period"])
+        add_receipt_span(receipt_id, "db_update", db_started, status="approved")
         if amount:
-            photo_url = None
-            if "photo_id" in receipt_data:
-                photo_url = f"https://t.me/c/{receipt_data['photo_id']}"
+            sheet_started = time.perf_counter()
             add_receipt_to_sheet(
                 bot_username=bot_username,
                 amount=amount,
                 currency=currency or get_bot_currency(bot_token),
                 pseudonym=receipt_data["pseudonym"],
-                photo_url=photo_url
+                photo_url=photo_url,
+                timestamp=sheet_ts,
+                period=receipt_data["sheet_period"]
             )
+            add_receipt_span(receipt_id, "sheet_write", sheet_started, op="add")
             if is_working_hours(bot_token):
-                db_add_daily_total(bot_token, amount)
-            logger.info(f"Added receipt to Google Sheets: {amount} {currency}")
+                db_add_daily_total(bot_token, amount, receipt_id)
+            logger.info("Added receipt to Google Sheets: %s %s", amount, currency)
 
     elif action == "decline":
+        db_started = time.perf_counter()
+        db_update_receipt_status(receipt_id, "declined")
+        add_receipt_span(receipt_id, "db_update", db_started, status="declined")
         if prev_status == "approved" and amount:
+            sheet_started = time.perf_counter()
             remove_receipt_from_sheet(
                 bot_username=bot_username,
                 amount=amount,
-                pseudonym=receipt_data["pseudonym"]
+                pseudonym=receipt_data["pseudonym"],
+                period=receipt_data.get("sheet_period")
             )
+            add_receipt_span(receipt_id, "sheet_write", sheet_started, op="remove")
             if is_working_hours(bot_token):
-                db_subtract_daily_total(bot_token, amount)
-            logger.info(f"Declined previously approved receipt: {amount} {currency}")
+                db_subtract_daily_total(bot_token, amount, receipt_id)
+            logger.info("Declined previously approved receipt: %s %s", amount, currency)
+
+    elif action == "undo":
+        db_started = time.perf_counter()
+        db_update_receipt_status(receipt_id, "pending")
+        add_receipt_span(receipt_id, "db_update", db_started, status="pending")
 
     elif action == "cancel":
         if amount:
             remove_receipt_from_sheet(
                 bot_username=bot_username,
                 amount=amount,
-                pseudonym=receipt_data["pseudonym"]
+                pseudonym=receipt_data["pseudonym"],
+                period=receipt_data.get("sheet_period")
             )
             if is_working_hours(bot_token):
-                db_subtract_daily_total(bot_token, amount)
-            logger.info(f"Cancelled receipt: {amount} {currency} by {approver_name}")
+                db_subtract_daily_total(bot_token, amount, receipt_id)
+            logger.info("Cancelled receipt: %s %s by %s", amount, currency, approver_name)
 
     currency_for_total = receipt_data.get("currency") or get_bot_currency(bot_token)
     if is_working_hours(bot_token):
@@ -1824,17 +5003,15 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         action_markup = None
 
-    comments_text = ""
-    if receipt_data.get("comments"):
-        comments_text = "\n\n💬 Комментарии:"
-        for c in receipt_data["comments"]:
-            comments_text += f"\n{c['pseudonym']}: {c['text']}"
+    comments_text = render_receipt_comments(receipt_data.get("comments"))
 
     if "message_ids" in receipt_data:
+        fanout_started = time.perf_counter()
         for uid, msg_id in receipt_data["message_ids"].items():
+            edit_started = time.perf_counter()
             try:
                 if "photo_id" in receipt_data or "document_id" in receipt_data:
-                    new_caption = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
+                    new_caption = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
                     await bot_to_use.edit_message_caption(
                         chat_id=uid,
                         message_id=msg_id,
@@ -1842,15 +5019,18 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         reply_markup=action_markup
                     )
                 else:
-                    new_text = f"{receipt_data['pseudonym']}: {receipt_data['text']}\n\nНовый чек\n{status_text}{daily_line}{comments_text}"
+                    new_text = render_receipt_caption(receipt_data, status_text, daily_line, comments_text)
                     await bot_to_use.edit_message_text(
                         chat_id=uid,
                         message_id=msg_id,
                         text=new_text,
                         reply_markup=action_markup
                     )
+                add_receipt_span(receipt_id, "caption_edit", edit_started, uid=uid)
             except Exception as e:
-                logger.error(f"Error updating receipt for {uid}: {e}", exc_info=True)
+                logger.error("Error updating receipt for %s: %s", uid, e, exc_info=True)
+                add_receipt_span(receipt_id, "caption_edit", edit_started, uid=uid, error=type(e).__name__)
+        record_fanout("receipt_update", fanout_started)
 
     now_msk = get_moscow_now().strftime("%H:%M МСК")
     owner_id = receipt_data.get("owner_id")
@@ -1883,9 +5063,10 @@ async def receipt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     allow_sending_without_reply=True
                 )
             except Exception as e:
-                logger.error(f"Error sending receipt notification to {uid}: {e}")
+                logger.error("Error sending receipt notification to %s: %s", uid, e)
 
-    logger.info("=== Receipt callback finished ===")
+    add_receipt_span(receipt_id, action, callback_started, by=approver_id)
+    logger.debug("Receipt callback %s finished", query.data, extra={"event": "callback"})
 
 
 async def invite_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2199,7 +5380,7 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             continue
 
         total_bots += 1
-        users = user_pseudonyms.get(bot_token, {})
+        users = get_bot_members(bot_token)
 
         for uid in users.keys():
             total_users += 1
@@ -2207,7 +5388,7 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await bot_app.bot.send_message(chat_id=uid, text=f"📢 Рассылка:\n\n{message_text}")
                 total_sent += 1
             except Exception as e:
-                logger.error(f"Failed to send broadcast to {uid}: {e}")
+                logger.error("Failed to send broadcast to %s: %s", uid, e)
 
     await update.message.reply_text(
         f"✅ Рассылка завершена\n\n"
@@ -2216,28 +5397,289 @@ async def broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+def start_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    dry_run = bool(context.args) and context.args[0] in ("dry", "check")
+    await update.message.reply_text("⏳ Сверка таблиц запущена...")
+    reports = await asyncio.to_thread(reconcile_all_sheets, dry_run)
+    await update.message.reply_text(format_reconcile_report(reports, dry_run))
+
+
+async def http_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    await update.message.reply_text(format_http_stats())
+
+
+async def memory_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global memory_report
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    if not memory_report or (context.args and context.args[0] == "now"):
+        memory_report = await asyncio.to_thread(sample_memory)
+    states, expected = await fetch_worker_states()
+    report = merge_memory_reports([memory_report] + [state["memory"] for state in states])
+    await update.message.reply_text(format_memory_report(report) + format_worker_coverage(len(states), expected))
+
+
+async def traces_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    limit = RECEIPT_TRACE_LIMIT
+    if context.args:
+        try:
+            limit = max(int(context.args[0]), 1)
+        except ValueError:
+            await update.message.reply_text("❌ Использование: /traces [количество]")
+            return
+
+    states, expected = await fetch_worker_states()
+    traces = list(receipt_traces.values())
+    if states:
+        traces.extend(trace for state in states for trace in state["traces"])
+        traces.sort(key=lambda trace: trace["spans"][0]["start"] if trace["spans"] else 0)
+    traces = traces[-limit:]
+    summary = summarize_receipt_traces(traces)
+    await update.message.reply_text(
+        format_receipt_trace_summary(summary, len(traces)) + format_worker_coverage(len(states), expected)
+    )
+    if traces:
+        payload = json.dumps({"summary": summary, "traces": traces}, ensure_ascii=False, indent=1)
+        await update.message.reply_document(
+            document=io.BytesIO(payload.encode("utf-8")),
+            filename=f"receipt_traces_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+        )
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    states, expected = await fetch_worker_states()
+    slow = count_slow_updates() + sum(state["slow_updates"] for state in states)
+    await update.message.reply_text(
+        format_handler_stats(merge_handler_timings(states), slow) + format_worker_coverage(len(states), expected)
+    )
+
+
+async def polling_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    await update.message.reply_text(format_polling_report())
+
+
+async def startup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return
+
+    await update.message.reply_text(format_startup_report())
+
+
+async def find_bot_for_command(update, context, usage):
+    user_id = update.effective_user.id
+    if user_id not in WHITELIST:
+        await update.message.reply_text("⛔ Доступ запрещён")
+        return None
+
+    if not context.args:
+        await update.message.reply_text(f"❌ Использование: {usage}")
+        return None
+
+    row = db_find_bot(context.args[0])
+    if not row:
+        await update.message.reply_text("❌ Бот не найден")
+        return None
+    return row
+
+
+def format_reclaimed(reclaimed):
+    return (
+        f"Освобождено: {reclaimed['members']} участников, "
+        f"{reclaimed['messages']} сообщений, {reclaimed['receipts']} чеков в памяти"
+    )
+
+
+async def suspend_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    row = await find_bot_for_command(update, context, "/suspend @bot")
+    if not row:
+        return
+    token, username, _, _, suspended = row
+    if suspended:
+        await update.message.reply_text(f"ℹ️ Бот @{username} уже приостановлен")
+        return
+
+    db_set_bot_suspended(token, True)
+    reclaimed = await retire_bot(token)
+    logger.info("Suspended bot @%s", username)
+    await update.message.reply_text(f"⏸ Бот @{username} приостановлен\n\n{format_reclaimed(reclaimed)}")
+
+
+async def resume_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id in WHITELIST and not context.args:
+        suspended = db_get_suspended_bots()
+        if suspended:
+            await update.message.reply_text(
+                "⏸ Приостановленные боты:\n" + "\n".join(f"  • @{u}" for u in suspended)
+                + "\n\nИспользование: /resume @bot"
+            )
+            return
+
+    row = await find_bot_for_command(update, context, "/resume @bot")
+    if not row:
+        return
+    token, username, admin_user_id, geo, suspended = row
+    if not suspended:
+        await update.message.reply_text(f"ℹ️ Бот @{username} уже работает")
+        return
+
+    db_set_bot_suspended(token, False)
+    evict_bot_state(token)
+    db_load_all(token)
+    result = await restore_bot(asyncio.Semaphore(1), token, username, admin_user_id, geo)
+    if result["error"]:
+        await update.message.reply_text(f"❌ Бот @{username} не запустился: {result['error']}")
+        return
+    logger.info("Resumed bot @%s", username)
+    await update.message.reply_text(f"▶️ Бот @{username} снова работает")
+
+
+async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    row = await find_bot_for_command(update, context, "/delete @bot confirm")
+    if not row:
+        return
+    token, username = row[0], row[1]
+    if len(context.args) < 2 or context.args[1] != "confirm":
+        await update.message.reply_text(
+            f"⚠️ Бот @{username} будет остановлен, а его участники, инвайты и настройки удалены.\n"
+            f"История чеков и таблица сохранятся.\n\n"
+            f"Для подтверждения: /delete @{username} confirm"
+        )
+        return
+
+    db_delete_bot(token)
+    reclaimed = await retire_bot(token)
+    logger.info("Deleted bot @%s", username)
+    await update.message.reply_text(f"🗑 Бот @{username} удалён\n\n{format_reclaimed(reclaimed)}")
+
+
+async def on_admin_startup(app):
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await serve_http(METRICS_LISTEN, METRICS_PORT, handle_metrics_request)
+        logger.info("Metrics listening on %s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    start_memory_sampler()
+    start_state_writer()
+    if WEBHOOK_URL and not BOT_WORKERS:
+        app.bot_data["webhook_server"] = await start_webhook_server()
+    await restore_bots(app)
+    if export_backend.name == "sheets":
+        start_background_task(init_google_sheets_background())
+    if BOT_WORKERS:
+        start_background_task(supervise_workers())
+    if RECONCILE_INTERVAL > 0 and export_backend.name == "sheets":
+        start_background_task(reconcile_loop())
+    if export_backend.name != "sheets" and EXPORT_FLUSH_INTERVAL > 0:
+        start_background_task(export_flush_loop())
+    if PENDING_ESCALATE_AFTER > 0:
+        start_background_task(pending_escalation_loop())
+
+
+async def on_admin_stop(app):
+    server = app.bot_data.get("webhook_server")
+    if server:
+        server.close()
+    await shutdown_secret_bots()
+    stop_memory_sampler()
+    stop_state_writer()
+    metrics_server = app.bot_data.get("metrics_server")
+    if metrics_server:
+        metrics_server.close()
+
+
+async def on_admin_shutdown(app):
+    if worker_processes:
+        await asyncio.to_thread(stop_workers)
+
+
 def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        asyncio.run(run_worker(int(sys.argv[2])))
+        return
+
     if not ADMIN_BOT_TOKEN:
         raise ValueError("ADMIN_BOT_TOKEN environment variable is required")
 
     if not WHITELIST:
         raise ValueError("WHITELIST environment variable is required")
 
+    setup_logging()
+    started = time.perf_counter()
     init_db()
-    init_google_sheets()
-
-    admin_app = Application.builder().token(ADMIN_BOT_TOKEN).post_init(restore_bots).build()
+    init_export_backend()
+    record_startup_phase("init_db", started)
+
+    started = time.perf_counter()
+    admin_app = (
+        new_application_builder(ADMIN_BOT_TOKEN)
+        .post_init(on_admin_startup)
+        .post_stop(on_admin_stop)
+        .post_shutdown(on_admin_shutdown)
+        .build()
+    )
 
     admin_app.add_handler(CommandHandler("start", start_admin))
     admin_app.add_handler(CommandHandler("create_secret_chat", create_secret_chat))
     admin_app.add_handler(CommandHandler("add", add_to_whitelist))
     admin_app.add_handler(CommandHandler("msg", broadcast_message))
+    admin_app.add_handler(CommandHandler("reconcile", reconcile_command))
+    admin_app.add_handler(CommandHandler("startup", startup_command))
+    admin_app.add_handler(CommandHandler("http", http_command))
+    admin_app.add_handler(CommandHandler("polling", polling_command))
+    admin_app.add_handler(CommandHandler("stats", stats_command))
+    admin_app.add_handler(CommandHandler("memory", memory_command))
+    admin_app.add_handler(CommandHandler("traces", traces_command))
+    admin_app.add_handler(CommandHandler("import", import_command))
+    admin_app.add_handler(CommandHandler("suspend", suspend_command))
+    admin_app.add_handler(CommandHandler("resume", resume_command))
+    admin_app.add_handler(CommandHandler("delete", delete_command))
     admin_app.add_handler(CallbackQueryHandler(admin_geo_callback))
     admin_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_message))
+    admin_app.add_handler(MessageHandler(filters.Document.ALL, handle_admin_document))
+    instrument_handlers(admin_app)
+    record_startup_phase("admin_build", started)
 
     logger.info("Admin bot started")
     admin_app.run_polling()
+    stop_logging()
+
 
+record_startup_phase("import", IMPORT_STARTED)
 
 if __name__ == "__main__":
     main()
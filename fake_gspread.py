@@ -0,0 +1,279 @@
+import os
+import time
+import random
+import threading
+from collections import deque, defaultdict
+
+from gspread.cell import Cell
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_range_to_grid_range
+
+FAKE_SHEETS_LATENCY = os.getenv("FAKE_SHEETS_LATENCY", "0")
+FAKE_SHEETS_QUOTA = int(os.getenv("FAKE_SHEETS_QUOTA", "0"))
+FAKE_SHEETS_FAILURE_RATE = float(os.getenv("FAKE_SHEETS_FAILURE_RATE", "0"))
+FAKE_SHEETS_SEED = os.getenv("FAKE_SHEETS_SEED")
+
+spreadsheets = {}
+
+
+class FakeResponse:
+    def __init__(self, code, message, status):
+        self.status_code = code
+        self.text = message
+        self.error = {"code": code, "message": message, "status": status}
+
+    def json(self):
+        return {"error": self.error}
+
+
+def parse_latency(value):
+    if "-" in value:
+        low, high = value.split("-", 1)
+        return float(low), float(high)
+    return float(value), float(value)
+
+
+class FakeBackend:
+    def __init__(self, latency=None, quota=None, failure_rate=None, seed=None):
+        self.latency = parse_latency(latency if latency is not None else FAKE_SHEETS_LATENCY)
+        self.quota = FAKE_SHEETS_QUOTA if quota is None else quota
+        self.failure_rate = FAKE_SHEETS_FAILURE_RATE if failure_rate is None else failure_rate
+        seed = FAKE_SHEETS_SEED if seed is None else seed
+        self.random = random.Random(seed)
+        self.calls = deque()
+        self.stats = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def request(self, method):
+        with self.lock:
+            now = time.monotonic()
+            self.stats[method] += 1
+            self.stats["total"] += 1
+            while self.calls and now - self.calls[0] > 60:
+                self.calls.popleft()
+            if self.quota and len(self.calls) >= self.quota:
+                self.stats["quota_exceeded"] += 1
+                raise APIError(FakeResponse(429, "Quota exceeded for quota metric 'Write requests'", "RESOURCE_EXHAUSTED"))
+            self.calls.append(now)
+            fail = self.failure_rate and self.random.random() < self.failure_rate
+            delay = self.random.uniform(*self.latency)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            self.stats["injected_failures"] += 1
+            raise APIError(FakeResponse(503, "The service is currently unavailable.", "UNAVAILABLE"))
+
+
+class FakeClient:
+    def __init__(self, backend=None):
+        self.backend = backend or FakeBackend()
+
+    def open_by_key(self, key):
+        self.backend.request("open_by_key")
+        if key not in spreadsheets:
+            spreadsheets[key] = FakeSpreadsheet(key, self.backend)
+        return spreadsheets[key]
+
+
+class FakeSpreadsheet:
+    def __init__(self, key, backend):
+        self.id = key
+        self.backend = backend
+        self.sheets = {}
+        self.next_sheet_id = 1
+
+    def worksheet(self, title):
+        self.backend.request("worksheet")
+        if title not in self.sheets:
+            raise WorksheetNotFound(title)
+        return self.sheets[title]
+
+    def worksheets(self, exclude_hidden=False):
+        self.backend.request("worksheets")
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title, rows, cols, index=None):
+        self.backend.request("add_worksheet")
+        return self.create_sheet(title, rows, cols)
+
+    def create_sheet(self, title, rows, cols):
+        if title in self.sheets:
+            raise APIError(FakeResponse(400, f'A sheet with the name "{title}" already exists.', "INVALID_ARGUMENT"))
+        worksheet = FakeWorksheet(self, self.next_sheet_id, title, rows, cols)
+        self.next_sheet_id += 1
+        self.sheets[title] = worksheet
+        return worksheet
+
+    def del_worksheet(self, worksheet):
+        self.backend.request("del_worksheet")
+        self.sheets.pop(worksheet.title, None)
+
+    def batch_update(self, body):
+        self.backend.request("batch_update")
+        replies = []
+        for request in body.get("requests", []):
+            if "addSheet" in request:
+                props = request["addSheet"]["properties"]
+                grid = props.get("gridProperties", {})
+                worksheet = self.create_sheet(props["title"], grid.get("rowCount", 1000), grid.get("columnCount", 26))
+                replies.append({"addSheet": {"properties": {"sheetId": worksheet.id, "title": worksheet.title}}})
+            elif "deleteDimension" in request:
+                grid = request["deleteDimension"]["range"]
+                worksheet = self.get_sheet_by_id(grid["sheetId"])
+                if grid.get("dimension", "ROWS") == "ROWS":
+                    worksheet.remove_rows(grid["startIndex"], grid["endIndex"])
+                replies.append({})
+            else:
+                raise APIError(FakeResponse(400, f"Unsupported request: {list(request)}", "INVALID_ARGUMENT"))
+        return {"spreadsheetId": self.id, "replies": replies}
+
+    def values_batch_update(self, body):
+        self.backend.request("values_batch_update")
+        for data in body.get("data", []):
+            title, _, cells = data["range"].rpartition("!")
+            worksheet = self.sheets.get(title.strip("'"))
+            if worksheet is None:
+                raise APIError(FakeResponse(400, f"Unable to parse range: {data['range']}", "INVALID_ARGUMENT"))
+            grid = a1_range_to_grid_range(cells)
+            for offset, row in enumerate(data["values"]):
+                for col_offset, value in enumerate(row):
+                    worksheet.set_value(grid.get("startRowIndex", 0) + offset + 1, grid.get("startColumnIndex", 0) + col_offset + 1, value)
+        return {"spreadsheetId": self.id, "totalUpdatedRows": len(body.get("data", []))}
+
+    def get_sheet_by_id(self, sheet_id):
+        for worksheet in self.sheets.values():
+            if worksheet.id == sheet_id:
+                return worksheet
+        raise WorksheetNotFound(sheet_id)
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, sheet_id, title, rows, cols):
+        self.spreadsheet = spreadsheet
+        self.backend = spreadsheet.backend
+        self.id = sheet_id
+        self.title = title
+        self.row_count = rows
+        self.col_count = cols
+        self.rows = []
+        self.protected_ranges = []
+
+    def ensure_rows(self, count):
+        while len(self.rows) < count:
+            self.rows.append([])
+
+    def set_value(self, row, col, value):
+        if row > self.row_count:
+            raise APIError(FakeResponse(400, f"Range exceeds grid limits. Max rows: {self.row_count}", "INVALID_ARGUMENT"))
+        self.ensure_rows(row)
+        cells = self.rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = "" if value is None else str(value)
+
+    def get_value(self, row, col):
+        if row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ""
+
+    def trimmed_rows(self):
+        end = len(self.rows)
+        while end and not any(self.rows[end - 1]):
+            end -= 1
+        return [list(row) for row in self.rows[:end]]
+
+    def append_rows(self, values, value_input_option=None, **kwargs):
+        self.backend.request("append_rows")
+        start = len(self.trimmed_rows()) + 1
+        if start + len(values) - 1 > self.row_count:
+            self.row_count = start + len(values) - 1
+        for offset, row in enumerate(values):
+            for col, value in enumerate(row, start=1):
+                self.set_value(start + offset, col, value)
+        return {"updates": {"updatedRows": len(values)}}
+
+    def append_row(self, values, value_input_option=None, **kwargs):
+        return self.append_rows([values])
+
+    def update(self, range_name, values=None, **kwargs):
+        self.backend.request("update")
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        grid = a1_range_to_grid_range(range_name)
+        for offset, row in enumerate(values):
+            for col_offset, value in enumerate(row):
+                self.set_value(grid.get("startRowIndex", 0) + offset + 1, grid.get("startColumnIndex", 0) + col_offset + 1, value)
+        return {"updatedRange": range_name}
+
+    def get_all_values(self, **kwargs):
+        self.backend.request("get_all_values")
+        return self.trimmed_rows()
+
+    def get(self, range_name=None, **kwargs):
+        self.backend.request("get")
+        rows = self.trimmed_rows()
+        if not range_name:
+            return rows
+        grid = a1_range_to_grid_range(range_name)
+        start_row = grid.get("startRowIndex", 0)
+        end_row = grid.get("endRowIndex", len(rows))
+        start_col = grid.get("startColumnIndex", 0)
+        end_col = grid.get("endColumnIndex")
+        result = [row[start_col:end_col] for row in rows[start_row:end_row]]
+        while result and not any(result[-1]):
+            result.pop()
+        return result
+
+    def col_values(self, col, **kwargs):
+        self.backend.request("col_values")
+        values = [row[col - 1] if col <= len(row) else "" for row in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self.backend.request("find")
+        for row_index, row in enumerate(self.rows, start=1):
+            if in_row and row_index != in_row:
+                continue
+            for col_index, value in enumerate(row, start=1):
+                if in_column and col_index != in_column:
+                    continue
+                if value == query or (not case_sensitive and value.lower() == str(query).lower()):
+                    return Cell(row_index, col_index, value)
+        return None
+
+    def cell(self, row, col, **kwargs):
+        self.backend.request("cell")
+        return Cell(row, col, self.get_value(row, col))
+
+    def update_cell(self, row, col, value):
+        self.backend.request("update_cell")
+        self.set_value(row, col, value)
+        return {"updatedCells": 1}
+
+    def delete_rows(self, start_index, end_index=None):
+        self.backend.request("delete_rows")
+        self.remove_rows(start_index - 1, end_index or start_index)
+
+    def remove_rows(self, start, end):
+        del self.rows[start:end]
+        self.row_count = max(self.row_count - (end - start), 1)
+
+    def resize(self, rows=None, cols=None):
+        self.backend.request("resize")
+        if rows is not None:
+            self.row_count = rows
+            del self.rows[rows:]
+        if cols is not None:
+            self.col_count = cols
+
+    def add_protected_range(self, name, editor_users_emails=None, editor_groups_emails=None,
+                            description=None, warning_only=False, requesting_user_can_edit=False):
+        self.backend.request("add_protected_range")
+        self.protected_ranges.append({"range": name, "description": description})
+        return {"replies": [{"addProtectedRange": {"protectedRange": {"range": name}}}]}
+
+
+def authorize(credentials=None, backend=None):
+    return FakeClient(backend)
@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter, deque
+from email.parser import BytesParser
+from urllib.parse import parse_qs
+
+import httpx
+
+from fake_gspread import parse_latency
+
+FAKE_TELEGRAM_LATENCY = os.getenv("FAKE_TELEGRAM_LATENCY", "0")
+FAKE_TELEGRAM_RATE_LIMIT = float(os.getenv("FAKE_TELEGRAM_RATE_LIMIT", "0"))
+FAKE_TELEGRAM_FLOOD_RATE = float(os.getenv("FAKE_TELEGRAM_FLOOD_RATE", "0"))
+FAKE_TELEGRAM_SEED = os.getenv("FAKE_TELEGRAM_SEED")
+
+JSON_PARAMS = {
+    "chat_id", "message_id", "from_chat_id", "reply_to_message_id", "offset", "limit", "timeout",
+    "reply_markup", "reply_parameters", "allowed_updates", "allow_sending_without_reply", "show_alert",
+    "disable_notification", "entities", "caption_entities", "link_preview_options", "drop_pending_updates",
+}
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendDocument", "sendVideo", "sendAudio", "sendVoice",
+    "sendAnimation", "sendSticker", "sendVideoNote", "copyMessage",
+}
+RATE_LIMITED_METHODS = SEND_METHODS | {"editMessageCaption", "editMessageText", "editMessageReplyMarkup"}
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def make_user(user_id, username=None):
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+    if username:
+        user["username"] = username
+    return user
+
+
+def make_message(user_id, text=None, message_id=None, reply_to=None, **fields):
+    message = {
+        "message_id": message_id or next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": make_user(user_id),
+    }
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    if reply_to:
+        message["reply_to_message"] = {
+            "message_id": reply_to,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+        }
+    message.update(fields)
+    return message
+
+
+def make_text_update(user_id, text, message_id=None, reply_to=None):
+    return {"update_id": next(update_ids), "message": make_message(user_id, text, message_id, reply_to)}
+
+
+def make_photo_update(user_id, file_id, message_id=None, reply_to=None, caption=None):
+    photo = [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}]
+    fields = {"photo": photo}
+    if caption:
+        fields["caption"] = caption
+    return {"update_id": next(update_ids), "message": make_message(user_id, None, message_id, reply_to, **fields)}
+
+
+def make_media_update(user_id, kind, file_id, message_id=None, reply_to=None, **extra):
+    media = {"file_id": file_id, "file_unique_id": file_id, **extra}
+    if kind in ("voice", "audio"):
+        media.setdefault("duration", 1)
+    return {"update_id": next(update_ids), "message": make_message(user_id, None, message_id, reply_to, **{kind: media})}
+
+
+def make_callback_update(user_id, data, message_id=1):
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": make_message(user_id, "", message_id),
+        },
+    }
+
+
+def parse_api_params(headers, body):
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("multipart/form-data"):
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        raw = {}
+        for part in message.get_payload():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename():
+                raw[name] = f"upload:{part.get_filename()}"
+            else:
+                raw[name] = part.get_payload(decode=True).decode("utf-8")
+    else:
+        raw = {key: values[-1] for key, values in parse_qs(body.decode("utf-8"), keep_blank_values=True).items()}
+    params = {}
+    for key, value in raw.items():
+        if key in JSON_PARAMS:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        params[key] = value
+    return params
+
+
+class FakeBotApi:
+    def __init__(self, latency=None, rate_limit=None, flood_rate=None, seed=None, retry_after=1):
+        self.latency = parse_latency(latency if latency is not None else FAKE_TELEGRAM_LATENCY)
+        self.rate_limit = FAKE_TELEGRAM_RATE_LIMIT if rate_limit is None else rate_limit
+        self.flood_rate = FAKE_TELEGRAM_FLOOD_RATE if flood_rate is None else flood_rate
+        self.random = random.Random(FAKE_TELEGRAM_SEED if seed is None else seed)
+        self.retry_after = retry_after
+        self.bots = {}
+        self.sends = {}
+        self.message_ids = itertools.count(1000)
+        self.stats = Counter()
+        self.server = None
+        self.url = None
+
+    def add_bot(self, token, username=None):
+        bot_id = int(token.split(":", 1)[0])
+        self.bots[token] = {
+            "user": {"id": bot_id, "is_bot": True, "first_name": username or f"bot{bot_id}",
+                     "username": username or f"bot{bot_id}", "can_join_groups": False,
+                     "can_read_all_group_messages": False, "supports_inline_queries": False},
+            "updates": deque(),
+            "arrived": asyncio.Event(),
+        }
+        self.sends[token] = deque()
+        return self.bots[token]["user"]
+
+    def push_update(self, token, update):
+        bot = self.bots[token]
+        bot["updates"].append(update)
+        bot["arrived"].set()
+
+    def error(self, code, description, **parameters):
+        self.stats[f"error_{code}"] += 1
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return code, "application/json", json.dumps(payload).encode()
+
+    def rate_limited(self, token):
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            return True
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        sends = self.sends[token]
+        while sends and now - sends[0] > 1:
+            sends.popleft()
+        if len(sends) >= self.rate_limit:
+            return True
+        sends.append(now)
+        return False
+
+    def make_sent_message(self, bot, params, **fields):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": params["chat_id"], "type": "private"},
+            "from": bot["user"],
+        }
+        message.update(fields)
+        if isinstance(params.get("reply_markup"), dict) and "inline_keyboard" in params["reply_markup"]:
+            message["reply_markup"] = params["reply_markup"]
+        return message
+
+    async def get_updates(self, bot, params):
+        offset = params.get("offset")
+        updates = bot["updates"]
+        if offset is not None:
+            while updates and updates[0]["update_id"] < offset:
+                updates.popleft()
+        if not updates and params.get("timeout"):
+            bot["arrived"].clear()
+            try:
+                await asyncio.wait_for(bot["arrived"].wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(updates, int(params.get("limit") or 100)))
+
+    async def call(self, token, method, params):
+        bot = self.bots[token]
+        if method == "getMe":
+            return bot["user"]
+        if method == "getUpdates":
+            return await self.get_updates(bot, params)
+        if method in ("deleteWebhook", "setWebhook", "answerCallbackQuery", "deleteMessage", "setMyCommands"):
+            return True
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": len(bot["updates"])}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"], "file_path": f"files/{params['file_id']}"}
+        if method == "sendMessage":
+            return self.make_sent_message(bot, params, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = [{"file_id": params["photo"], "file_unique_id": params["photo"], "width": 800, "height": 600}]
+            return self.make_sent_message(bot, params, photo=photo, caption=params.get("caption"))
+        if method in SEND_METHODS:
+            field = method[4:].lower()
+            media = params.get(field) or params.get("document")
+            document = {"file_id": media, "file_unique_id": media}
+            return self.make_sent_message(bot, params, document=document, caption=params.get("caption"))
+        if method in ("editMessageCaption", "editMessageText", "editMessageReplyMarkup"):
+            fields = {"caption": params.get("caption")} if method == "editMessageCaption" else {"text": params.get("text", "")}
+            message = self.make_sent_message(bot, params, **fields)
+            message["message_id"] = params.get("message_id")
+            message["edit_date"] = int(time.time())
+            return message
+        return None
+
+    async def handle(self, method, path, headers, body):
+        token, _, api_method = path.lstrip("/").removeprefix("bot").partition("/")
+        api_method = api_method.split("?", 1)[0]
+        if path.startswith("/fake/"):
+            token = path.split("/")[2]
+            if token not in self.bots:
+                return self.error(404, "Not Found: unknown bot")
+            self.push_update(token, json.loads(body))
+            return 200, "application/json", b'{"ok":true}'
+        self.stats[api_method] += 1
+        if token not in self.bots:
+            return self.error(401, "Unauthorized")
+        params = parse_api_params(headers, body)
+        delay = self.random.uniform(*self.latency)
+        if delay:
+            await asyncio.sleep(delay)
+        if api_method in RATE_LIMITED_METHODS and self.rate_limited(token):
+            return self.error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+        result = await self.call(token, api_method, params)
+        if result is None:
+            return self.error(404, "Not Found: method not found")
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    async def start(self, host="127.0.0.1", port=0):
+        import bot
+        self.server = await bot.serve_http(host, port, self.handle, max_body=50 * 1024 * 1024)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+async def serve_fake_api(host, port, tokens, **options):
+    api = FakeBotApi(**options)
+    for token in tokens:
+        api.add_bot(token)
+    url = await api.start(host, port)
+    print(f"Fake Bot API listening on {url} (set TELEGRAM_API_URL={url})")
+    while True:
+        await asyncio.sleep(3600)
+
+
+def post_update(url, secret, update, client=None):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    if client:
+        return client.post(url, json=update, headers=headers)
+    return httpx.post(url, json=update, headers=headers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Telegram stand-in for testing the bot")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    post = commands.add_parser("post", help="post a text update to the local webhook server")
+    post.add_argument("--token", required=True, help="secret bot token the update is addressed to")
+    post.add_argument("--server", default="http://127.0.0.1:8443")
+    post.add_argument("--user", type=int, required=True)
+    post.add_argument("--text", required=True)
+    post.add_argument("--reply-to", type=int)
+
+    serve = commands.add_parser("serve", help="run a local stand-in for the Telegram Bot API")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8081)
+    serve.add_argument("--token", action="append", default=[], help="bot token to accept (repeatable)")
+    serve.add_argument("--latency", default=None, help="seconds per call, e.g. 0.05 or 0.02-0.2")
+    serve.add_argument("--rate-limit", type=float, default=None, help="sends per second per bot before 429")
+    serve.add_argument("--flood-rate", type=float, default=None, help="probability of an injected 429")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            asyncio.run(serve_fake_api(
+                args.host, args.port, args.token,
+                latency=args.latency, rate_limit=args.rate_limit, flood_rate=args.flood_rate,
+            ))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.command == "post":
+        import bot
+        url = f"{args.server.rstrip('/')}/{bot.get_webhook_path(args.token)}"
+        update = make_text_update(args.user, args.text, reply_to=args.reply_to)
+        response = post_update(url, bot.get_webhook_secret(args.token), update)
+        print(f"{response.status_code} {url}")
+        return 0 if response.status_code == 200 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
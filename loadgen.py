@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+
+import bot
+from benchmarks import percentile
+
+TRACE_FORMAT = 1
+LOAD_ADMIN = 1
+DEFAULT_MIX = "text=40,reply=15,media=10,delete=5,receipt=12,approve=8,decline=3,edit=3,comment=4"
+EVENT_KINDS = ("text", "reply", "media", "delete", "receipt", "approve", "decline", "edit", "comment")
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in EVENT_KINDS:
+            raise ValueError(f"unknown event kind: {kind}")
+        mix[kind] = float(weight or 1)
+    if not mix:
+        raise ValueError("empty mix")
+    return mix
+
+
+def generate_trace(bots, members, events, mix, seed):
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    chats = [{"messages": {}, "pending": [], "approved": []} for _ in range(bots)]
+    trace = []
+    for seq in range(events):
+        index = rng.randrange(bots)
+        chat = chats[index]
+        kind = rng.choices(kinds, weights)[0]
+        user = rng.randint(1, members)
+        own = chat["messages"].get(user)
+        if kind in ("reply", "delete") and not own:
+            kind = "text"
+        if (kind in ("approve", "decline") and not chat["pending"]) or (kind == "edit" and not chat["approved"]):
+            kind = "receipt"
+        if kind == "comment" and not (chat["pending"] or chat["approved"]):
+            kind = "receipt"
+
+        event = {"seq": seq, "bot": index, "user": user, "kind": kind, "message_id": 2 * seq + 1}
+        if kind == "text":
+            event["text"] = f"message {seq}"
+        elif kind == "reply":
+            event["text"] = f"reply {seq}"
+            event["reply_to"] = rng.choice(own)
+        elif kind == "delete":
+            event["reply_to"] = own.pop(rng.randrange(len(own)))
+        elif kind == "media":
+            event["file_id"] = f"voice{seq}"
+        elif kind == "receipt":
+            event["file_id"] = f"receipt{seq}"
+            event["amount"] = rng.randint(10, 5000)
+            chat["pending"].append(seq)
+        elif kind in ("approve", "decline"):
+            event["user"] = LOAD_ADMIN
+            event["receipt"] = chat["pending"].pop(rng.randrange(len(chat["pending"])))
+            if kind == "approve":
+                chat["approved"].append(event["receipt"])
+        elif kind == "edit":
+            event["user"] = LOAD_ADMIN
+            event["receipt"] = rng.choice(chat["approved"])
+            event["amount"] = rng.randint(10, 5000)
+        elif kind == "comment":
+            event["receipt"] = rng.choice(chat["pending"] + chat["approved"])
+            event["text"] = f"comment {seq}"
+
+        if kind in ("text", "reply", "media"):
+            chat["messages"].setdefault(event["user"], []).append(event["message_id"])
+        trace.append(event)
+    return trace
+
+
+def trace_digest(trace):
+    return hashlib.sha256(json.dumps(trace, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def save_trace(path, header, trace):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"format": TRACE_FORMAT, **header}) + "\n")
+        for event in trace:
+            f.write(json.dumps(event) + "\n")
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != TRACE_FORMAT:
+            raise ValueError(f"unsupported trace format: {header.get('format')}")
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def build_updates(event, receipt_ids):
+    import fake_telegram
+
+    user = event["user"]
+    message_id = event["message_id"]
+    kind = event["kind"]
+    if kind in ("text", "reply"):
+        return [fake_telegram.make_text_update(user, event["text"], message_id, event.get("reply_to"))]
+    if kind == "delete":
+        return [fake_telegram.make_text_update(user, "удалить", message_id, event["reply_to"])]
+    if kind == "media":
+        return [fake_telegram.make_media_update(user, "voice", event["file_id"], message_id)]
+    if kind == "receipt":
+        return [
+            fake_telegram.make_photo_update(user, event["file_id"], message_id),
+            fake_telegram.make_text_update(user, str(event["amount"]), message_id + 1),
+        ]
+    receipt_id = receipt_ids.get(event["receipt"])
+    if not receipt_id:
+        return []
+    if kind in ("approve", "decline"):
+        return [fake_telegram.make_callback_update(user, f"receipt_{kind}_{receipt_id}")]
+    if kind == "edit":
+        return [
+            fake_telegram.make_callback_update(user, f"receipt_edit_{receipt_id}"),
+            fake_telegram.make_text_update(user, str(event["amount"]), message_id),
+        ]
+    return [
+        fake_telegram.make_callback_update(user, f"receipt_comment_{receipt_id}"),
+        fake_telegram.make_text_update(user, event["text"], message_id),
+    ]
+
+
+async def start_load_bots(api, bots, members):
+    apps = []
+    for index in range(bots):
+        token = f"{7000 + index}:{'l' * 35}"
+        username = f"load{index}"
+        api.add_bot(token, username)
+        bot.create_bot_sheet(username)
+        app = bot.build_secret_app(token)
+        await app.initialize()
+        bot.created_bots[token] = {"token": token, "application": app, "username": username}
+        bot.bot_admins[token] = LOAD_ADMIN
+        bot.user_pseudonyms[token] = {uid: f"user{uid}" for uid in range(1, members + 1)}
+        apps.append(app)
+    return apps
+
+
+async def replay_trace(header, trace, latency="0", rate_limit=0, flood_rate=0):
+    import fake_telegram
+    from telegram import Update
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.DB_PATH = os.path.join(tempfile.mkdtemp(), "load.db")
+    bot.init_db()
+    bot.GOOGLE_SHEETS_BACKEND = "fake"
+    bot.init_google_sheets()
+    random.seed(header["seed"])
+
+    api = fake_telegram.FakeBotApi(latency=latency, rate_limit=rate_limit, flood_rate=flood_rate, seed=header["seed"])
+    bot.TELEGRAM_API_URL = await api.start()
+    bot.start_state_writer()
+    latencies = {}
+    receipt_ids = {}
+    skipped = 0
+    try:
+        apps = await start_load_bots(api, header["bots"], header["members"])
+        started = time.perf_counter()
+        for event in trace:
+            app = apps[event["bot"]]
+            updates = build_updates(event, receipt_ids)
+            if not updates:
+                skipped += 1
+                continue
+            known = set(bot.receipts) if event["kind"] == "receipt" else None
+            event_started = time.perf_counter()
+            for update in updates:
+                await app.process_update(Update.de_json(update, app.bot))
+            latencies.setdefault(event["kind"], []).append(time.perf_counter() - event_started)
+            if known is not None:
+                created = [rid for rid in bot.receipts if rid not in known]
+                if created:
+                    receipt_ids[event["seq"]] = created[0]
+        seconds = time.perf_counter() - started
+        for app in apps:
+            await app.shutdown()
+    finally:
+        bot.stop_state_writer()
+        await api.stop()
+
+    calls = sum(count for method, count in api.stats.items() if not method.startswith("error_"))
+    return {
+        "digest": trace_digest(trace),
+        "bots": header["bots"],
+        "members": header["members"],
+        "events": len(trace),
+        "skipped": skipped,
+        "seconds": seconds,
+        "events_per_sec": (len(trace) - skipped) / seconds if seconds else 0.0,
+        "api_calls": calls,
+        "api_errors": sum(count for method, count in api.stats.items() if method.startswith("error_")),
+        "kinds": {
+            kind: {
+                "count": len(values),
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "total_ms": sum(values) * 1000,
+            }
+            for kind, values in latencies.items()
+        },
+    }
+
+
+def print_results(results):
+    print(
+        f"trace {results['digest']}: {results['bots']} bots x {results['members']} members, "
+        f"{results['events']} events ({results['skipped']} skipped) in {results['seconds']:.2f}s, "
+        f"{results['events_per_sec']:.1f} events/s, {results['api_calls']} API calls, {results['api_errors']} errors"
+    )
+    print(f"{'kind':<8} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'total ms':>10}")
+    for kind in EVENT_KINDS:
+        stats = results["kinds"].get(kind)
+        if stats:
+            print(f"{kind:<8} {stats['count']:>6} {stats['p50_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['total_ms']:>10.0f}")
+
+
+def compare_results(base, current):
+    if base["digest"] != current["digest"]:
+        print(f"warning: different traces ({base['digest']} vs {current['digest']})")
+    print(f"{'kind':<8} {'base p50':>9} {'new p50':>9} {'change':>8} {'base p99':>9} {'new p99':>9} {'change':>8}")
+    for kind in EVENT_KINDS:
+        old, new = base["kinds"].get(kind), current["kinds"].get(kind)
+        if not old or not new:
+            continue
+        p50 = (new["p50_ms"] / old["p50_ms"] - 1) * 100 if old["p50_ms"] else 0.0
+        p99 = (new["p99_ms"] / old["p99_ms"] - 1) * 100 if old["p99_ms"] else 0.0
+        print(
+            f"{kind:<8} {old['p50_ms']:>9.1f} {new['p50_ms']:>9.1f} {p50:>+7.1f}% "
+            f"{old['p99_ms']:>9.1f} {new['p99_ms']:>9.1f} {p99:>+7.1f}%"
+        )
+
+
+def add_backend_arguments(parser):
+    parser.add_argument("--latency", default="0", help="fake Bot API latency per call, e.g. 0.02-0.05")
+    parser.add_argument("--rate-limit", type=float, default=0, help="fake Bot API sends per second per bot")
+    parser.add_argument("--flood-rate", type=float, default=0, help="probability of an injected 429")
+    parser.add_argument("--results", help="write results as JSON for later comparison")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic chat and receipt load against the real handlers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="generate a trace without running it")
+    run = commands.add_parser("run", help="generate a trace and replay it")
+    for command in (generate, run):
+        command.add_argument("--bots", type=int, default=3)
+        command.add_argument("--members", type=int, default=20)
+        command.add_argument("--events", type=int, default=500)
+        command.add_argument("--mix", default=DEFAULT_MIX, help="kind=weight pairs, comma separated")
+        command.add_argument("--seed", type=int, default=1)
+    generate.add_argument("--output", required=True)
+    run.add_argument("--record", help="save the generated trace for replay")
+    add_backend_arguments(run)
+
+    replay = commands.add_parser("replay", help="replay a recorded trace")
+    replay.add_argument("trace")
+    add_backend_arguments(replay)
+
+    compare = commands.add_parser("compare", help="compare two results files")
+    compare.add_argument("base")
+    compare.add_argument("current")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        compare_results(base, current)
+        return 0
+
+    if args.command == "replay":
+        header, trace = load_trace(args.trace)
+    else:
+        header = {"seed": args.seed, "bots": args.bots, "members": args.members, "mix": args.mix}
+        trace = generate_trace(args.bots, args.members, args.events, parse_mix(args.mix), args.seed)
+        path = args.output if args.command == "generate" else args.record
+        if path:
+            save_trace(path, header, trace)
+            print(f"trace {trace_digest(trace)} saved to {path} ({len(trace)} events)")
+        if args.command == "generate":
+            return 0
+
+    results = asyncio.run(replay_trace(header, trace, args.latency, args.rate_limit, args.flood_rate))
+    print_results(results)
+    if args.results:
+        with open(args.results, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())